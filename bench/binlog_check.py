@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+
+# Round trip of a binlog backup against a local MySQL or MariaDB server with binary logging on: a full dump, rows
+# written before and after a chosen time, binlog capture, then restores to that time and to the end. The captured
+# SQL only replays into the database it came from, so the scratch database is reloaded for each restore. Nothing
+# else on the server is touched
+
+import os
+import sys
+import time
+import shutil
+import argparse
+import datetime
+import tempfile
+import subprocess
+
+sys.path.insert(0, os.path.abspath(os.path.dirname(os.path.abspath(__file__)) + '/..'))
+from util import binlog
+
+
+SOURCE_DATABASE = 'web_backup_binlog_check'
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Checks web_backup.py --binlog capture and web_restore.py ' \
+        '--stop-datetime replay against a local MySQL or MariaDB server')
+    parser.add_argument('--user', required=True, help='MySQL user with the RELOAD, REPLICATION CLIENT and ' \
+        'REPLICATION SLAVE privileges, and rights to create databases')
+    parser.add_argument('--password', required=True)
+    parser.add_argument('--socket', required=False, default='/var/lib/mysql/mysql.sock')
+    args = parser.parse_args(argv)
+
+    connection_args = binlog.get_connection_args(args.user, args.password, args.socket)
+    binlog.get_master_status(connection_args)
+    work_directory = tempfile.mkdtemp(prefix='binlog_check_')
+    try:
+        binlog.query(connection_args, 'DROP DATABASE IF EXISTS ' + SOURCE_DATABASE + '; CREATE DATABASE ' +
+            SOURCE_DATABASE + '; CREATE TABLE ' + SOURCE_DATABASE + '.t (id INT AUTO_INCREMENT PRIMARY KEY, ' +
+            'phase VARCHAR(16)) ENGINE=InnoDB')
+        insert_rows(connection_args, 'dump', 10)
+
+        dump_filename = os.path.join(work_directory, 'database.sql')
+        subprocess.check_call(['/bin/mysqldump'] + connection_args + ['--single-transaction',
+            binlog.get_dump_position_option(), '-r', dump_filename, SOURCE_DATABASE])
+        dump_position = binlog.read_dump_position(dump_filename)
+        print 'Dumped at binlog position ' + dump_position[0] + ':' + str(dump_position[1])
+
+        insert_rows(connection_args, 'before', 10)
+        # Binlog event times have one second resolution
+        time.sleep(2)
+        stop_datetime = datetime.datetime.now().strftime(binlog.DATETIME_FORMAT)
+        time.sleep(2)
+        insert_rows(connection_args, 'after', 10)
+
+        binlog_directory = os.path.join(work_directory, binlog.BINLOG_DIRECTORY)
+        names = binlog.capture(connection_args, dump_position[0], dump_position[1], SOURCE_DATABASE,
+            binlog_directory)
+        print 'Captured binlog files ' + ', '.join(names)
+
+        failed = False
+        for stop, expected_rows in [(stop_datetime, 20), (None, 30)]:
+            binlog.query(connection_args, 'DROP DATABASE IF EXISTS ' + SOURCE_DATABASE + '; CREATE DATABASE ' +
+                SOURCE_DATABASE)
+            with open(dump_filename) as f:
+                subprocess.check_call(['/bin/mysql'] + connection_args + [SOURCE_DATABASE], stdin=f)
+            binlog.replay_sql(connection_args, [os.path.join(binlog_directory, x) for x in names], stop)
+            num_rows = int(binlog.query(connection_args, 'SELECT COUNT(*) FROM ' + SOURCE_DATABASE + '.t')[0][0])
+            result = 'ok' if num_rows == expected_rows else 'FAILED'
+            failed = failed or num_rows != expected_rows
+            print 'Restored up to ' + str(stop) + ': ' + str(num_rows) + ' rows, expected ' + str(expected_rows) + \
+                ' ' + result
+    finally:
+        binlog.query(connection_args, 'DROP DATABASE IF EXISTS ' + SOURCE_DATABASE)
+        shutil.rmtree(work_directory)
+    if failed:
+        return 1
+    return 0
+
+
+def insert_rows(connection_args, phase, num_rows):
+    # With statement based logging, mysqlbinlog --database goes by the default database, as set by WordPress
+    binlog.query(connection_args, 'USE ' + SOURCE_DATABASE + '; INSERT INTO t (phase) VALUES ' +
+        ','.join(["('" + phase + "')"] * num_rows))
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,18 @@
+#!/usr/bin/env python
+
+# Stand-in for /bin/mysql used by web_bench.py. Reads the SQL piped to it to the end, the way the real client would
+# consume a restore, and reports how many bytes it was sent on stderr
+
+import sys
+
+
+def main(argv):
+    num_bytes = 0
+    for chunk in iter(lambda: sys.stdin.read(1024 * 1024), ''):
+        num_bytes += len(chunk)
+    sys.stderr.write(str(num_bytes) + '\n')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,54 @@
+#!/usr/bin/env python
+
+# Stand-in for /bin/mysqldump used by web_bench.py. Takes the same command line web_backup.py passes to mysqldump
+# and writes WEB_BENCH_DB_MB megabytes of WordPress-like SQL to the -r file (or stdout), so the dump phase can be
+# measured without a MySQL server
+
+import os
+import sys
+import random
+
+
+ROWS_PER_INSERT = 100
+
+
+def get_corpus(seed):
+    rand = random.Random(seed)
+    words = ['post', 'content', 'wordpress', 'the', 'and', 'of', 'to', 'a', 'in', 'is', 'that', 'for', 'with',
+        'page', 'comment', 'author', 'draft', 'publish', 'category', 'image', 'gallery', 'plugin', 'theme']
+    return ' '.join(rand.choice(words) for x in range(200000))
+
+
+def main(argv):
+    output_filename = None
+    if '-r' in argv:
+        output_filename = argv[argv.index('-r') + 1]
+    num_bytes = int(float(os.environ.get('WEB_BENCH_DB_MB', '50')) * 1024 * 1024)
+    rand = random.Random(int(os.environ.get('WEB_BENCH_SEED', '1')))
+    corpus = get_corpus(rand.random())
+    if output_filename is not None:
+        output_file = open(output_filename, 'wb')
+    else:
+        output_file = sys.stdout
+    output_file.write('DROP TABLE IF EXISTS `wp_posts`;\nCREATE TABLE `wp_posts` (`ID` bigint(20) unsigned NOT ' \
+        'NULL AUTO_INCREMENT, `post_title` text NOT NULL, `post_content` longtext NOT NULL, PRIMARY KEY (`ID`)) ' \
+        'ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;\n')
+    bytes_written = 0
+    row_id = 0
+    while bytes_written < num_bytes:
+        rows = []
+        for x in range(ROWS_PER_INSERT):
+            row_id += 1
+            offset = rand.randint(0, len(corpus) - 4096)
+            rows.append('(' + str(row_id) + ",'" + corpus[offset:offset + 40] + "','" +
+                corpus[offset + 40:offset + rand.randint(200, 4096)] + "')")
+        statement = 'INSERT INTO `wp_posts` VALUES ' + ','.join(rows) + ';\n'
+        output_file.write(statement)
+        bytes_written += len(statement)
+    if output_filename is not None:
+        output_file.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
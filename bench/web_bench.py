@@ -0,0 +1,586 @@
+#!/usr/bin/env python
+
+import os
+import sys
+import json
+import time
+import random
+import socket
+import shutil
+import argparse
+import datetime
+import resource
+import tempfile
+import threading
+import subprocess
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+import boto3
+
+sys.path.insert(0, os.path.abspath(os.path.dirname(os.path.abspath(__file__)) + '/..'))
+from util import s3
+from util import catalog
+from util import indexed_archive
+from util import compression
+from util import config
+
+
+# Phases run in this order, each in its own child process so peak RSS is measured per phase
+PHASE_NAMES = ['scan', 'dump', 'zip', 'upload', 'plan', 'download', 'extract']
+
+BENCH_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+
+ZIP_FILE_PASSWORD = 'web_bench'
+
+MEDIA_EXTENSIONS = ['jpg', 'png', 'mp4', 'pdf', 'zip']
+CODE_EXTENSIONS = ['php', 'php', 'php', 'js', 'css', 'html', 'txt', 'json']
+
+TEXT_WORDS = ['<?php', 'function', 'return', '$post', '$wpdb', 'array(', ');', 'if', '(', ')', '{', '}', 'echo',
+    'esc_html', 'get_option', 'apply_filters', 'add_action', 'wp_enqueue_script', '=>', 'null', 'true', 'false',
+    '//', 'the', 'content', 'widget', 'theme', 'plugin', '\n', '\n\t', 'class', 'public', 'static', '$this->']
+
+
+class g:
+    args = None
+    work_directory = None
+    site_directory = None
+    codec_spec = None
+    s3_endpoint_url = None
+    s3_process = None
+
+
+def main(argv):
+    global g
+
+    defaults = dict(((x[0], x[1]), x[3]) for x in config.SETTINGS)
+    parser = argparse.ArgumentParser(description='Benchmarks the phases of a web_backup.py backup and '
+        'web_restore.py restore against a synthetic WordPress-like site, a fake mysqldump/mysql and a local S3 '
+        'stand-in, and writes per-phase wall time, throughput, peak RSS and temp-disk high-water mark to a JSON file')
+    parser.add_argument('--work-directory', required=False, help='Directory for the synthetic site and all phase ' \
+        'output. Defaults to <temp>/web_bench. The site is only regenerated when its parameters change')
+    parser.add_argument('--output-filename', required=False, help='JSON results file. Defaults to ' \
+        './web_bench_<git commit>.json')
+    parser.add_argument('--compare-filename', required=False, help='If specified, an earlier results file whose ' \
+        'phase timings are printed side by side with this run')
+    parser.add_argument('--site-directory', required=False, help='A real website directory to benchmark against ' \
+        'instead of the synthetic site, e.g. to compare codecs on its mix of files. It is only read')
+    parser.add_argument('--site-files', type=int, default=2000, help='Number of files in the synthetic site')
+    parser.add_argument('--site-size-mb', type=float, default=200, help='Total size of the synthetic site')
+    parser.add_argument('--media-files-fraction', type=float, default=0.3, help='Fraction of the files that are ' \
+        'already-compressed media (jpg, png, mp4, pdf, zip) rather than code and text')
+    parser.add_argument('--media-bytes-fraction', type=float, default=0.8, help='Fraction of the site size that ' \
+        'is media')
+    parser.add_argument('--db-size-mb', type=float, default=50, help='Size of the fake mysqldump output')
+    parser.add_argument('--history', type=int, default=30, help='Archives per schedule folder seeded into the ' \
+        'bucket for the plan phase')
+    parser.add_argument('--other-sites', type=int, default=20, help='Other websites with the same history seeded ' \
+        'into the bucket for the plan phase')
+    parser.add_argument('--seed', type=int, default=1, help='Random seed for the synthetic site and database')
+    parser.add_argument('--runs', type=int, default=1, help='Times to run every phase. The run with the median ' \
+        'wall time of each phase is reported')
+    parser.add_argument('--compression-workers', type=int, default=defaults[('zip_file', 'compression_workers')],
+        help='Threads compressing and encrypting (and, for extract, decrypting) the archive. 0 for one per CPU core')
+    parser.add_argument('--codec', default=defaults[('zip_file', 'codec')], choices=sorted(compression.CODEC_IDS),
+        help='Codec the archive is compressed with')
+    parser.add_argument('--compression-level', type=int, default=defaults[('zip_file', 'compression_level')])
+    parser.add_argument('--codecs', nargs='*', default=[], help='Codecs to compare, each as <codec>[:<level>], ' \
+        'e.g. store deflate:6 zstd:3 zstd:9. Each is timed compressing the site into an archive and decompressing ' \
+        'it back, and reported with its compression ratio')
+    parser.add_argument('--store-extensions', nargs='*', default=list(defaults[('zip_file', 'store_extensions')]),
+        help='Extensions stored rather than deflated in the archive')
+    parser.add_argument('--store-sample-percent', type=int, default=defaults[('zip_file', 'store_sample_percent')],
+        help='Files whose first 64KB a quick trial compression cannot get under this percent are stored. 0 to ' \
+        'skip the trial')
+    parser.add_argument('--part-size-mb', type=int, default=defaults[('aws', 'multipart_part_size_mb')])
+    parser.add_argument('--upload-workers', type=int, default=defaults[('aws', 'upload_workers')])
+    parser.add_argument('--download-part-size-mb', type=int, default=defaults[('aws', 'download_part_size_mb')])
+    parser.add_argument('--download-workers', type=int, default=defaults[('aws', 'download_workers')])
+    parser.add_argument('--s3-endpoint-url', required=False, help='S3-compatible server to use, e.g. a local ' \
+        'MinIO at http://localhost:9000. If unspecified, a moto_server is started on a free localhost port')
+    parser.add_argument('--s3-bucket-name', default='web-bench', help='Bucket to benchmark against. Created if ' \
+        'missing')
+    parser.add_argument('--phases', nargs='*', default=PHASE_NAMES, choices=PHASE_NAMES, help='Subset of phases ' \
+        'to run. Later phases use the output of earlier ones')
+
+    g.args = parser.parse_args(argv)
+
+    if g.args.work_directory is None:
+        g.work_directory = os.path.join(tempfile.gettempdir(), 'web_bench')
+    else:
+        g.work_directory = os.path.abspath(g.args.work_directory)
+    if g.args.site_directory is None:
+        g.site_directory = os.path.join(g.work_directory, 'site')
+    else:
+        g.site_directory = os.path.abspath(g.args.site_directory)
+    for codec_spec in [g.args.codec] + g.args.codecs:
+        if not compression.is_available(codec_spec.split(':')[0]):
+            print 'Codec ' + codec_spec + ' needs the Python zstandard package (pip install zstandard)'
+            return 1
+    if g.args.output_filename is None:
+        g.args.output_filename = 'web_bench_' + get_git_commit()[:12] + '.json'
+
+    # The fake database tools read their parameters from the environment of the child processes
+    os.environ['WEB_BENCH_DB_MB'] = str(g.args.db_size_mb)
+    os.environ['WEB_BENCH_SEED'] = str(g.args.seed)
+    os.environ.setdefault('AWS_ACCESS_KEY_ID', 'web_bench')
+    os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'web_bench')
+
+    if g.args.site_directory is None:
+        site_stats = make_site()
+    else:
+        site_stats = phase_scan()
+        site_stats = {'files': site_stats['files'], 'bytes': site_stats['bytes_in']}
+    print 'Site: ' + str(site_stats['files']) + ' files, ' + format_mb(site_stats['bytes'])
+
+    start_s3()
+    try:
+        s3_client = get_s3_client()
+        try:
+            s3_client.create_bucket(Bucket=g.args.s3_bucket_name)
+        except s3_client.exceptions.BucketAlreadyOwnedByYou:
+            pass
+        runs = []
+        for run_number in range(g.args.runs):
+            runs.append(run_phases())
+    finally:
+        stop_s3()
+
+    results = {
+        'commit': get_git_commit(),
+        'started': datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+        'host': socket.gethostname(),
+        'cpus': multiprocessing.cpu_count(),
+        'python': sys.version.split()[0],
+        'parameters': dict((x, y) for x, y in vars(g.args).items() if x not in ['output_filename',
+            'compare_filename', 'work_directory']),
+        'site': site_stats,
+        'phases': get_median_phases(runs)
+    }
+    with open(g.args.output_filename, 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+    print_results(results)
+    print 'Results written to ' + g.args.output_filename
+    if g.args.compare_filename is not None:
+        with open(g.args.compare_filename) as f:
+            print_comparison(json.load(f), results)
+    return 0
+
+
+def run_phases():
+    backup_directory = os.path.join(g.work_directory, 'backup')
+    restore_directory = os.path.join(g.work_directory, 'restore')
+    for directory in [backup_directory, restore_directory]:
+        if os.path.isdir(directory):
+            shutil.rmtree(directory)
+        os.makedirs(directory)
+    phases = {}
+    for phase_name in PHASE_NAMES:
+        if phase_name not in g.args.phases:
+            continue
+        if phase_name == 'plan':
+            seed_bucket()
+        phases[phase_name] = run_phase(phase_name, globals()['phase_' + phase_name])
+        print_phase(phase_name, phases[phase_name])
+    for codec_spec in g.args.codecs:
+        # Read by phase_codec() in the child process
+        g.codec_spec = codec_spec
+        phase_name = 'codec:' + codec_spec
+        phases[phase_name] = run_phase(phase_name, phase_codec)
+        print_phase(phase_name, phases[phase_name])
+    return phases
+
+
+def run_phase(phase_name, phase_function):
+    """Runs phase_function in a child process and returns its stats along with wall time, throughput, the peak RSS
+    of the child (and of the tools it ran) and the most temp disk space in use over the baseline at any point."""
+    result_queue = multiprocessing.Queue()
+    disk_baseline = get_disk_used()
+    disk_high_water = [0]
+    done = threading.Event()
+
+    def sample_disk():
+        while not done.is_set():
+            disk_high_water[0] = max(disk_high_water[0], get_disk_used() - disk_baseline)
+            done.wait(0.05)
+
+    sampler = threading.Thread(target=sample_disk)
+    sampler.start()
+    started = time.time()
+    process = multiprocessing.Process(target=run_phase_child, args=(phase_function, result_queue))
+    process.start()
+    stats = result_queue.get()
+    process.join()
+    seconds = time.time() - started
+    done.set()
+    sampler.join()
+    if 'error' in stats:
+        raise Exception('Phase ' + phase_name + ' failed: ' + stats['error'])
+    stats['seconds'] = seconds
+    stats['mb_per_second'] = stats['bytes_in'] / 1048576.0 / max(seconds, 1e-6)
+    stats['temp_disk_high_water_bytes'] = disk_high_water[0]
+    return stats
+
+
+def run_phase_child(phase_function, result_queue):
+    try:
+        stats = phase_function()
+        # ru_maxrss is in KB on Linux. RUSAGE_CHILDREN is the largest of the tools (mysqldump, mysql) waited for
+        stats['peak_rss_kb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        stats['peak_child_rss_kb'] = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    except Exception as e:
+        stats = {'error': str(e)}
+    result_queue.put(stats)
+
+
+def get_disk_used():
+    # Whole-filesystem usage of the work directory, which is cheap enough to sample while a phase writes to it
+    stat = os.statvfs(g.work_directory)
+    return (stat.f_blocks - stat.f_bfree) * stat.f_frsize
+
+
+def phase_scan():
+    # The directory walk and stat() of every file that zipping the website directory starts with
+    num_files = 0
+    num_bytes = 0
+    for root, dirs, files in os.walk(g.site_directory):
+        for filename in files:
+            num_files += 1
+            num_bytes += os.lstat(os.path.join(root, filename)).st_size
+    return {'files': num_files, 'bytes_in': num_bytes, 'bytes_out': 0}
+
+
+def phase_dump():
+    # Same mysqldump command line as web_backup.py, with the fake mysqldump in place of /bin/mysqldump
+    output_filename = os.path.join(g.work_directory, 'backup', 'database.sql')
+    subprocess.check_call([sys.executable, os.path.join(BENCH_DIRECTORY, 'fake_mysqldump.py'), '-h', 'localhost',
+        '-u', 'web_bench', '-pweb_bench', 'web_bench', '--add-drop-table', '-r', output_filename])
+    size = os.path.getsize(output_filename)
+    return {'files': 1, 'bytes_in': size, 'bytes_out': size}
+
+
+def phase_zip():
+    # The encrypted archive of the website files (under files/) and the results, as web_backup.py writes it
+    backup_directory = os.path.join(g.work_directory, 'backup')
+    backup_filename = get_backup_filename()
+    if os.path.isfile(backup_filename):
+        os.remove(backup_filename)
+    with open(backup_filename, 'wb') as output_file:
+        writer = indexed_archive.ArchiveWriter(output_file, ZIP_FILE_PASSWORD, compression.Codec(g.args.codec,
+            g.args.compression_level), g.args.store_extensions, g.args.store_sample_percent,
+            get_compression_workers())
+        writer.add_directory('files/', os.stat(g.site_directory))
+        writer.add_tree(g.site_directory, 'files/', True)
+        writer.add_tree(backup_directory)
+        archive_stats = writer.close()
+    return {'files': archive_stats['files'], 'bytes_in': archive_stats['bytes_in'],
+        'bytes_out': archive_stats['bytes_out'], 'stored_bytes': archive_stats['stored_bytes'],
+        'compressed_bytes': archive_stats['compressed_bytes'],
+        'compression_ratio': float(archive_stats['bytes_out']) / max(archive_stats['bytes_in'], 1)}
+
+
+def phase_upload():
+    upload = s3.MultipartUpload(get_s3_client(), g.args.s3_bucket_name, get_bench_key(), g.args.part_size_mb *
+        1024 * 1024, g.args.upload_workers)
+    with open(get_backup_filename(), 'rb') as f:
+        try:
+            upload.upload_stream(f, os.path.getsize(get_backup_filename()))
+            upload.complete()
+        except:
+            upload.abort()
+            raise
+    return {'files': 1, 'bytes_in': upload.bytes_uploaded, 'bytes_out': upload.bytes_uploaded,
+        'parts': len(upload.parts)}
+
+
+def phase_plan():
+    # Syncs a fresh catalog against the bucket listing, then answers the backup planning and restore lookups from it
+    catalog_filename = os.path.join(g.work_directory, 'catalog.db')
+    if os.path.isfile(catalog_filename):
+        os.remove(catalog_filename)
+    folder_names = ['daily', 'weekly', 'monthly']
+    conn = catalog.open_catalog(catalog_filename)
+    num_added, num_removed = catalog.reconcile(conn, get_s3_client(), g.args.s3_bucket_name, 'web_bench',
+        folder_names)
+    backup_index = catalog.get_backup_index(conn, g.args.s3_bucket_name, 'web_bench', folder_names)
+    catalog.get_latest_backup(conn, g.args.s3_bucket_name, 'web_bench', 'daily')
+    conn.close()
+    return {'files': sum(len(x) for x in backup_index.values()), 'bytes_in': 0, 'bytes_out': 0,
+        'keys_listed': num_added}
+
+
+def phase_download():
+    download_filename = os.path.join(g.work_directory, 'restore', 'backup' + indexed_archive.EXTENSION)
+    size = s3.download_object(get_s3_client(), g.args.s3_bucket_name, get_bench_key(), download_filename,
+        g.args.download_part_size_mb * 1024 * 1024, g.args.download_workers)
+    return {'files': 1, 'bytes_in': size, 'bytes_out': size}
+
+
+def phase_extract():
+    # Decrypts the files/ entries of the downloaded archive into the website directory, and streams database.sql
+    # into the fake mysql client, the way web_restore.py does
+    backup_filename = os.path.join(g.work_directory, 'restore', 'backup' + indexed_archive.EXTENSION)
+    website_directory = os.path.join(g.work_directory, 'restore', 'site')
+    reader = indexed_archive.ArchiveReader(indexed_archive.FileSource(backup_filename), ZIP_FILE_PASSWORD,
+        get_compression_workers())
+    reader.open()
+    num_files, num_bytes = reader.extract(reader.get_entries(['files']), website_directory, 'files/')
+    mysql_process = subprocess.Popen([sys.executable, os.path.join(BENCH_DIRECTORY, 'fake_mysql.py')],
+        stdin=subprocess.PIPE, stderr=subprocess.PIPE)
+    entry_file = reader.open_entry('database.sql')
+    for data in iter(lambda: entry_file.read(1024 * 1024), ''):
+        mysql_process.stdin.write(data)
+    database_bytes = int(mysql_process.communicate()[1])
+    reader.close()
+    if mysql_process.returncode != 0:
+        raise Exception('Loading database.sql failed')
+    return {'files': num_files, 'bytes_in': os.path.getsize(backup_filename),
+        'bytes_out': num_bytes + database_bytes}
+
+
+def phase_codec():
+    # Archives the site with one codec and reads every block back, for comparing codecs by compression ratio against
+    # compress and decompress throughput. Nothing is written out on the way back, so disk speed doesn't count
+    codec_parms = g.codec_spec.split(':')
+    level = g.args.compression_level
+    if len(codec_parms) > 1:
+        level = int(codec_parms[1])
+    codec = compression.Codec(codec_parms[0], level)
+    archive_filename = os.path.join(g.work_directory, 'codec' + indexed_archive.EXTENSION)
+    # The key is derived once per run, before the timing starts
+    indexed_archive.derive_key(ZIP_FILE_PASSWORD, indexed_archive.get_write_salt(ZIP_FILE_PASSWORD),
+        indexed_archive.PBKDF2_ITERATIONS)
+    started = time.time()
+    with open(archive_filename, 'wb') as output_file:
+        writer = indexed_archive.ArchiveWriter(output_file, ZIP_FILE_PASSWORD, codec, g.args.store_extensions,
+            g.args.store_sample_percent, get_compression_workers())
+        writer.add_tree(g.site_directory, 'files/', True)
+        archive_stats = writer.close()
+    compress_seconds = time.time() - started
+    started = time.time()
+    reader = indexed_archive.ArchiveReader(indexed_archive.FileSource(archive_filename), ZIP_FILE_PASSWORD,
+        get_compression_workers())
+    num_bytes = 0
+    for group in reader.iter_ranges(reader.open()):
+        start = group[0]['offset']
+        for record_type, body in reader.iter_records(start, group[-1]['offset'] + group[-1]['length'] - start):
+            if record_type == indexed_archive.BLOCK_RECORD:
+                num_bytes += len(body)
+    decompress_seconds = time.time() - started
+    reader.close()
+    os.remove(archive_filename)
+    if num_bytes != archive_stats['bytes_in']:
+        raise Exception('Read back ' + str(num_bytes) + ' bytes of ' + str(archive_stats['bytes_in']))
+    return {'files': archive_stats['files'], 'bytes_in': archive_stats['bytes_in'],
+        'bytes_out': archive_stats['bytes_out'], 'stored_bytes': archive_stats['stored_bytes'],
+        'compressed_bytes': archive_stats['compressed_bytes'],
+        'compression_ratio': float(archive_stats['bytes_out']) / max(archive_stats['bytes_in'], 1),
+        'compress_mb_per_second': archive_stats['bytes_in'] / 1048576.0 / max(compress_seconds, 1e-6),
+        'decompress_mb_per_second': num_bytes / 1048576.0 / max(decompress_seconds, 1e-6)}
+
+
+def seed_bucket():
+    # A bucket with backup history for this and other websites, so the plan phase lists and catalogs a realistic
+    # number of keys. Only done once per bucket
+    s3_client = get_s3_client()
+    marker_key = 'web_bench_seeded_' + str(g.args.history) + '_' + str(g.args.other_sites)
+    if len(list(s3.iter_objects(s3_client, g.args.s3_bucket_name, marker_key))) > 0:
+        return
+    print 'Seeding bucket with backup history'
+    website_names = ['web_bench'] + ['web_bench_' + str(x) for x in range(g.args.other_sites)]
+    keys = []
+    for website_name in website_names:
+        for folder_name in ['daily', 'weekly', 'monthly']:
+            for i in range(g.args.history):
+                stamp = datetime.datetime(2020, 1, 1) + datetime.timedelta(days=i)
+                keys.append(website_name + '/' + folder_name + '/' + stamp.strftime('%Y%m%d%H%M%S') + '.zip')
+    pool = ThreadPool(16)
+    try:
+        pool.map(lambda x: s3_client.put_object(Bucket=g.args.s3_bucket_name, Key=x, Body=''), keys)
+    finally:
+        pool.close()
+        pool.join()
+    s3_client.put_object(Bucket=g.args.s3_bucket_name, Key=marker_key, Body='')
+
+
+def make_site():
+    """Generates the synthetic WordPress-like document root: code and text files (compressible) under wp-admin,
+    wp-includes, plugins and themes, and media files (random bytes, so incompressible) under wp-content/uploads.
+    File sizes are log-normally distributed. The site is reused while its parameters are unchanged."""
+    parameters = {'site_files': g.args.site_files, 'site_size_mb': g.args.site_size_mb,
+        'media_files_fraction': g.args.media_files_fraction, 'media_bytes_fraction': g.args.media_bytes_fraction,
+        'seed': g.args.seed}
+    parameters_filename = os.path.join(g.work_directory, 'site.json')
+    if os.path.isfile(parameters_filename):
+        with open(parameters_filename) as f:
+            saved = json.load(f)
+        if saved['parameters'] == parameters and os.path.isdir(g.site_directory):
+            return saved['stats']
+    if os.path.isdir(g.site_directory):
+        shutil.rmtree(g.site_directory)
+    os.makedirs(g.site_directory)
+    print 'Generating synthetic site in ' + g.site_directory
+
+    rand = random.Random(g.args.seed)
+    corpus = ' '.join(rand.choice(TEXT_WORDS) for x in range(300000))
+    num_media = int(round(g.args.site_files * g.args.media_files_fraction))
+    num_code = max(g.args.site_files - num_media - 1, 0)
+    total_bytes = int(g.args.site_size_mb * 1024 * 1024)
+    media_sizes = get_sizes(rand, num_media, int(total_bytes * g.args.media_bytes_fraction), 1.5)
+    code_sizes = get_sizes(rand, num_code, total_bytes - sum(media_sizes), 1.0)
+
+    with open(os.path.join(g.site_directory, 'wp-config.php'), 'w') as f:
+        f.write("<?php\ndefine('DB_NAME', 'web_bench');\ndefine('DB_USER', 'web_bench');\n" \
+            "define('DB_PASSWORD', 'web_bench');\ndefine('DB_HOST', 'localhost');\n")
+    code_directories = ['wp-admin', 'wp-admin/includes', 'wp-includes', 'wp-includes/js', 'wp-includes/css'] + \
+        ['wp-content/plugins/plugin-' + str(x) for x in range(20)] + \
+        ['wp-content/themes/theme-' + str(x) for x in range(3)]
+    for i, size in enumerate(code_sizes):
+        offset = rand.randint(0, len(corpus) - 1)
+        data = (corpus[offset:] + corpus * (size // len(corpus) + 1))[:size]
+        write_site_file(rand.choice(code_directories), 'file-' + str(i) + '.' + rand.choice(CODE_EXTENSIONS), data)
+    for i, size in enumerate(media_sizes):
+        directory = 'wp-content/uploads/' + str(rand.randint(2015, 2020)) + '/' + str(rand.randint(1, 12)).zfill(2)
+        write_site_file(directory, 'media-' + str(i) + '.' + rand.choice(MEDIA_EXTENSIONS), os.urandom(size))
+
+    stats = {'files': num_code + num_media + 1, 'bytes': sum(code_sizes) + sum(media_sizes),
+        'media_files': num_media, 'media_bytes': sum(media_sizes)}
+    with open(parameters_filename, 'w') as f:
+        json.dump({'parameters': parameters, 'stats': stats}, f)
+    return stats
+
+
+def get_sizes(rand, num_files, total_bytes, sigma):
+    # Log-normal weights scaled to add up to total_bytes
+    if num_files == 0:
+        return []
+    weights = [rand.lognormvariate(0, sigma) for x in range(num_files)]
+    scale = total_bytes / sum(weights)
+    return [max(int(x * scale), 1) for x in weights]
+
+
+def write_site_file(directory, filename, data):
+    directory = os.path.join(g.site_directory, directory)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    with open(os.path.join(directory, filename), 'wb') as f:
+        f.write(data)
+
+
+def start_s3():
+    global g
+
+    if g.args.s3_endpoint_url is not None:
+        g.s3_endpoint_url = g.args.s3_endpoint_url
+        return
+    listen_socket = socket.socket()
+    listen_socket.bind(('127.0.0.1', 0))
+    port = listen_socket.getsockname()[1]
+    listen_socket.close()
+    g.s3_endpoint_url = 'http://127.0.0.1:' + str(port)
+    moto_server = os.path.join(os.path.dirname(sys.executable), 'moto_server')
+    if not os.path.isfile(moto_server):
+        moto_server = 'moto_server'
+    with open(os.devnull, 'w') as FNULL:
+        g.s3_process = subprocess.Popen([moto_server, 's3', '-H', '127.0.0.1', '-p', str(port)], stdout=FNULL,
+            stderr=FNULL)
+    for attempt in range(100):
+        try:
+            socket.create_connection(('127.0.0.1', port), 1).close()
+            return
+        except socket.error:
+            if g.s3_process.poll() is not None:
+                break
+            time.sleep(0.1)
+    raise Exception('Could not start moto_server. Install moto[server] or pass --s3-endpoint-url')
+
+
+def stop_s3():
+    if g.s3_process is not None:
+        g.s3_process.terminate()
+        g.s3_process.wait()
+
+
+def get_s3_client():
+    return boto3.client('s3', endpoint_url=g.s3_endpoint_url, region_name='us-east-1')
+
+
+def get_bench_key():
+    return 'web_bench/bench/backup' + indexed_archive.EXTENSION
+
+
+def get_backup_filename():
+    return os.path.join(g.work_directory, 'backup' + indexed_archive.EXTENSION)
+
+
+def get_compression_workers():
+    if g.args.compression_workers == 0:
+        return multiprocessing.cpu_count()
+    return g.args.compression_workers
+
+
+def get_git_commit():
+    try:
+        with open(os.devnull, 'w') as FNULL:
+            commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=BENCH_DIRECTORY, stderr=FNULL).strip()
+            dirty = subprocess.check_output(['git', 'status', '--porcelain', '--untracked-files=no'],
+                cwd=BENCH_DIRECTORY, stderr=FNULL).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+    if dirty:
+        return commit + '-dirty'
+    return commit
+
+
+def get_phase_names(phases):
+    # The phases in run order, then the codec comparisons by codec and level
+    codec_phase_names = [x for x in phases if x.startswith('codec:')]
+    return [x for x in PHASE_NAMES if x in phases] + sorted(codec_phase_names, key=lambda x: (x.split(':')[1],
+        int(x.split(':')[2]) if len(x.split(':')) > 2 else -1))
+
+
+def get_median_phases(runs):
+    phases = {}
+    for phase_name in get_phase_names(runs[0]):
+        phase_runs = sorted([x[phase_name] for x in runs if phase_name in x], key=lambda x: x['seconds'])
+        if len(phase_runs) == 0:
+            continue
+        phases[phase_name] = dict(phase_runs[(len(phase_runs) - 1) // 2])
+        phases[phase_name]['all_seconds'] = [x['seconds'] for x in phase_runs]
+    return phases
+
+
+def format_mb(num_bytes):
+    return '%.1fMB' % (num_bytes / 1048576.0)
+
+
+def print_phase(phase_name, stats):
+    line = '%-14s %8.2fs %9.1fMB/s  rss %7dKB (tools %7dKB)  disk %s' % (phase_name, stats['seconds'],
+        stats['mb_per_second'], stats['peak_rss_kb'], stats['peak_child_rss_kb'],
+        format_mb(stats['temp_disk_high_water_bytes']))
+    if 'decompress_mb_per_second' in stats:
+        line += '  ratio %.3f  compress %.1fMB/s  decompress %.1fMB/s' % (stats['compression_ratio'],
+            stats['compress_mb_per_second'], stats['decompress_mb_per_second'])
+    print line
+
+
+def print_results(results):
+    print
+    print 'Commit ' + results['commit']
+    for phase_name in get_phase_names(results['phases']):
+        print_phase(phase_name, results['phases'][phase_name])
+
+
+def print_comparison(old_results, new_results):
+    print
+    print '%-14s %13s %13s   change' % ('Phase', old_results['commit'][:12], new_results['commit'][:12])
+    for phase_name in get_phase_names(new_results['phases']):
+        if phase_name not in old_results['phases']:
+            continue
+        old_seconds = old_results['phases'][phase_name]['seconds']
+        new_seconds = new_results['phases'][phase_name]['seconds']
+        change = (new_seconds - old_seconds) / max(old_seconds, 1e-6) * 100
+        print '%-14s %12.2fs %12.2fs %+8.1f%%' % (phase_name, old_seconds, new_seconds, change)
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,204 @@
+#!/usr/bin/env python
+
+import os
+import stat
+import struct
+import zlib
+import time
+import logging
+
+
+LOCAL_FILE_HEADER_SIGNATURE = 0x04034b50
+DATA_DESCRIPTOR_SIGNATURE = 0x08074b50
+
+# Local file header fields after the signature: version, flags, method, time, date, crc, sizes, name/extra lengths
+LOCAL_FILE_HEADER = struct.Struct('<HHHHHIIIHH')
+
+STORED = 0
+DEFLATED = 8
+
+COPY_BUFFER_SIZE = 1024 * 1024
+
+
+class StreamReader:
+    """Forward-only reader over a pipe, with a push-back buffer for bytes read past the end of a compressed entry."""
+
+    def __init__(self, input_stream):
+        self.input_stream = input_stream
+        self.pending = ''
+
+    def read(self, size):
+        if self.pending:
+            data = self.pending[:size]
+            self.pending = self.pending[size:]
+            return data
+        return self.input_stream.read(size)
+
+    def read_exact(self, size):
+        chunks = []
+        remaining = size
+        while remaining > 0:
+            chunk = self.read(remaining)
+            if not chunk:
+                raise IOError('Unexpected end of zip stream')
+            chunks.append(chunk)
+            remaining -= len(chunk)
+        return ''.join(chunks)
+
+    def unread(self, data):
+        self.pending = data + self.pending
+
+
+def get_safe_path(target_directory, name):
+    path = os.path.normpath(os.path.join(target_directory, name))
+    if not path.startswith(os.path.normpath(target_directory) + os.sep):
+        raise IOError('Refusing to extract entry outside of target directory: ' + name)
+    return path
+
+
+def dos_datetime_to_timestamp(dos_date, dos_time):
+    return time.mktime(((dos_date >> 9) + 1980, (dos_date >> 5) & 0xF, dos_date & 0x1F, dos_time >> 11,
+        (dos_time >> 5) & 0x3F, (dos_time & 0x1F) * 2, 0, 0, -1))
+
+
+def get_zip64_sizes(extra, compressed_size, uncompressed_size):
+    # The zip64 extra field holds whichever of the two sizes overflowed 32 bits, uncompressed first
+    offset = 0
+    while offset + 4 <= len(extra):
+        header_id, data_size = struct.unpack('<HH', extra[offset:offset + 4])
+        if header_id == 0x0001:
+            data = extra[offset + 4:offset + 4 + data_size]
+            if uncompressed_size == 0xFFFFFFFF:
+                uncompressed_size = struct.unpack('<Q', data[:8])[0]
+                data = data[8:]
+            if compressed_size == 0xFFFFFFFF:
+                compressed_size = struct.unpack('<Q', data[:8])[0]
+            return compressed_size, uncompressed_size, True
+        offset += 4 + data_size
+    return compressed_size, uncompressed_size, False
+
+
+def extract_zip_stream(input_stream, target_directory):
+    """Extracts a (non-encrypted) zip archive read front to back from input_stream, e.g. a pipe, into
+    target_directory, without ever needing the archive on disk. Entries are found from their local file headers;
+    the central directory at the end is not needed. Returns (number of files, total bytes extracted)."""
+    reader = StreamReader(input_stream)
+    num_files = 0
+    num_bytes = 0
+    while True:
+        signature = reader.read_exact(4)
+        if struct.unpack('<I', signature)[0] != LOCAL_FILE_HEADER_SIGNATURE:
+            # Central directory reached, so every entry has been seen. Drain the rest so a writer on the other end
+            # of a pipe is not left blocked
+            while reader.read(COPY_BUFFER_SIZE):
+                pass
+            break
+        (version, flags, method, dos_time, dos_date, crc, compressed_size, uncompressed_size, name_length,
+            extra_length) = LOCAL_FILE_HEADER.unpack(reader.read_exact(LOCAL_FILE_HEADER.size))
+        name = reader.read_exact(name_length)
+        extra = reader.read_exact(extra_length)
+        compressed_size, uncompressed_size, is_zip64 = get_zip64_sizes(extra, compressed_size, uncompressed_size)
+        if flags & 0x1:
+            raise IOError('Encrypted entries are not supported when streaming: ' + name)
+        if method not in [STORED, DEFLATED]:
+            raise IOError('Unsupported compression method ' + str(method) + ' for ' + name)
+        has_data_descriptor = flags & 0x8
+        if has_data_descriptor and method == STORED:
+            raise IOError('Cannot stream a stored entry without its size: ' + name)
+        path = get_safe_path(target_directory, name)
+        if name.endswith('/'):
+            if not os.path.isdir(path):
+                os.makedirs(path)
+            continue
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        running_crc = 0
+        with open(path, 'wb') as output_file:
+            if method == STORED:
+                remaining = compressed_size
+                while remaining > 0:
+                    data = reader.read_exact(min(remaining, COPY_BUFFER_SIZE))
+                    remaining -= len(data)
+                    running_crc = zlib.crc32(data, running_crc)
+                    output_file.write(data)
+            else:
+                # Raw deflate knows where its own stream ends, which is what allows entries with a trailing data
+                # descriptor (no sizes up front) to be read. Bytes past the end go back to the reader
+                decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+                remaining = compressed_size
+                while has_data_descriptor or remaining > 0:
+                    if has_data_descriptor:
+                        chunk = reader.read(COPY_BUFFER_SIZE)
+                    else:
+                        chunk = reader.read(min(remaining, COPY_BUFFER_SIZE))
+                        remaining -= len(chunk)
+                    if not chunk:
+                        raise IOError('Unexpected end of zip stream in ' + name)
+                    data = decompressor.decompress(chunk)
+                    running_crc = zlib.crc32(data, running_crc)
+                    output_file.write(data)
+                    if decompressor.unused_data:
+                        reader.unread(decompressor.unused_data)
+                        break
+                data = decompressor.flush()
+                running_crc = zlib.crc32(data, running_crc)
+                output_file.write(data)
+        if has_data_descriptor:
+            descriptor = reader.read_exact(4)
+            if struct.unpack('<I', descriptor)[0] == DATA_DESCRIPTOR_SIGNATURE:
+                descriptor = reader.read_exact(4)
+            crc = struct.unpack('<I', descriptor)[0]
+            reader.read_exact(16 if is_zip64 else 8)
+        if running_crc & 0xFFFFFFFF != crc:
+            raise IOError('CRC mismatch extracting ' + name)
+        mtime = dos_datetime_to_timestamp(dos_date, dos_time)
+        os.utime(path, (mtime, mtime))
+        num_files += 1
+        num_bytes += os.path.getsize(path)
+    return num_files, num_bytes
+
+
+# How much of the start of a file is trial-compressed to judge whether deflating it is worthwhile
+COMPRESSIBILITY_SAMPLE_SIZE = 64 * 1024
+
+
+def iter_tree(source_directory):
+    """Yields (archive name, path, stat) for everything under source_directory in the order ArchiveWriter.add_tree()
+    writes it: names sorted within each directory, and each directory (named with a trailing /) ahead of its
+    contents, so extracting front to back creates it before its files. Symlinks are followed, except back into an
+    ancestor directory. Entries that can't be read are skipped with a warning."""
+
+    def walk(directory, prefix, ancestors):
+        try:
+            names = sorted(os.listdir(directory))
+        except OSError as e:
+            logging.warning('Skipping unreadable directory ' + directory + ': ' + str(e))
+            return
+        for name in names:
+            path = os.path.join(directory, name)
+            try:
+                file_stat = os.stat(path)
+            except OSError as e:
+                logging.warning('Skipping ' + path + ': ' + str(e))
+                continue
+            if stat.S_ISDIR(file_stat.st_mode):
+                if (file_stat.st_dev, file_stat.st_ino) in ancestors:
+                    logging.warning('Skipping symlinked directory loop at ' + path)
+                    continue
+                yield prefix + name + '/', path, file_stat
+                for item in walk(path, prefix + name + '/', ancestors | set([(file_stat.st_dev,
+                        file_stat.st_ino)])):
+                    yield item
+            elif stat.S_ISREG(file_stat.st_mode):
+                yield prefix + name, path, file_stat
+
+    root_stat = os.stat(source_directory)
+    return walk(source_directory, '', set([(root_stat.st_dev, root_stat.st_ino)]))
+
+
+def is_incompressible(data, store_sample_percent):
+    # A fast, level 1 deflate of the sample estimates its entropy. Already-compressed data (JPEG, video, zip, ...)
+    # barely shrinks at any level, so if level 1 can't get it under store_sample_percent it is stored as is
+    sample = data[:COMPRESSIBILITY_SAMPLE_SIZE]
+    # (zlib.compress() adds a 2 byte header and 4 byte checksum that a zip entry doesn't have)
+    return (len(zlib.compress(sample, 1)) - 6) * 100 > len(sample) * store_sample_percent
@@ -0,0 +1,173 @@
+#!/usr/bin/env python
+
+import os
+import re
+import json
+import datetime
+import subprocess
+
+
+# Binlog backups hold BINLOG_DIRECTORY/MANIFEST_FILENAME and the captured binlog files next to it
+BINLOG_DIRECTORY = 'binlog'
+MANIFEST_FILENAME = 'manifest.json'
+
+DATETIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+# Manifest format of binlog backups captured as SQL for just the website's database (each file <binlog file>.sql).
+# Manifests without it are from backups holding raw copies of the server's binlog files
+SQL_FORMAT = 'sql'
+SQL_EXTENSION = '.sql'
+
+# Header mysqlbinlog writes ahead of each event, e.g. '#261017  9:05:03 server id 1  end_log_pos 126 ...'
+EVENT_HEADER_PATTERN = re.compile('#([0-9]{6}) +([0-9]{1,2}:[0-9]{2}:[0-9]{2}) +server id ')
+
+# Ends SQL cut off before --stop-datetime, in the middle of mysqlbinlog output (where the delimiter is /*!*/;)
+STOP_SQL = 'ROLLBACK /*!*/;\nDELIMITER ;\n'
+
+
+class BinlogError(Exception):
+    pass
+
+
+def get_connection_args(user, password, socket_filename=None):
+    # Options understood by both the mysql client and mysqlbinlog
+    connection_args = ['--user=' + user, '--password=' + password]
+    if socket_filename is not None and os.path.exists(socket_filename):
+        connection_args.append('--socket=' + socket_filename)
+    return connection_args
+
+
+def query(connection_args, sql):
+    output = subprocess.check_output(['/bin/mysql'] + connection_args + ['-N', '-B', '-e', sql])
+    return [x.split('\t') for x in output.split('\n') if x != '']
+
+
+def get_master_status(connection_args):
+    """Returns (binlog file, position) the server is writing at."""
+    try:
+        rows = query(connection_args, 'SHOW MASTER STATUS')
+    except subprocess.CalledProcessError:
+        # MySQL 8.4 renamed it
+        rows = query(connection_args, 'SHOW BINARY LOG STATUS')
+    if len(rows) == 0:
+        raise BinlogError('Binary logging is not enabled on the MySQL server (set log_bin in my.cnf)')
+    return rows[0][0], int(rows[0][1])
+
+
+def get_binary_logs(connection_args):
+    return [x[0] for x in query(connection_args, 'SHOW BINARY LOGS')]
+
+
+def get_dump_position_option():
+    # MySQL 8.0.26 renamed --master-data to --source-data (and 8.4 dropped the old name)
+    help_text = subprocess.check_output(['/bin/mysqldump', '--help'])
+    if '--source-data' in help_text:
+        return '--source-data=2'
+    return '--master-data=2'
+
+
+def read_dump_position(dump_filename):
+    """The binlog position written as a comment near the top of a mysqldump --master-data=2 dump."""
+    with open(dump_filename) as f:
+        for i in range(100):
+            line = f.readline()
+            match = re.search("(?:MASTER|SOURCE)_LOG_FILE='([^']+)', *(?:MASTER|SOURCE)_LOG_POS=([0-9]+)", line)
+            if match is not None:
+                return match.group(1), int(match.group(2))
+    raise BinlogError('No binlog position in ' + dump_filename + ' (was it dumped with --master-data=2?)')
+
+
+def capture(connection_args, start_file, start_position, database, output_directory):
+    """Closes the binlog file the server is writing to, then turns every binlog file from start_file (at
+    start_position) up to it into SQL for just database's changes, one <binlog file>.sql in output_directory each.
+    Other databases on the server never leave it. Returns the names of the files written. Needs the RELOAD and
+    REPLICATION SLAVE privileges."""
+    query(connection_args, 'FLUSH BINARY LOGS')
+    current_file = get_master_status(connection_args)[0]
+    binary_logs = get_binary_logs(connection_args)
+    if start_file not in binary_logs:
+        raise BinlogError('Binlog file ' + start_file + ' has been purged from the server')
+    names = binary_logs[binary_logs.index(start_file):binary_logs.index(current_file)]
+    if not os.path.isdir(output_directory):
+        os.makedirs(output_directory)
+    filenames = []
+    for name in names:
+        exec_list = ['/bin/mysqlbinlog'] + connection_args + ['--read-from-remote-server', '--database=' + database]
+        if name == start_file:
+            exec_list.append('--start-position=' + str(start_position))
+        subprocess.check_call(exec_list + get_gtid_options() + ['--result-file=' + os.path.join(output_directory,
+            name + SQL_EXTENSION), name])
+        filenames.append(name + SQL_EXTENSION)
+    return filenames
+
+
+def get_gtid_options():
+    # The events already ran on the source server, so with GTIDs on (MySQL only) they must not carry them along
+    if 'MariaDB' not in subprocess.check_output(['/bin/mysqlbinlog', '--version']):
+        return ['--skip-gtids']
+    return []
+
+
+def write_manifest(output_directory, binlog_manifest):
+    with open(os.path.join(output_directory, MANIFEST_FILENAME), 'w') as f:
+        json.dump(binlog_manifest, f, indent=2)
+
+
+def get_replay_list(filenames, start_position, source_database, target_database, stop_datetime=None):
+    """mysqlbinlog command line that turns filenames (starting at start_position in the first) into SQL for just
+    source_database's changes, renamed to target_database, and stopping before stop_datetime if given."""
+    exec_list = ['/bin/mysqlbinlog', '--start-position=' + str(start_position)]
+    if source_database != target_database:
+        # The rename happens first, so the filter is on the new name
+        exec_list.append('--rewrite-db=' + source_database + '->' + target_database)
+    exec_list.append('--database=' + target_database)
+    if stop_datetime is not None:
+        exec_list.append('--stop-datetime=' + stop_datetime)
+    return exec_list + get_gtid_options() + filenames
+
+
+def replay(connection_args, filenames, start_position, source_database, target_database, stop_datetime=None):
+    """Pipes the binlog events of source_database from filenames into target_database."""
+    mysqlbinlog_process = subprocess.Popen(get_replay_list(filenames, start_position, source_database,
+        target_database, stop_datetime), stdout=subprocess.PIPE)
+    mysql_process = subprocess.Popen(['/bin/mysql'] + connection_args, stdin=mysqlbinlog_process.stdout)
+    mysqlbinlog_process.stdout.close()
+    mysql_exit_status = mysql_process.wait()
+    mysqlbinlog_exit_status = mysqlbinlog_process.wait()
+    if mysqlbinlog_exit_status != 0:
+        raise BinlogError('mysqlbinlog exited with status ' + str(mysqlbinlog_exit_status))
+    if mysql_exit_status != 0:
+        raise BinlogError('mysql exited with status ' + str(mysql_exit_status) + ' replaying binlog')
+
+
+def read_sql(filenames, stop_datetime=None):
+    """Yields the lines of SQL files written by capture(), up to the first event at or after stop_datetime if
+    given (as mysqlbinlog --stop-datetime does with binlog files)."""
+    stop = None
+    if stop_datetime is not None:
+        stop = datetime.datetime.strptime(stop_datetime, DATETIME_FORMAT)
+    for filename in filenames:
+        with open(filename) as f:
+            for line in f:
+                match = EVENT_HEADER_PATTERN.match(line)
+                if stop is not None and match is not None and datetime.datetime.strptime(match.group(1) + ' ' +
+                        match.group(2), '%y%m%d %H:%M:%S') >= stop:
+                    yield STOP_SQL
+                    return
+                yield line
+
+
+def replay_sql(connection_args, filenames, stop_datetime=None):
+    """Pipes SQL files written by capture() into the database they were captured from."""
+    mysql_process = subprocess.Popen(['/bin/mysql'] + connection_args, stdin=subprocess.PIPE)
+    try:
+        for line in read_sql(filenames, stop_datetime):
+            mysql_process.stdin.write(line)
+    except IOError:
+        # mysql quit early. Its exit status below says why
+        pass
+    finally:
+        mysql_process.stdin.close()
+    mysql_exit_status = mysql_process.wait()
+    if mysql_exit_status != 0:
+        raise BinlogError('mysql exited with status ' + str(mysql_exit_status) + ' replaying binlog')
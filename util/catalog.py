@@ -0,0 +1,258 @@
+#!/usr/bin/env python
+
+import os
+import sqlite3
+import datetime
+import pytz
+import s3
+
+
+# Stored next to web_backup.ini
+CATALOG_FILENAME = 'web_backup_catalog.db'
+
+DATETIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS backups (
+    bucket TEXT NOT NULL,
+    key TEXT NOT NULL,
+    website_name TEXT NOT NULL,
+    folder_name TEXT NOT NULL,
+    datetime_stamp TEXT NOT NULL,
+    last_modified TEXT NOT NULL,
+    size INTEGER,
+    checksum TEXT,
+    PRIMARY KEY (bucket, key)
+);
+CREATE INDEX IF NOT EXISTS backups_by_folder ON backups (bucket, website_name, folder_name, last_modified);
+CREATE TABLE IF NOT EXISTS events (
+    event_datetime TEXT NOT NULL,
+    action TEXT NOT NULL,
+    bucket TEXT NOT NULL,
+    key TEXT NOT NULL,
+    source_key TEXT,
+    size INTEGER,
+    checksum TEXT
+);
+CREATE TABLE IF NOT EXISTS reconciles (
+    bucket TEXT NOT NULL,
+    website_name TEXT NOT NULL,
+    folder_name TEXT NOT NULL,
+    reconcile_datetime TEXT NOT NULL,
+    PRIMARY KEY (bucket, website_name, folder_name)
+);
+CREATE TABLE IF NOT EXISTS fingerprints (
+    bucket TEXT NOT NULL,
+    website_name TEXT NOT NULL,
+    fingerprint TEXT NOT NULL,
+    key TEXT NOT NULL,
+    recorded_datetime TEXT NOT NULL,
+    PRIMARY KEY (bucket, website_name)
+);
+CREATE TABLE IF NOT EXISTS binlog_bases (
+    bucket TEXT NOT NULL,
+    website_name TEXT NOT NULL,
+    key TEXT NOT NULL,
+    binlog_file TEXT NOT NULL,
+    binlog_position INTEGER NOT NULL,
+    recorded_datetime TEXT NOT NULL,
+    PRIMARY KEY (bucket, website_name)
+);
+CREATE TABLE IF NOT EXISTS binlog_dependencies (
+    bucket TEXT NOT NULL,
+    key TEXT NOT NULL,
+    base_key TEXT NOT NULL,
+    PRIMARY KEY (bucket, key)
+);
+"""
+
+
+def get_catalog_filename():
+    return os.path.abspath(os.path.dirname(os.path.abspath(__file__)) + '/../' + CATALOG_FILENAME)
+
+
+def open_catalog(catalog_filename=None):
+    if catalog_filename is None:
+        catalog_filename = get_catalog_filename()
+    # Several backup runs can share the catalog, so wait on a locked database rather than failing right away
+    conn = sqlite3.connect(catalog_filename, timeout=60)
+    conn.executescript(SCHEMA)
+    return conn
+
+
+def utc_now():
+    return datetime.datetime.now(pytz.UTC)
+
+
+def format_datetime(dt):
+    return dt.astimezone(pytz.UTC).strftime(DATETIME_FORMAT)
+
+
+def parse_datetime(s):
+    return pytz.UTC.localize(datetime.datetime.strptime(s, DATETIME_FORMAT))
+
+
+def split_key(key):
+    # <website_name>/<folder_name>/<YYYYMMDDHHMMSS>.zip (or .wba or .snapshot)
+    path_sects = key.split('/')
+    return path_sects[0], path_sects[1], path_sects[2][:14]
+
+
+def record_upload(conn, bucket_name, key, size, checksum, source_key=None, last_modified=None):
+    """Records an uploaded (or, when source_key is given, server-side copied) backup archive."""
+    if last_modified is None:
+        last_modified = utc_now()
+    website_name, folder_name, datetime_stamp = split_key(key)
+    if checksum is None and source_key is not None:
+        row = conn.execute('SELECT checksum FROM backups WHERE bucket = ? AND key = ?', (bucket_name,
+            source_key)).fetchone()
+        if row is not None:
+            checksum = row[0]
+    with conn:
+        conn.execute('INSERT OR REPLACE INTO backups (bucket, key, website_name, folder_name, datetime_stamp, '
+            'last_modified, size, checksum) VALUES (?, ?, ?, ?, ?, ?, ?, ?)', (bucket_name, key, website_name,
+            folder_name, datetime_stamp, format_datetime(last_modified), size, checksum))
+        conn.execute('INSERT INTO events (event_datetime, action, bucket, key, source_key, size, checksum) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?)', (format_datetime(utc_now()), 'upload' if source_key is None else 'copy',
+            bucket_name, key, source_key, size, checksum))
+
+
+def record_deletion(conn, bucket_name, key):
+    with conn:
+        conn.execute('DELETE FROM backups WHERE bucket = ? AND key = ?', (bucket_name, key))
+        conn.execute('INSERT INTO events (event_datetime, action, bucket, key) VALUES (?, ?, ?, ?)',
+            (format_datetime(utc_now()), 'delete', bucket_name, key))
+
+
+def get_unreconciled_folders(conn, bucket_name, website_name, folder_names):
+    # Folders the catalog has never been synced against S3 for, and so knows nothing about yet
+    reconciled = set(x[0] for x in conn.execute('SELECT folder_name FROM reconciles WHERE bucket = ? AND '
+        'website_name = ?', (bucket_name, website_name)))
+    return [x for x in folder_names if x not in reconciled]
+
+
+def reconcile(conn, s3_client, bucket_name, website_name, folder_names):
+    """Replaces the catalog's view of a website's schedule folders with what is actually in S3. Returns the number
+    of archives (added, removed) by the resync."""
+    backup_index = s3.get_backup_index(s3_client, bucket_name, website_name, folder_names)
+    num_added = 0
+    num_removed = 0
+    with conn:
+        for folder_name in folder_names:
+            catalog_keys = set(x[0] for x in conn.execute('SELECT key FROM backups WHERE bucket = ? AND '
+                'website_name = ? AND folder_name = ?', (bucket_name, website_name, folder_name)))
+            s3_keys = set(x.key for x in backup_index[folder_name])
+            for key in catalog_keys - s3_keys:
+                conn.execute('DELETE FROM backups WHERE bucket = ? AND key = ?', (bucket_name, key))
+                num_removed += 1
+            for backup_object in backup_index[folder_name]:
+                if backup_object.key not in catalog_keys:
+                    num_added += 1
+                # Keep checksums recorded at upload time; S3 ETags of multipart uploads are not content hashes
+                conn.execute('INSERT OR IGNORE INTO backups (bucket, key, website_name, folder_name, '
+                    'datetime_stamp, last_modified, size) VALUES (?, ?, ?, ?, ?, ?, ?)', (bucket_name,
+                    backup_object.key, website_name, folder_name, backup_object.datetime_stamp,
+                    format_datetime(backup_object.last_modified), backup_object.size))
+                conn.execute('UPDATE backups SET last_modified = ?, size = ? WHERE bucket = ? AND key = ?',
+                    (format_datetime(backup_object.last_modified), backup_object.size, bucket_name,
+                    backup_object.key))
+            conn.execute('INSERT OR REPLACE INTO reconciles (bucket, website_name, folder_name, reconcile_datetime) '
+                'VALUES (?, ?, ?, ?)', (bucket_name, website_name, folder_name, format_datetime(utc_now())))
+    return num_added, num_removed
+
+
+def ensure_reconciled(conn, s3_client, bucket_name, website_name, folder_names):
+    unreconciled_folders = get_unreconciled_folders(conn, bucket_name, website_name, folder_names)
+    if len(unreconciled_folders) > 0:
+        reconcile(conn, s3_client, bucket_name, website_name, unreconciled_folders)
+
+
+def get_backup_index(conn, bucket_name, website_name, folder_names):
+    """Same shape as s3.get_backup_index(), answered from the catalog's index instead of an S3 listing."""
+    backup_index = {}
+    for folder_name in folder_names:
+        rows = conn.execute('SELECT key, datetime_stamp, last_modified, size FROM backups WHERE bucket = ? AND '
+            'website_name = ? AND folder_name = ? ORDER BY last_modified', (bucket_name, website_name, folder_name))
+        backup_index[folder_name] = [s3.BackupObject(x[0], x[1], parse_datetime(x[2]), x[3]) for x in rows]
+    return backup_index
+
+
+def get_latest_backup(conn, bucket_name, website_name, folder_name):
+    row = conn.execute('SELECT key, datetime_stamp, last_modified, size FROM backups WHERE bucket = ? AND '
+        'website_name = ? AND folder_name = ? ORDER BY datetime_stamp DESC LIMIT 1', (bucket_name, website_name,
+        folder_name)).fetchone()
+    if row is None:
+        return None
+    return s3.BackupObject(row[0], row[1], parse_datetime(row[2]), row[3])
+
+
+def get_snapshot_keys(conn, bucket_name, website_name):
+    """Keys of the website's incremental backup snapshots in every schedule folder, oldest first."""
+    rows = conn.execute("SELECT key FROM backups WHERE bucket = ? AND website_name = ? AND key LIKE '%.snapshot' "
+        'ORDER BY datetime_stamp, key', (bucket_name, website_name))
+    return [x[0] for x in rows]
+
+
+def record_fingerprint(conn, bucket_name, website_name, fingerprint, key):
+    """Remembers the fingerprint (see manifest.get_fingerprint()) of the contents of a website's latest archive."""
+    with conn:
+        conn.execute('INSERT OR REPLACE INTO fingerprints (bucket, website_name, fingerprint, key, '
+            'recorded_datetime) VALUES (?, ?, ?, ?, ?)', (bucket_name, website_name, fingerprint, key,
+            format_datetime(utc_now())))
+
+
+def get_fingerprinted_backup(conn, bucket_name, website_name, fingerprint):
+    """Returns the key of the website's latest archive if its contents had this fingerprint and it is still in the
+    bucket, otherwise None."""
+    row = conn.execute('SELECT fingerprints.key FROM fingerprints JOIN backups ON backups.bucket = '
+        'fingerprints.bucket AND backups.key = fingerprints.key WHERE fingerprints.bucket = ? AND '
+        'fingerprints.website_name = ? AND fingerprints.fingerprint = ?', (bucket_name, website_name,
+        fingerprint)).fetchone()
+    if row is None:
+        return None
+    return row[0]
+
+
+def record_binlog_base(conn, bucket_name, website_name, key, binlog_file, binlog_position):
+    """Remembers the website's latest archive with a full database dump, and the binlog position it was dumped at,
+    which binlog backups after it replay from."""
+    with conn:
+        conn.execute('INSERT OR REPLACE INTO binlog_bases (bucket, website_name, key, binlog_file, binlog_position, '
+            'recorded_datetime) VALUES (?, ?, ?, ?, ?, ?)', (bucket_name, website_name, key, binlog_file,
+            binlog_position, format_datetime(utc_now())))
+
+
+def get_binlog_base(conn, bucket_name, website_name):
+    """Returns (key, last_modified, binlog file, binlog position) of the website's latest full dump archive if it is
+    still in the bucket, otherwise None."""
+    row = conn.execute('SELECT binlog_bases.key, backups.last_modified, binlog_file, binlog_position FROM '
+        'binlog_bases JOIN backups ON backups.bucket = binlog_bases.bucket AND backups.key = binlog_bases.key WHERE '
+        'binlog_bases.bucket = ? AND binlog_bases.website_name = ?', (bucket_name, website_name)).fetchone()
+    if row is None:
+        return None
+    return row[0], parse_datetime(row[1]), row[2], row[3]
+
+
+def record_binlog_dependency(conn, bucket_name, key, base_key):
+    """Remembers that binlog backup key (which has no full dump of its own) is restored on top of base_key."""
+    with conn:
+        conn.execute('INSERT OR REPLACE INTO binlog_dependencies (bucket, key, base_key) VALUES (?, ?, ?)',
+            (bucket_name, key, base_key))
+
+
+def get_binlog_dependencies(conn, bucket_name, website_name):
+    """Returns (key, base_key) of the website's binlog backups still in the bucket."""
+    rows = conn.execute('SELECT binlog_dependencies.key, base_key FROM binlog_dependencies JOIN backups ON '
+        'backups.bucket = binlog_dependencies.bucket AND backups.key = binlog_dependencies.key WHERE '
+        'binlog_dependencies.bucket = ? AND backups.website_name = ?', (bucket_name, website_name))
+    return [(x[0], x[1]) for x in rows]
+
+
+def get_first_backup_after(conn, bucket_name, website_name, folder_name, datetime_stamp):
+    # The oldest backup made at or after datetime_stamp (YYYYMMDDHHMMSS)
+    row = conn.execute('SELECT key, datetime_stamp, last_modified, size FROM backups WHERE bucket = ? AND '
+        'website_name = ? AND folder_name = ? AND datetime_stamp >= ? ORDER BY datetime_stamp LIMIT 1', (bucket_name,
+        website_name, folder_name, datetime_stamp)).fetchone()
+    if row is None:
+        return None
+    return s3.BackupObject(row[0], row[1], parse_datetime(row[2]), row[3])
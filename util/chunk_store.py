@@ -0,0 +1,413 @@
+#!/usr/bin/env python
+
+import os
+import io
+import hmac
+import gzip
+import json
+import time
+import stat
+import hashlib
+import logging
+import binascii
+import threading
+import Queue
+from multiprocessing.pool import ThreadPool
+try:
+    from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+    from cryptography.exceptions import InvalidTag
+except ImportError:
+    AESGCM = None
+import s3
+import governor
+
+
+# Everything for a website's incremental backups lives under <website_name>/chunks/ in the bucket: the key
+# parameters, the index of chunks already stored, and the encrypted chunks themselves
+KEY_PARAMETERS_NAME = 'key.json'
+INDEX_NAME = 'index.gz'
+
+SNAPSHOT_EXTENSION = '.snapshot'
+SNAPSHOT_VERSION = 1
+
+PBKDF2_ITERATIONS = 200000
+
+# Chunk boundaries are content defined: a chunk ends just after the first occurrence of a 2 byte anchor (derived
+# from the key) at least MIN_CHUNK_SIZE into it, or at MAX_CHUNK_SIZE. Because boundaries depend only on nearby
+# content, an insert or delete in a big file changes the chunks around it and not every chunk after it. In random
+# data the anchor turns up every 64KB on average, so chunks average a little over MIN_CHUNK_SIZE
+MIN_CHUNK_SIZE = 512 * 1024
+MAX_CHUNK_SIZE = 8 * 1024 * 1024
+ANCHOR_SIZE = 2
+
+# Encrypted chunks and snapshots are the magic, a 12 byte nonce, then AES-256-GCM ciphertext and tag
+ENCRYPTED_MAGIC = 'WBC1'
+NONCE_SIZE = 12
+
+
+def is_available():
+    return AESGCM is not None
+
+
+def is_snapshot_key(s3_key):
+    return s3_key.endswith(SNAPSHOT_EXTENSION)
+
+
+def get_chunks_prefix(website_name):
+    return website_name + '/chunks/'
+
+
+def iter_chunks(input_file, anchor):
+    data = ''
+    while True:
+        more = input_file.read(MAX_CHUNK_SIZE - len(data)) if len(data) < MAX_CHUNK_SIZE else ''
+        governor.throttle_read(len(more))
+        data += more
+        if not data:
+            return
+        if len(data) < MAX_CHUNK_SIZE and more:
+            continue
+        position = data.find(anchor, MIN_CHUNK_SIZE, MAX_CHUNK_SIZE)
+        if position == -1 or len(data) <= MIN_CHUNK_SIZE:
+            end = min(len(data), MAX_CHUNK_SIZE)
+        else:
+            end = position + ANCHOR_SIZE
+        yield data[:end]
+        data = data[end:]
+
+
+class ChunkStore:
+    """A website's encrypted, content-addressed chunk store in S3. Chunk ids are an HMAC of the chunk's contents, so
+    identical chunks are stored once, and the ids reveal nothing about the contents to anyone without the key."""
+
+    def __init__(self, s3_client, bucket_name, website_name, password, num_workers):
+        self.s3_client = s3_client
+        self.bucket_name = bucket_name
+        self.website_name = website_name
+        self.password = password
+        self.num_workers = max(num_workers, 1)
+        self.prefix = get_chunks_prefix(website_name)
+        self.encryption_key = None
+        self.mac_key = None
+        self.anchor = None
+        self.chunk_ids = None
+        self.new_chunk_ids = set()
+        self._lock = threading.Lock()
+
+    def open(self, create=False):
+        """Loads (or with create, first makes) the key parameters, derives the keys from the password, checks the
+        password against them, and loads the chunk index."""
+        try:
+            response = self.s3_client.get_object(Bucket=self.bucket_name, Key=self.prefix + KEY_PARAMETERS_NAME)
+            key_parameters = json.loads(response['Body'].read())
+        except self.s3_client.exceptions.NoSuchKey:
+            if not create:
+                raise IOError('No chunk store for ' + self.website_name + ' in bucket ' + self.bucket_name)
+            key_parameters = {'salt': binascii.hexlify(os.urandom(16)), 'iterations': PBKDF2_ITERATIONS}
+            self.derive_keys(key_parameters)
+            key_parameters['check'] = self.mac('key check')
+            self.s3_client.put_object(Bucket=self.bucket_name, Key=self.prefix + KEY_PARAMETERS_NAME,
+                Body=json.dumps(key_parameters))
+        self.derive_keys(key_parameters)
+        if not hmac.compare_digest(str(key_parameters['check']), self.mac('key check')):
+            raise IOError('Password does not match the one the chunk store of ' + self.website_name + ' was made with')
+        self.load_index()
+
+    def derive_keys(self, key_parameters):
+        # Derived once per run: one key encrypts, the other names chunks and picks the chunk boundary anchor
+        key = hashlib.pbkdf2_hmac('sha256', self.password, binascii.unhexlify(key_parameters['salt']),
+            key_parameters['iterations'], 64)
+        self.encryption_key = key[:32]
+        self.mac_key = key[32:]
+        self.anchor = hmac.new(self.mac_key, 'chunk anchor', hashlib.sha256).digest()[:ANCHOR_SIZE]
+
+    def mac(self, data):
+        return hmac.new(self.mac_key, data, hashlib.sha256).hexdigest()
+
+    def encrypt(self, data, associated_data):
+        nonce = os.urandom(NONCE_SIZE)
+        return ENCRYPTED_MAGIC + nonce + AESGCM(self.encryption_key).encrypt(nonce, data, associated_data)
+
+    def decrypt(self, data, associated_data):
+        if data[:len(ENCRYPTED_MAGIC)] != ENCRYPTED_MAGIC:
+            raise IOError('Not an encrypted chunk store object')
+        nonce = data[len(ENCRYPTED_MAGIC):len(ENCRYPTED_MAGIC) + NONCE_SIZE]
+        try:
+            return AESGCM(self.encryption_key).decrypt(nonce, data[len(ENCRYPTED_MAGIC) + NONCE_SIZE:],
+                associated_data)
+        except InvalidTag:
+            raise IOError('Chunk store object failed authentication (wrong password or corrupted)')
+
+    def get_chunk_key(self, chunk_id):
+        return self.prefix + chunk_id[:2] + '/' + chunk_id
+
+    def load_index(self):
+        try:
+            response = self.s3_client.get_object(Bucket=self.bucket_name, Key=self.prefix + INDEX_NAME)
+            with gzip.GzipFile(fileobj=io.BytesIO(response['Body'].read())) as f:
+                self.chunk_ids = set(x for x in f.read().split('\n') if x != '')
+        except self.s3_client.exceptions.NoSuchKey:
+            self.rebuild_index()
+
+    def rebuild_index(self):
+        # The chunk objects themselves are the truth, so a missing index is rebuilt by listing them
+        logging.info('Rebuilding chunk index of ' + self.website_name + ' from the bucket')
+        self.chunk_ids = set()
+        for item in s3.iter_objects(self.s3_client, self.bucket_name, self.prefix):
+            name = item['Key'][len(self.prefix):]
+            if '/' in name:
+                self.chunk_ids.add(name.split('/')[-1])
+
+    def save_index(self):
+        output = io.BytesIO()
+        with gzip.GzipFile(fileobj=output, mode='wb') as f:
+            f.write('\n'.join(sorted(self.chunk_ids)) + '\n')
+        self.s3_client.put_object(Bucket=self.bucket_name, Key=self.prefix + INDEX_NAME, Body=output.getvalue())
+
+    def put_chunk(self, data):
+        """Returns the chunk's id, and the bytes uploaded for it (0 if the store already had it)."""
+        chunk_id = self.mac(data)
+        with self._lock:
+            if chunk_id in self.chunk_ids or chunk_id in self.new_chunk_ids:
+                return chunk_id, 0
+            self.new_chunk_ids.add(chunk_id)
+        body = self.encrypt(data, chunk_id)
+        try:
+            self.s3_client.put_object(Bucket=self.bucket_name, Key=self.get_chunk_key(chunk_id),
+                **governor.get_upload_args(body))
+        except:
+            with self._lock:
+                self.new_chunk_ids.discard(chunk_id)
+            raise
+        return chunk_id, len(body)
+
+    def get_chunk(self, chunk_id):
+        # Ids read back from a snapshot's JSON are unicode
+        chunk_id = str(chunk_id)
+        response = self.s3_client.get_object(Bucket=self.bucket_name, Key=self.get_chunk_key(chunk_id))
+        data = self.decrypt(response['Body'].read(), chunk_id)
+        if self.mac(data) != chunk_id:
+            raise IOError('Chunk ' + chunk_id + ' does not match its id')
+        return data
+
+    def commit(self):
+        # Chunks uploaded this run join the index only once a snapshot referencing them is safely stored
+        if len(self.new_chunk_ids) > 0:
+            self.chunk_ids |= self.new_chunk_ids
+            self.new_chunk_ids = set()
+            self.save_index()
+
+    def encode_snapshot(self, snapshot):
+        output = io.BytesIO()
+        with gzip.GzipFile(fileobj=output, mode='wb') as f:
+            f.write(json.dumps(snapshot))
+        return self.encrypt(output.getvalue(), 'snapshot')
+
+    def decode_snapshot(self, data):
+        with gzip.GzipFile(fileobj=io.BytesIO(self.decrypt(data, 'snapshot'))) as f:
+            snapshot = json.loads(f.read())
+        if snapshot.get('version') != SNAPSHOT_VERSION:
+            raise IOError('Unsupported snapshot version ' + str(snapshot.get('version')))
+        return snapshot
+
+    def get_snapshot(self, s3_key):
+        response = self.s3_client.get_object(Bucket=self.bucket_name, Key=s3_key)
+        return self.decode_snapshot(response['Body'].read())
+
+    def list_snapshot_keys(self):
+        """Keys of every snapshot the website has in the bucket, in any folder, listed from S3 itself (rather than
+        from a catalog that may be missing some)."""
+        folder_prefixes = []
+        paginator = self.s3_client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.bucket_name, Prefix=self.website_name + '/', Delimiter='/'):
+            folder_prefixes.extend(x['Prefix'] for x in page.get('CommonPrefixes', []))
+        snapshot_keys = []
+        for prefix in folder_prefixes:
+            if prefix != get_chunks_prefix(self.website_name):
+                snapshot_keys.extend(x['Key'] for x in s3.iter_objects(self.s3_client, self.bucket_name, prefix)
+                    if is_snapshot_key(x['Key']))
+        return sorted(snapshot_keys)
+
+    def collect_garbage(self):
+        """Deletes chunks no longer referenced by any snapshot in the bucket (see list_snapshot_keys()). Any
+        failure to list or read a snapshot raises before anything is deleted. The index is rewritten first, so a
+        chunk is never in the index without also being in the bucket. Returns the number of chunks deleted."""
+        snapshot_keys = self.list_snapshot_keys()
+        referenced = set()
+        for s3_key in snapshot_keys:
+            snapshot = self.get_snapshot(s3_key)
+            for section in ['files', 'extra_files']:
+                for entry in snapshot[section]:
+                    referenced.update(entry['chunks'])
+        unreferenced = self.chunk_ids - referenced
+        if len(unreferenced) == 0:
+            return 0
+        self.chunk_ids -= unreferenced
+        self.save_index()
+        deleted_keys, errors = s3.delete_objects(self.s3_client, self.bucket_name,
+            [self.get_chunk_key(x) for x in sorted(unreferenced)])
+        # A chunk left behind only costs storage (it is out of the index, and back in it only if the index is rebuilt)
+        for key, code, message in errors:
+            logging.warning('Could not delete chunk ' + key + ': ' + code + ' ' + message)
+        return len(deleted_keys)
+
+
+def get_file_entries(store, directory, names, previous_entries, stats):
+    """Chunks the files, uploading chunks the store doesn't have yet, num_workers at a time. A file with the same
+    size, mtime and inode as in the previous snapshot reuses its chunk list without being read."""
+    pool = ThreadPool(store.num_workers)
+    # Bounds how many chunks are read ahead of their upload
+    buffered_chunks = threading.BoundedSemaphore(store.num_workers * 2)
+    entries = []
+
+    def put_chunk_and_release(data):
+        try:
+            return store.put_chunk(data)
+        finally:
+            buffered_chunks.release()
+
+    try:
+        for name in names:
+            path = os.path.join(directory, name)
+            try:
+                file_stat = os.stat(path)
+            except OSError as e:
+                logging.warning('Skipping ' + path + ': ' + str(e))
+                continue
+            if stat.S_ISDIR(file_stat.st_mode):
+                entries.append({'path': name, 'type': 'directory', 'mode': file_stat.st_mode,
+                    'mtime': file_stat.st_mtime, 'chunks': []})
+                continue
+            entry = {'path': name, 'type': 'file', 'mode': file_stat.st_mode, 'mtime': file_stat.st_mtime,
+                'size': file_stat.st_size, 'inode': file_stat.st_ino}
+            previous = previous_entries.get(name)
+            if previous is not None and [previous.get(x) for x in ['size', 'mtime', 'inode']] == \
+                    [file_stat.st_size, file_stat.st_mtime, file_stat.st_ino]:
+                entry['chunks'] = previous['chunks']
+                stats['reused_files'] += 1
+                entries.append(entry)
+                continue
+            try:
+                pending = []
+                with open(path, 'rb') as f:
+                    for data in iter_chunks(f, store.anchor):
+                        stats['chunked_bytes'] += len(data)
+                        buffered_chunks.acquire()
+                        pending.append(pool.apply_async(put_chunk_and_release, (data,)))
+            except IOError as e:
+                logging.warning('Skipping ' + path + ': ' + str(e))
+                for result in pending:
+                    result.wait()
+                continue
+            entry['chunks'] = []
+            for result in pending:
+                chunk_id, uploaded = result.get()
+                entry['chunks'].append(chunk_id)
+                if uploaded > 0:
+                    stats['new_chunks'] += 1
+                    stats['uploaded_bytes'] += uploaded
+            stats['chunked_files'] += 1
+            entries.append(entry)
+    finally:
+        pool.close()
+        pool.join()
+    return entries
+
+
+def make_snapshot(store, website_directory, file_manifest, extra_directory, extra_manifest, previous_snapshot):
+    """Stores the files of file_manifest (see manifest.get_file_manifest()) under website_directory, and of
+    extra_manifest under extra_directory (the database dump and messages log), in the chunk store. Returns the
+    snapshot, which lists every file with its chunk ids, and stats of what was read and uploaded."""
+    stats = {'files': 0, 'bytes_in': 0, 'reused_files': 0, 'chunked_files': 0, 'chunked_bytes': 0, 'new_chunks': 0,
+        'uploaded_bytes': 0}
+    previous_entries = {}
+    if previous_snapshot is not None:
+        previous_entries = dict((x['path'], x) for x in previous_snapshot['files'])
+    names = [x[0].rstrip('/') for x in file_manifest]
+    extra_names = [x[0].rstrip('/') for x in extra_manifest]
+    snapshot = {
+        'version': SNAPSHOT_VERSION,
+        'website_name': store.website_name,
+        'created': time.time(),
+        'files': get_file_entries(store, website_directory, names, previous_entries, stats),
+        'extra_files': get_file_entries(store, extra_directory, extra_names, {}, stats)
+    }
+    for entry in snapshot['files'] + snapshot['extra_files']:
+        if entry['type'] == 'file':
+            stats['files'] += 1
+            stats['bytes_in'] += entry['size']
+    return snapshot, stats
+
+
+def restore_entries(store, entries, target_directory):
+    """Rebuilds entries of a snapshot under target_directory, fetching chunks num_workers at a time while files are
+    written in order. Returns (number of files, bytes written)."""
+    pool = ThreadPool(store.num_workers)
+    chunk_queue = Queue.Queue(store.num_workers * 4)
+    errors = []
+    stats = [0, 0]
+
+    def queue_chunks():
+        try:
+            for entry in entries:
+                chunk_queue.put(('entry', entry))
+                for chunk_id in entry['chunks']:
+                    chunk_queue.put(('chunk', pool.apply_async(store.get_chunk, (chunk_id,))))
+                chunk_queue.put(('end', entry))
+        except Exception as e:
+            errors.append(e)
+        finally:
+            chunk_queue.put(None)
+
+    reader = threading.Thread(target=queue_chunks)
+    reader.daemon = True
+    reader.start()
+    output_file = None
+    directories = []
+    try:
+        for kind, value in iter(chunk_queue.get, None):
+            if kind == 'entry':
+                path = get_restore_path(target_directory, value['path'])
+                if value['type'] == 'directory':
+                    if not os.path.isdir(path):
+                        os.makedirs(path)
+                    directories.append((path, value))
+                    continue
+                if not os.path.isdir(os.path.dirname(path)):
+                    os.makedirs(os.path.dirname(path))
+                output_file = open(path, 'wb')
+            elif kind == 'chunk':
+                data = value.get()
+                output_file.write(data)
+                stats[1] += len(data)
+            elif value['type'] == 'file':
+                output_file.close()
+                output_file = None
+                path = get_restore_path(target_directory, value['path'])
+                os.chmod(path, stat.S_IMODE(value['mode']))
+                os.utime(path, (value['mtime'], value['mtime']))
+                stats[0] += 1
+        if errors:
+            raise errors[0]
+    finally:
+        if output_file is not None:
+            output_file.close()
+        while reader.is_alive():
+            try:
+                chunk_queue.get(timeout=0.1)
+            except Queue.Empty:
+                pass
+        pool.close()
+        pool.join()
+    # Directory times last, after their contents stopped changing them
+    for path, entry in reversed(directories):
+        os.chmod(path, stat.S_IMODE(entry['mode']))
+        os.utime(path, (entry['mtime'], entry['mtime']))
+    return stats[0], stats[1]
+
+
+def get_restore_path(target_directory, name):
+    path = os.path.normpath(os.path.join(target_directory, name))
+    if not path.startswith(os.path.normpath(target_directory) + os.sep):
+        raise IOError('Refusing to restore entry outside of target directory: ' + name)
+    return path
@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+
+import zlib
+import threading
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+# Codecs by [zip_file]codec name. The id is the byte each compressed block of an archive starts with, so a reader
+# finds the codec of every block from the block itself
+CODEC_IDS = {'store': 's', 'deflate': 'z', 'zstd': 'd'}
+
+# Levels ([zip_file]compression_level) each codec that compresses takes, as (lowest, highest)
+CODEC_LEVELS = {'deflate': (0, 9), 'zstd': (1, 22)}
+
+# Zstandard compressor and decompressor objects can't be shared between threads, so each thread keeps its own
+_zstd = threading.local()
+
+
+def is_available(codec_name):
+    return codec_name != 'zstd' or zstandard is not None
+
+
+class Codec:
+    """Compresses blocks with one codec at one level. Safe to use from several threads at once."""
+
+    def __init__(self, name, level):
+        if name not in CODEC_IDS:
+            raise ValueError('Unknown codec ' + name)
+        if not is_available(name):
+            raise ValueError('The ' + name + ' codec needs the Python zstandard package (pip install zstandard)')
+        self.name = name
+        self.level = level
+
+    def compress(self, data):
+        """Returns data compressed, preceded by this codec's id."""
+        if self.name == 'deflate':
+            return CODEC_IDS['deflate'] + zlib.compress(data, self.level)
+        if self.name == 'zstd':
+            compressors = getattr(_zstd, 'compressors', None)
+            if compressors is None:
+                compressors = _zstd.compressors = {}
+            if self.level not in compressors:
+                compressors[self.level] = zstandard.ZstdCompressor(level=self.level)
+            return CODEC_IDS['zstd'] + compressors[self.level].compress(data)
+        return CODEC_IDS['store'] + data
+
+
+def decompress(block):
+    """Reverses Codec.compress() of any codec, found from the block's first byte."""
+    codec_id = block[0]
+    if codec_id == CODEC_IDS['store']:
+        return block[1:]
+    if codec_id == CODEC_IDS['deflate']:
+        return zlib.decompress(block[1:])
+    if codec_id == CODEC_IDS['zstd']:
+        if zstandard is None:
+            raise IOError('Archive is compressed with zstd, which needs the Python zstandard package (pip install ' +
+                'zstandard)')
+        decompressor = getattr(_zstd, 'decompressor', None)
+        if decompressor is None:
+            decompressor = _zstd.decompressor = zstandard.ZstdDecompressor()
+        return decompressor.decompress(block[1:])
+    raise IOError('Archive block has unknown codec id ' + repr(codec_id))
@@ -0,0 +1,188 @@
+#!/usr/bin/env python
+
+import os
+import re
+import sys
+import logging
+import collections
+import ConfigParser
+import compression
+
+
+# Every setting read from web_backup.ini as (section, option, type, default). A blank or missing setting takes the
+# default; settings with a None default that are needed by a run are checked with require(). A list setting is
+# comma-separated and read as a tuple, with 'none' for an empty list
+SETTINGS = [
+    ('logging', 'level', str, None),
+    ('aws', 'access_key_id', str, None),
+    ('aws', 'secret_access_key', str, None),
+    ('aws', 'region_name', str, None),
+    ('aws', 's3_bucket_name', str, None),
+    ('aws', 'multipart_part_size_mb', int, 64),
+    ('aws', 'upload_workers', int, 4),
+    ('aws', 'stale_upload_hours', int, 24),
+    ('aws', 'download_part_size_mb', int, 16),
+    ('aws', 'download_workers', int, 8),
+    ('zip_file', 'password', str, None),
+    ('zip_file', 'codec', str, 'deflate'),
+    ('zip_file', 'compression_workers', int, 0),
+    ('zip_file', 'compression_level', int, 6),
+    ('zip_file', 'store_extensions', list, ('jpg', 'jpeg', 'png', 'gif', 'webp', 'ico', 'mp4', 'm4v', 'mov', 'webm',
+        'avi', 'mp3', 'm4a', 'ogg', 'pdf', 'zip', 'gz', 'tgz', 'bz2', 'xz', '7z', 'rar', 'woff', 'woff2')),
+    ('zip_file', 'store_sample_percent', int, 95),
+    ('database', 'user', str, None),
+    ('database', 'password', str, None),
+    ('database', 'dump_workers', int, 4),
+    ('database', 'load_workers', int, 4),
+    ('database', 'socket', str, '/var/lib/mysql/mysql.sock'),
+    ('database', 'binlog_full_dump_interval', str, '1w'),
+    ('website', 'root_directory', str, None),
+    ('concurrency', 'sites', int, 4),
+    ('concurrency', 'zip', int, 2),
+    ('concurrency', 'mysqldump', int, 2),
+    ('concurrency', 'upload', int, 2),
+    ('throttle', 'read_mb_per_second', float, 0),
+    ('throttle', 'upload_mb_per_second', float, 0),
+    ('throttle', 'nice', int, 0),
+    ('throttle', 'ionice_class', str, 'none'),
+    ('throttle', 'ionice_level', int, 7),
+    ('throttle', 'max_load_average', float, 0),
+    ('throttle', 'apache_status_url', str, None),
+    ('throttle', 'max_apache_busy_workers', int, 0),
+    ('metrics', 'run_record_directory', str, None),
+    ('metrics', 'textfile_directory', str, None),
+    ('notification_emails', 'gmail_user', str, None),
+    ('notification_emails', 'gmail_password', str, None),
+]
+
+SECTION_NAMES = []
+for _setting in SETTINGS:
+    if _setting[0] not in SECTION_NAMES:
+        SECTION_NAMES.append(_setting[0])
+
+# Immutable settings, one namedtuple per section, e.g. config.aws.s3_bucket_name
+SECTION_TYPES = dict((x, collections.namedtuple(x.title().replace('_', '') + 'Settings',
+    [y[1] for y in SETTINGS if y[0] == x])) for x in SECTION_NAMES)
+
+# [schedules] entries are <folder_name>,<interval>,<num_files_to_keep>, e.g. daily,1d,7
+Schedule = collections.namedtuple('Schedule', ['folder_name', 'interval', 'num_files_to_keep'])
+
+Config = collections.namedtuple('Config', SECTION_NAMES + ['schedules'])
+
+_config = None
+
+
+def get_config_filename():
+    return os.path.abspath(os.path.dirname(os.path.abspath(__file__)) + '/../web_backup.ini')
+
+
+def get_config():
+    """Returns the settings from web_backup.ini. The file is parsed and validated on the first call only."""
+    global _config
+
+    if _config is None:
+        _config = load_config(get_config_filename())
+    return _config
+
+
+def load_config(config_filename):
+    if not os.path.isfile(config_filename):
+        logging.error("Required ini file '" + config_filename + "' is missing. Clone file 'web_backup__sample.ini' " +
+            "to create file 'web_backup.ini'")
+        sys.exit(1)
+    config_parser = ConfigParser.ConfigParser()
+    try:
+        config_parser.read(config_filename)
+    except ConfigParser.Error as e:
+        logging.error('Cannot parse ' + config_filename + ': ' + str(e))
+        sys.exit(1)
+
+    # Collect every problem in the file so they can all be fixed in one go
+    errors = []
+    section_values = dict((x, {}) for x in SECTION_NAMES)
+    for section, option, value_type, default_value in SETTINGS:
+        value = None
+        if config_parser.has_option(section, option):
+            value = config_parser.get(section, option).strip()
+            if value == '':
+                value = None
+        if value is None:
+            value = default_value
+        elif value_type is int:
+            try:
+                value = int(value)
+                if value < 0:
+                    raise ValueError()
+            except ValueError:
+                errors.append("Setting in web_backup.ini '[" + section + ']' + option + "' must be a positive " +
+                    'integer')
+        elif value_type is float:
+            try:
+                value = float(value)
+                if value < 0:
+                    raise ValueError()
+            except ValueError:
+                errors.append("Setting in web_backup.ini '[" + section + ']' + option + "' must be a positive " +
+                    'number')
+        elif value_type is list:
+            value = tuple(x.strip() for x in value.split(',') if x.strip() != '' and x.strip().lower() != 'none')
+        section_values[section][option] = value
+    codec_name = section_values['zip_file']['codec']
+    if codec_name not in compression.CODEC_IDS:
+        errors.append("Setting in web_backup.ini '[zip_file]codec' must be 'zstd', 'deflate' or 'store'")
+    elif codec_name in compression.CODEC_LEVELS:
+        lowest, highest = compression.CODEC_LEVELS[codec_name]
+        if not lowest <= section_values['zip_file']['compression_level'] <= highest:
+            errors.append("Setting in web_backup.ini '[zip_file]compression_level' must be from " + str(lowest) +
+                ' to ' + str(highest) + ' for ' + codec_name)
+    if section_values['zip_file']['store_sample_percent'] > 100:
+        errors.append("Setting in web_backup.ini '[zip_file]store_sample_percent' must be from 0 to 100")
+    if re.match('[1-9][0-9]*[smhdwMY]$', section_values['database']['binlog_full_dump_interval']) is None:
+        errors.append("Setting in web_backup.ini '[database]binlog_full_dump_interval' must be an interval like " +
+            "those in [schedules], e.g. 1w")
+    if section_values['throttle']['nice'] > 19:
+        errors.append("Setting in web_backup.ini '[throttle]nice' must be from 0 to 19")
+    if section_values['throttle']['ionice_class'] not in ['none', 'best-effort', 'idle']:
+        errors.append("Setting in web_backup.ini '[throttle]ionice_class' must be 'none', 'best-effort' or 'idle'")
+    if section_values['throttle']['ionice_level'] > 7:
+        errors.append("Setting in web_backup.ini '[throttle]ionice_level' must be from 0 to 7")
+    if section_values['logging']['level'] not in [None, 'Info', 'Warning', 'Error']:
+        errors.append("Setting in web_backup.ini '[logging]level' must be 'Info', 'Warning', or 'Error'")
+
+    schedules = []
+    if config_parser.has_section('schedules'):
+        for schedule in config_parser.items('schedules'):
+            schedule_error = get_schedule_error(schedule[1])
+            if schedule_error is not None:
+                errors.append("web_backup.ini [schedules] entry '" + schedule[0] + '=' + schedule[1] + "' is " +
+                    'invalid. ' + schedule_error)
+                continue
+            schedule_parms = [x.strip() for x in schedule[1].split(',')]
+            schedules.append(Schedule(schedule_parms[0], schedule_parms[1], int(schedule_parms[2])))
+
+    if len(errors) > 0:
+        for error in errors:
+            logging.error(error)
+        sys.exit(1)
+    sections = [SECTION_TYPES[x](**section_values[x]) for x in SECTION_NAMES]
+    return Config(*(sections + [tuple(schedules)]))
+
+
+def get_schedule_error(schedule_value):
+    schedule_parms = [x.strip() for x in schedule_value.split(',')]
+    if len(schedule_parms) != 3:
+        return 'Must contain 3 comma-separated fields'
+    if re.match('[1-9][0-9]*[smhdwMY]$', schedule_parms[1]) is None:
+        return "Contains an invalid interval between backups '" + schedule_parms[1] + "'"
+    if re.match('[0-9]+$', schedule_parms[2]) is None:
+        return "'" + schedule_parms[2] + "' must be a positive integer"
+    return None
+
+
+def require(value, section, option):
+    # For settings that are optional in general but needed by this particular run
+    if value is None:
+        logging.error("Required setting in web_backup.ini '[" + section + ']' + option + "' cannot be missing " +
+            "or blank")
+        sys.exit(1)
+    return value
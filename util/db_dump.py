@@ -0,0 +1,208 @@
+#!/usr/bin/env python
+
+import os
+import gzip
+import json
+import time
+import logging
+import threading
+import Queue
+import governor
+try:
+    import pymysql
+    import pymysql.cursors
+except ImportError:
+    pymysql = None
+
+
+# Per-table dumps are written as <dump_directory>/<table>.sql.gz, with MANIFEST_FILENAME listing them in load order
+MANIFEST_FILENAME = 'manifest.json'
+
+# Each INSERT holds up to ROWS_PER_INSERT rows, but is ended early once it passes MAX_INSERT_BYTES (mysqldump's
+# net_buffer_length default), so no statement comes near the max_allowed_packet of the server it is restored into
+ROWS_PER_INSERT = 1000
+MAX_INSERT_BYTES = 1024 * 1024
+
+FILE_HEADER = '/*!40101 SET NAMES utf8mb4 */;\n/*!40014 SET FOREIGN_KEY_CHECKS=0 */;\n' \
+    '/*!40101 SET SQL_MODE=\'NO_AUTO_VALUE_ON_ZERO\' */;\n'
+
+
+class SnapshotError(Exception):
+    pass
+
+
+def is_available():
+    return pymysql is not None
+
+
+def connect(db_info, socket_filename=None):
+    connect_args = {'user': db_info['DB_USER'], 'passwd': db_info['DB_PASSWORD'], 'db': db_info['DB_NAME'],
+        'charset': 'utf8mb4', 'use_unicode': False}
+    if db_info['DB_HOST'] == 'localhost' and socket_filename is not None and os.path.exists(socket_filename):
+        connect_args['unix_socket'] = socket_filename
+    else:
+        connect_args['host'] = db_info['DB_HOST']
+    return pymysql.connect(**connect_args)
+
+
+def get_unsupported_objects(db_info, socket_filename=None):
+    """Returns the views and triggers of the database (as 'view <name>' / 'trigger <name>'), which the parallel dump
+    does not include. A database with any of them has to be dumped with mysqldump instead."""
+    conn = connect(db_info, socket_filename)
+    try:
+        cursor = conn.cursor()
+        cursor.execute("SELECT CONCAT('view ', table_name) FROM information_schema.views "
+            "WHERE table_schema = DATABASE() UNION ALL SELECT CONCAT('trigger ', trigger_name) "
+            "FROM information_schema.triggers WHERE trigger_schema = DATABASE()")
+        objects = [x[0] for x in cursor.fetchall()]
+        cursor.close()
+    finally:
+        conn.close()
+    return objects
+
+
+def get_tables(conn):
+    # Largest tables first, so the long dumps start right away instead of being left for the end
+    cursor = conn.cursor()
+    cursor.execute("SELECT table_name FROM information_schema.tables WHERE table_schema = DATABASE() "
+        "AND table_type = 'BASE TABLE' ORDER BY data_length + index_length DESC")
+    tables = [x[0] for x in cursor.fetchall()]
+    cursor.close()
+    return tables
+
+
+def start_snapshots(lock_conn, worker_conns):
+    """Opens a REPEATABLE READ snapshot on every worker connection at the same point in time. Writes are held off
+    with a global read lock while the snapshots start, so all tables are dumped as of one instant. Raises
+    SnapshotError without the RELOAD privilege needed for the lock, as snapshots started one after another would
+    not be consistent with each other. Returns the (binlog file, position) of that instant, or None without binary
+    logging."""
+    cursor = lock_conn.cursor()
+    try:
+        cursor.execute('FLUSH TABLES WITH READ LOCK')
+    except pymysql.MySQLError as e:
+        cursor.close()
+        raise SnapshotError('Could not take global read lock (' + str(e) + ')')
+    try:
+        for worker_conn in worker_conns:
+            worker_cursor = worker_conn.cursor()
+            worker_cursor.execute('SET SESSION TRANSACTION ISOLATION LEVEL REPEATABLE READ')
+            worker_cursor.execute('START TRANSACTION WITH CONSISTENT SNAPSHOT')
+            worker_cursor.close()
+        binlog_position = get_binlog_position(cursor)
+    finally:
+        cursor.execute('UNLOCK TABLES')
+        cursor.close()
+    return binlog_position
+
+
+def get_binlog_position(cursor):
+    # MySQL 8.4 renamed SHOW MASTER STATUS
+    for sql in ['SHOW MASTER STATUS', 'SHOW BINARY LOG STATUS']:
+        try:
+            cursor.execute(sql)
+        except pymysql.MySQLError:
+            continue
+        row = cursor.fetchone()
+        if row is not None:
+            return [row[0], int(row[1])]
+        return None
+    return None
+
+
+def dump_table(conn, table_name, output_filename):
+    started = time.time()
+    quoted_table_name = '`' + table_name.replace('`', '``') + '`'
+    num_rows = 0
+    cursor = conn.cursor()
+    cursor.execute('SHOW CREATE TABLE ' + quoted_table_name)
+    create_table = cursor.fetchone()[1]
+    cursor.close()
+    # Unbuffered cursor, so rows stream from the server instead of the whole table being loaded into memory
+    cursor = conn.cursor(pymysql.cursors.SSCursor)
+    output_file = gzip.open(output_filename, 'wb', 6)
+    try:
+        output_file.write(FILE_HEADER)
+        output_file.write('DROP TABLE IF EXISTS ' + quoted_table_name + ';\n' + create_table + ';\n')
+        cursor.execute('SELECT * FROM ' + quoted_table_name)
+        insert_prefix = 'INSERT INTO ' + quoted_table_name + ' VALUES '
+        values = []
+        values_bytes = 0
+        while True:
+            rows = cursor.fetchmany(ROWS_PER_INSERT)
+            if not rows:
+                break
+            # The snapshot is already started, so pausing here holds back nothing but this dump
+            governor.wait_while_busy()
+            for row in rows:
+                value = conn.escape(row)
+                # A single row over the limit still gets a statement of its own
+                if values and (len(values) == ROWS_PER_INSERT or values_bytes + len(value) > MAX_INSERT_BYTES):
+                    output_file.write(insert_prefix + ','.join(values) + ';\n')
+                    values = []
+                    values_bytes = 0
+                values.append(value)
+                values_bytes += len(value) + 1
+            num_rows += len(rows)
+        if values:
+            output_file.write(insert_prefix + ','.join(values) + ';\n')
+    finally:
+        cursor.close()
+        output_file.close()
+    return {'table': table_name, 'filename': os.path.basename(output_filename), 'rows': num_rows,
+        'bytes': os.path.getsize(output_filename), 'seconds': time.time() - started}
+
+
+def dump_database(db_info, dump_directory, num_workers, socket_filename=None):
+    """Dumps each table of the database to its own gzipped .sql file in dump_directory, num_workers tables at a
+    time, all from one consistent snapshot. Writes and returns the manifest of per-table row counts and timings,
+    and the binlog position of the snapshot if there is one. Raises SnapshotError, before anything is written, if
+    the snapshot can't be taken (see start_snapshots())."""
+    started = time.time()
+    lock_conn = connect(db_info, socket_filename)
+    tables = get_tables(lock_conn)
+    num_workers = max(1, min(num_workers, len(tables)))
+    worker_conns = [connect(db_info, socket_filename) for x in range(num_workers)]
+    table_queue = Queue.Queue()
+    for table_name in tables:
+        table_queue.put(table_name)
+    table_results = {}
+    errors = []
+
+    def dump_worker(conn):
+        while not errors:
+            try:
+                table_name = table_queue.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                table_results[table_name] = dump_table(conn, table_name, os.path.join(dump_directory,
+                    table_name + '.sql.gz'))
+                logging.info('Dumped table ' + table_name + ' (' + str(table_results[table_name]['rows']) +
+                    ' rows in ' + '%.1f' % table_results[table_name]['seconds'] + 's)')
+            except Exception as e:
+                errors.append(table_name + ': ' + str(e))
+
+    try:
+        try:
+            binlog_position = start_snapshots(lock_conn, worker_conns)
+        finally:
+            lock_conn.close()
+        if not os.path.isdir(dump_directory):
+            os.makedirs(dump_directory)
+        threads = [threading.Thread(target=dump_worker, args=(x,)) for x in worker_conns]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    finally:
+        for conn in worker_conns:
+            conn.close()
+    if errors:
+        raise Exception('Database dump failed. ' + '; '.join(errors))
+
+    manifest = {'database': db_info['DB_NAME'], 'seconds': time.time() - started,
+        'tables': [table_results[x] for x in tables], 'binlog_position': binlog_position}
+    with open(os.path.join(dump_directory, MANIFEST_FILENAME), 'w') as f:
+        json.dump(manifest, f, indent=2)
+    return manifest
@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+
+import re
+import time
+
+
+# Sent ahead of a dump being loaded: one transaction per load, and no unique or foreign key checks per row
+BULK_LOAD_PREFIX = 'SET autocommit=0;\nSET unique_checks=0;\nSET foreign_key_checks=0;\n'
+
+BULK_LOAD_SUFFIX = 'COMMIT;\nSET unique_checks=1;\nSET foreign_key_checks=1;\n'
+
+# Non-unique index definitions in SHOW CREATE TABLE output, which are built after the rows are loaded
+SECONDARY_KEY_PATTERN = re.compile('\s*(KEY|INDEX|FULLTEXT KEY|FULLTEXT INDEX|SPATIAL KEY|SPATIAL INDEX)\s')
+
+CREATE_TABLE_PATTERN = re.compile('CREATE TABLE (?:IF NOT EXISTS )?`((?:[^`]|``)+)`')
+
+# The rows of an extended INSERT are separated by ),( outside of quoted strings
+INSERT_TOKEN_PATTERN = re.compile(r"'[^'\\]*(?:\\.[^'\\]*)*'|\),\(")
+
+
+def quote_name(name):
+    return '`' + name.replace('`', '``') + '`'
+
+
+def count_insert_rows(line):
+    return 1 + sum(1 for x in INSERT_TOKEN_PATTERN.finditer(line) if x.group(0) == '),(')
+
+
+def iter_lines(chunks):
+    remainder = ''
+    for chunk in chunks:
+        lines = (remainder + chunk).split('\n')
+        remainder = lines.pop()
+        for line in lines:
+            yield line + '\n'
+    if remainder != '':
+        yield remainder
+
+
+def split_secondary_keys(create_table):
+    """Returns create_table without its non-unique indexes, and their definitions. Tables with foreign keys are
+    left alone, as a foreign key needs its index from the start."""
+    lines = create_table.rstrip('\n').split('\n')
+    definitions = [x.rstrip().rstrip(',') for x in lines[1:-1]]
+    if len(lines) < 3 or len([x for x in definitions if 'FOREIGN KEY' in x]) > 0:
+        return create_table, []
+    kept = [x for x in definitions if SECONDARY_KEY_PATTERN.match(x) is None]
+    deferred = [x.strip() for x in definitions if SECONDARY_KEY_PATTERN.match(x) is not None]
+    if len(deferred) == 0 or len(kept) == 0:
+        return create_table, []
+    return lines[0] + '\n' + ',\n'.join(kept) + '\n' + lines[-1] + '\n', deferred
+
+
+class BulkLoadFilter:
+    """Passes a SQL dump through with the secondary indexes taken out of each CREATE TABLE. get_index_sql() then
+    adds them back, one ALTER TABLE per table, so each index is built once by sorting the loaded rows rather than
+    row by row. Each table's rows, bytes and load time (from its CREATE TABLE to the next one, as the SQL is taken
+    in by whatever reads the filter) are listed in tables."""
+
+    def __init__(self):
+        self.deferred_keys = []
+        self.tables = []
+
+    def end_table(self):
+        if len(self.tables) > 0 and 'load_seconds' not in self.tables[-1]:
+            self.tables[-1]['load_seconds'] = time.time() - self.tables[-1]['started']
+
+    def filter(self, chunks):
+        create_table = None
+        for line in iter_lines(chunks):
+            if create_table is None:
+                match = CREATE_TABLE_PATTERN.match(line)
+                if match is None:
+                    if len(self.tables) > 0:
+                        self.tables[-1]['bytes'] += len(line)
+                        if line.startswith('INSERT INTO '):
+                            self.tables[-1]['rows'] += count_insert_rows(line)
+                    yield line
+                    continue
+                self.end_table()
+                self.tables.append({'table': match.group(1).replace('``', '`'), 'rows': 0, 'bytes': 0,
+                    'started': time.time()})
+                create_table = ''
+            create_table += line
+            self.tables[-1]['bytes'] += len(line)
+            if line.startswith(')') and line.rstrip().endswith(';'):
+                create_table, keys = split_secondary_keys(create_table)
+                if len(keys) > 0:
+                    self.deferred_keys.append((self.tables[-1]['table'], keys))
+                yield create_table
+                create_table = None
+        if create_table is not None:
+            yield create_table
+        self.end_table()
+
+    def get_index_sql(self, table_name=None):
+        # All tables' indexes, or just table_name's. InnoDB adds only one FULLTEXT (or SPATIAL) index per ALTER TABLE
+        sql = ''
+        for deferred_table_name, keys in self.deferred_keys:
+            if table_name is not None and deferred_table_name != table_name:
+                continue
+            plain_keys = [x for x in keys if not x.startswith('FULLTEXT') and not x.startswith('SPATIAL')]
+            groups = [plain_keys] + [[x] for x in keys if x not in plain_keys]
+            for group in [x for x in groups if len(x) > 0]:
+                sql += 'ALTER TABLE ' + quote_name(deferred_table_name) + ' ' + ', '.join('ADD ' + x for x in
+                    group) + ';\n'
+        return sql
@@ -0,0 +1,203 @@
+#!/usr/bin/env python
+
+import os
+import re
+import io
+import time
+import base64
+import hashlib
+import logging
+import threading
+import subprocess
+import urllib2
+
+
+# ionice scheduling classes by [throttle]ionice_class name
+IONICE_CLASSES = {'best-effort': 2, 'idle': 3}
+
+# While adaptive throttling is on, the load average and Apache busy workers are looked at this often
+LOAD_CHECK_SECONDS = 5
+
+# Backing off starts with a 1 second pause, doubling each time the server is still busy, up to this
+MAX_BACKOFF_SECONDS = 60
+
+APACHE_STATUS_TIMEOUT_SECONDS = 2
+
+
+class TokenBucket:
+    """Paces whatever is passed to consume() to rate bytes per second on average, across all threads, allowing bursts
+    of up to a second's worth."""
+
+    def __init__(self, rate):
+        self.rate = float(rate)
+        self.tokens = self.rate
+        self.updated = time.time()
+        self.waited_seconds = 0
+        self._lock = threading.Lock()
+
+    def consume(self, num_bytes):
+        # The bucket can go into debt, so a read bigger than the bucket is still paced right. Each caller sleeps off
+        # the debt as it stood after its own bytes, which queues concurrent callers one behind the other
+        with self._lock:
+            now = time.time()
+            self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate) - num_bytes
+            self.updated = now
+            wait_seconds = max(0, -self.tokens / self.rate)
+            self.waited_seconds += wait_seconds
+        if wait_seconds > 0:
+            time.sleep(wait_seconds)
+
+
+class ThrottledReader:
+    """File-like wrapper for an upload body, so bytes are paced as the HTTP client reads them to send."""
+
+    def __init__(self, input_file, bucket):
+        self.input_file = input_file
+        self.bucket = bucket
+
+    def read(self, size=-1):
+        data = self.input_file.read(size)
+        wait_while_busy()
+        self.bucket.consume(len(data))
+        return data
+
+    def seek(self, offset, whence=0):
+        return self.input_file.seek(offset, whence)
+
+    def tell(self):
+        return self.input_file.tell()
+
+
+class Governor:
+    """Keeps a backup run from crowding out the live web server: read and upload rate caps, and (if thresholds are
+    set) backing off while the load average or Apache busy workers are too high."""
+
+    def __init__(self, settings):
+        self.read_bucket = None
+        if settings.read_mb_per_second > 0:
+            self.read_bucket = TokenBucket(settings.read_mb_per_second * 1024 * 1024)
+        self.upload_bucket = None
+        if settings.upload_mb_per_second > 0:
+            self.upload_bucket = TokenBucket(settings.upload_mb_per_second * 1024 * 1024)
+        self.max_load_average = settings.max_load_average
+        self.apache_status_url = settings.apache_status_url
+        self.max_apache_busy_workers = settings.max_apache_busy_workers
+        self.is_adaptive = self.max_load_average > 0 or (self.apache_status_url is not None and
+            self.max_apache_busy_workers > 0)
+        self.last_checked = 0
+        self.backoff_seconds = 0
+        self.apache_status_failed = False
+        self._lock = threading.Lock()
+
+    def get_busy_reason(self):
+        load_average = os.getloadavg()[0]
+        if self.max_load_average > 0 and load_average > self.max_load_average:
+            return 'load average ' + '%.2f' % load_average + ' is over ' + str(self.max_load_average)
+        if self.apache_status_url is not None and self.max_apache_busy_workers > 0:
+            busy_workers = self.get_apache_busy_workers()
+            if busy_workers is not None and busy_workers > self.max_apache_busy_workers:
+                return str(busy_workers) + ' Apache busy workers is over ' + str(self.max_apache_busy_workers)
+        return None
+
+    def get_apache_busy_workers(self):
+        # mod_status machine readable output (server-status?auto) has a 'BusyWorkers: <n>' line
+        try:
+            status = urllib2.urlopen(self.apache_status_url, timeout=APACHE_STATUS_TIMEOUT_SECONDS).read()
+        except Exception as e:
+            if not self.apache_status_failed:
+                logging.warning('Could not read Apache status from ' + self.apache_status_url + ': ' + str(e))
+                self.apache_status_failed = True
+            return None
+        match = re.search('^BusyWorkers: *([0-9]+)', status, re.MULTILINE)
+        if match is None:
+            return None
+        return int(match.group(1))
+
+    def wait_while_busy(self):
+        # One thread looks at the server and sleeps while it is busy. Other threads wait on the lock meanwhile,
+        # so the whole run pauses
+        if not self.is_adaptive:
+            return
+        with self._lock:
+            if time.time() - self.last_checked < LOAD_CHECK_SECONDS:
+                return
+            pause_seconds = 1
+            while True:
+                busy_reason = self.get_busy_reason()
+                self.last_checked = time.time()
+                if busy_reason is None:
+                    return
+                logging.info('Backup pausing for ' + str(pause_seconds) + 's, ' + busy_reason)
+                time.sleep(pause_seconds)
+                self.backoff_seconds += pause_seconds
+                pause_seconds = min(pause_seconds * 2, MAX_BACKOFF_SECONDS)
+
+
+_governor = None
+
+
+def start(settings):
+    """Applies the [throttle] settings to this run. Until it is called, the functions below do nothing."""
+    global _governor
+
+    _governor = Governor(settings)
+    set_priority(settings.nice, settings.ionice_class, settings.ionice_level)
+    return _governor
+
+
+def set_priority(nice, ionice_class, ionice_level):
+    # Lowers this process's CPU and I/O priority, which zip, mysqldump and any other child process inherit. Niceness
+    # only goes up to nice, so a child web_backup.py (--all-sites) doesn't add its own on top of its parent's
+    current_nice = os.nice(0)
+    if nice > current_nice:
+        os.nice(nice - current_nice)
+    if ionice_class in IONICE_CLASSES:
+        exec_list = ['ionice', '-c', str(IONICE_CLASSES[ionice_class])]
+        if ionice_class != 'idle':
+            exec_list += ['-n', str(ionice_level)]
+        try:
+            subprocess.check_call(exec_list + ['-p', str(os.getpid())])
+        except (OSError, subprocess.CalledProcessError) as e:
+            logging.warning('Could not set I/O priority with ionice: ' + str(e))
+
+
+def throttle_read(num_bytes):
+    """Called after reading num_bytes of website files; sleeps as needed to keep under the read rate cap."""
+    if _governor is None:
+        return
+    _governor.wait_while_busy()
+    if _governor.read_bucket is not None:
+        _governor.read_bucket.consume(num_bytes)
+
+
+def wait_while_busy():
+    if _governor is not None:
+        _governor.wait_while_busy()
+
+
+def get_upload_args(body):
+    """Returns the Body (and ContentMD5) arguments for an S3 upload of body (a string or a file), wrapped so it is
+    sent no faster than the upload cap."""
+    if _governor is None or _governor.upload_bucket is None:
+        return {'Body': body}
+    if isinstance(body, str):
+        body = io.BytesIO(body)
+    # Given no Content-MD5, boto reads the whole body to work it out before sending, which would count every byte
+    # against the cap twice
+    md5 = hashlib.md5()
+    for data in iter(lambda: body.read(1024 * 1024), ''):
+        md5.update(data)
+    body.seek(0)
+    return {'Body': ThrottledReader(body, _governor.upload_bucket), 'ContentMD5': base64.b64encode(md5.digest())}
+
+
+def get_stats():
+    # Seconds the run spent paused by each part of the governor, for the run report
+    if _governor is None:
+        return {}
+    stats = {'backoff_seconds': _governor.backoff_seconds}
+    if _governor.read_bucket is not None:
+        stats['read_wait_seconds'] = _governor.read_bucket.waited_seconds
+    if _governor.upload_bucket is not None:
+        stats['upload_wait_seconds'] = _governor.upload_bucket.waited_seconds
+    return stats
@@ -0,0 +1,453 @@
+#!/usr/bin/env python
+
+import os
+import stat
+import json
+import zlib
+import struct
+import hashlib
+import logging
+import threading
+import collections
+from multiprocessing.pool import ThreadPool
+try:
+    from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+    from cryptography.exceptions import InvalidTag
+except ImportError:
+    AESGCM = None
+import archive
+import governor
+import compression
+
+
+# An indexed archive (.wba) is a header, a sequence of encrypted records, and a trailer:
+#   header:  HEADER_MAGIC, then the PBKDF2 iterations and salt the key is derived from the password with
+#   records: 4 byte length, 12 byte nonce, then the AES-256-GCM ciphertext and tag, authenticated along with the
+#            record's offset in the archive. Records are encrypted independently, so several are encrypted or
+#            decrypted at a time, and each is verified as it is read. Each entry record (name, type, mode, mtime) is
+#            followed by block records holding the file's contents, BLOCK_SIZE bytes of it (before compression) per
+#            block, each starting with the id of the codec it is compressed with (see compression.CODEC_IDS). The
+#            last record is the index, listing every entry with the byte range its records take up
+#   trailer: TRAILER_MAGIC, the iterations and salt again, and the offset and length of the index record
+# So the trailer and index can be fetched on their own, and then just the byte ranges of the files wanted
+EXTENSION = '.wba'
+
+HEADER_MAGIC = 'WBA1'
+HEADER = struct.Struct('<4sI16s')
+TRAILER_MAGIC = 'WBAT'
+TRAILER = struct.Struct('<4sI16sQQ')
+RECORD_LENGTH = struct.Struct('<I')
+RECORD_OFFSET = struct.Struct('<Q')
+
+PBKDF2_ITERATIONS = 200000
+SALT_SIZE = 16
+NONCE_SIZE = 12
+TAG_SIZE = 16
+
+BLOCK_SIZE = 1024 * 1024
+
+# The first byte of a record's plaintext is its type. Abandoned follows the blocks of a file that couldn't be read
+# to the end, which is left out of the index
+ENTRY_RECORD = 'E'
+BLOCK_RECORD = 'B'
+ABANDONED_RECORD = 'A'
+INDEX_RECORD = 'I'
+
+# Entries whose byte ranges are closer together than this are fetched with one ranged GET
+MAX_RANGE_GAP = 1024 * 1024
+
+# Keys already derived by this run, by (password, salt, iterations), and the salt of archives this run writes, by
+# password. PBKDF2 is slow on purpose, so it is run once per run rather than once per archive
+_keys = {}
+_write_salts = {}
+_keys_lock = threading.Lock()
+
+
+class UnreadableFileError(IOError):
+    pass
+
+
+def is_available():
+    return AESGCM is not None
+
+
+def is_indexed_archive(filename):
+    with open(filename, 'rb') as f:
+        return f.read(len(HEADER_MAGIC)) == HEADER_MAGIC
+
+
+def derive_key(password, salt, iterations):
+    with _keys_lock:
+        if (password, salt, iterations) not in _keys:
+            _keys[(password, salt, iterations)] = hashlib.pbkdf2_hmac('sha256', password, salt, iterations, 32)
+        return _keys[(password, salt, iterations)]
+
+
+def get_write_salt(password):
+    with _keys_lock:
+        if password not in _write_salts:
+            _write_salts[password] = os.urandom(SALT_SIZE)
+        return _write_salts[password]
+
+
+def read_exact(input_stream, size):
+    chunks = []
+    remaining = size
+    while remaining > 0:
+        chunk = input_stream.read(remaining)
+        if not chunk:
+            raise IOError('Unexpected end of indexed archive')
+        chunks.append(chunk)
+        remaining -= len(chunk)
+    return ''.join(chunks)
+
+
+class ArchiveWriter:
+    """Writes an indexed archive, front to back, to output_file (which only needs write(), so it can be a pipe).
+    Blocks are compressed with codec (a compression.Codec, deflate level 6 if None), and records encrypted, on
+    num_workers threads and written in order. Files with one of store_extensions, or whose first block a trial
+    compression can't get under store_sample_percent of its size, are stored rather than compressed."""
+
+    def __init__(self, output_file, password, codec=None, store_extensions=(), store_sample_percent=0,
+                 num_workers=1):
+        self.output_file = output_file
+        if codec is None:
+            codec = compression.Codec('deflate', 6)
+        self.codec = codec
+        self.store_extensions = set(store_extensions)
+        self.store_sample_percent = store_sample_percent
+        self.salt = get_write_salt(password)
+        self.aesgcm = AESGCM(derive_key(password, self.salt, PBKDF2_ITERATIONS))
+        self.pool = ThreadPool(max(num_workers, 1))
+        # Bounds the records (and blocks) in flight, and so the memory they take
+        self.max_pending = max(num_workers, 1) * 4
+        self.pending = collections.deque()
+        # Offset of the next record, counting the records still being encrypted
+        self.offset = 0
+        self.entries = []
+        self.stats = {'files': 0, 'directories': 0, 'bytes_in': 0, 'bytes_out': 0, 'stored_files': 0,
+            'stored_bytes': 0, 'compressed_files': 0, 'compressed_bytes': 0, 'compressed_bytes_out': 0}
+        self.write(HEADER.pack(HEADER_MAGIC, PBKDF2_ITERATIONS, self.salt))
+
+    def write(self, data):
+        self.output_file.write(data)
+        self.offset += len(data)
+
+    def write_record(self, plaintext):
+        # The ciphertext is the plaintext plus a tag, so the offset of the record after this one is known before
+        # this one is encrypted
+        offset = self.offset
+        self.offset += RECORD_LENGTH.size + NONCE_SIZE + len(plaintext) + TAG_SIZE
+        self.pending.append(self.pool.apply_async(self.encrypt_record, (offset, plaintext)))
+        self.flush(self.max_pending)
+
+    def encrypt_record(self, offset, plaintext):
+        nonce = os.urandom(NONCE_SIZE)
+        ciphertext = self.aesgcm.encrypt(nonce, plaintext, RECORD_OFFSET.pack(offset))
+        return RECORD_LENGTH.pack(NONCE_SIZE + len(ciphertext)) + nonce + ciphertext
+
+    def flush(self, max_pending=0):
+        while len(self.pending) > max_pending:
+            self.output_file.write(self.pending.popleft().get())
+
+    def add_directory(self, name, file_stat):
+        entry = {'name': name, 'type': 'directory', 'mode': file_stat.st_mode, 'mtime': file_stat.st_mtime,
+            'offset': self.offset}
+        self.write_record(ENTRY_RECORD + json.dumps(entry))
+        entry['length'] = self.offset - entry['offset']
+        self.entries.append(entry)
+        self.stats['directories'] += 1
+
+    def add_file(self, name, input_file, file_stat, is_website_file=False):
+        """Adds the contents of input_file. Reads of website files count against the read rate cap."""
+        entry = {'name': name, 'type': 'file', 'mode': file_stat.st_mode, 'mtime': file_stat.st_mtime,
+            'offset': self.offset}
+        self.write_record(ENTRY_RECORD + json.dumps(entry))
+        is_stored = self.codec.name == 'store' or os.path.splitext(name)[1][1:].lower() in self.store_extensions
+        size = 0
+        size_out = 0
+        blocks = collections.deque()
+        while True:
+            try:
+                data = input_file.read(BLOCK_SIZE)
+            except IOError as e:
+                raise UnreadableFileError(str(e))
+            if is_website_file:
+                governor.throttle_read(len(data))
+            if not data:
+                break
+            if size == 0 and not is_stored and self.store_sample_percent > 0:
+                is_stored = archive.is_incompressible(data, self.store_sample_percent)
+            blocks.append(self.pool.apply_async(encode_block, (data, None if is_stored else self.codec)))
+            size += len(data)
+            # Blocks go to the pool to be compressed, and on to be encrypted in the order they were read
+            while len(blocks) > self.max_pending:
+                block = blocks.popleft().get()
+                self.write_record(BLOCK_RECORD + block)
+                size_out += len(block) - 1
+        while blocks:
+            block = blocks.popleft().get()
+            self.write_record(BLOCK_RECORD + block)
+            size_out += len(block) - 1
+        entry['size'] = size
+        entry['length'] = self.offset - entry['offset']
+        self.entries.append(entry)
+        self.stats['files'] += 1
+        self.stats['bytes_in'] += size
+        if is_stored:
+            self.stats['stored_files'] += 1
+            self.stats['stored_bytes'] += size
+        else:
+            self.stats['compressed_files'] += 1
+            self.stats['compressed_bytes'] += size
+            self.stats['compressed_bytes_out'] += size_out
+
+    def add_path(self, name, path, file_stat, is_website_file=False):
+        try:
+            input_file = open(path, 'rb')
+        except IOError as e:
+            logging.warning('Skipping ' + path + ': ' + str(e))
+            return
+        offset = self.offset
+        try:
+            with input_file:
+                self.add_file(name, input_file, file_stat, is_website_file)
+        except UnreadableFileError as e:
+            # What was written of it can't be taken back, so readers are told to drop it
+            logging.warning('Skipping ' + path + ': ' + str(e))
+            if self.entries and self.entries[-1]['offset'] == offset:
+                self.entries.pop()
+            self.write_record(ABANDONED_RECORD)
+
+    def add_tree(self, directory, prefix='', is_website_file=False):
+        """Adds everything under directory, with names starting with prefix: sorted by name, each directory ahead of
+        its contents, symlinks followed, and unreadable entries skipped (see archive.iter_tree())."""
+        for name, path, file_stat in archive.iter_tree(directory):
+            if name.endswith('/'):
+                self.add_directory(prefix + name, file_stat)
+            else:
+                self.add_path(prefix + name, path, file_stat, is_website_file)
+
+    def close(self):
+        """Writes the index and trailer. Returns the stats of what was archived."""
+        index_offset = self.offset
+        # The codec is listed for information. Readers go by the codec id of each block
+        index = {'version': 1, 'codec': self.codec.name, 'level': self.codec.level, 'entries': self.entries}
+        self.write_record(INDEX_RECORD + zlib.compress(json.dumps(index), 6))
+        self.flush()
+        self.pool.close()
+        self.write(TRAILER.pack(TRAILER_MAGIC, PBKDF2_ITERATIONS, self.salt, index_offset, self.offset - index_offset))
+        self.stats['bytes_out'] = self.offset
+        return self.stats
+
+
+class FileSource:
+    """Byte ranges of a local archive file."""
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.size = os.path.getsize(filename)
+        self.bytes_read = 0
+
+    def open_range(self, offset, length):
+        input_file = open(self.filename, 'rb')
+        input_file.seek(offset)
+        self.bytes_read += length
+        return input_file
+
+
+class S3Source:
+    """Byte ranges of an archive in S3, each fetched with a ranged GET."""
+
+    def __init__(self, s3_client, bucket_name, s3_key):
+        self.s3_client = s3_client
+        self.bucket_name = bucket_name
+        self.s3_key = s3_key
+        head = s3_client.head_object(Bucket=bucket_name, Key=s3_key)
+        self.size = head['ContentLength']
+        self.etag = head['ETag']
+        self.bytes_read = 0
+
+    def open_range(self, offset, length):
+        response = self.s3_client.get_object(Bucket=self.bucket_name, Key=self.s3_key, IfMatch=self.etag,
+            Range='bytes=' + str(offset) + '-' + str(offset + length - 1))
+        self.bytes_read += length
+        return response['Body']
+
+
+class EntryFile:
+    """Read-only file object over the contents of one entry, decrypted and inflated as it is read."""
+
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.pending = ''
+
+    def read(self, size=-1):
+        while size < 0 or len(self.pending) < size:
+            chunk = next(self.chunks, None)
+            if chunk is None:
+                break
+            self.pending += chunk
+        if size < 0:
+            size = len(self.pending)
+        data = self.pending[:size]
+        self.pending = self.pending[size:]
+        return data
+
+
+class ArchiveReader:
+    """Reads an indexed archive from source (a FileSource or S3Source). Only the trailer and index are read up
+    front; entries are read from their own byte ranges, with records decrypted and inflated on num_workers threads
+    as they stream in."""
+
+    def __init__(self, source, password, num_workers=1):
+        self.source = source
+        self.password = password
+        self.aesgcm = None
+        self.entries = None
+        self.codec_name = None
+        self.pool = ThreadPool(max(num_workers, 1))
+        self.max_pending = max(num_workers, 1) * 4
+
+    def open(self):
+        if self.source.size < HEADER.size + TRAILER.size:
+            raise IOError('Not an indexed archive')
+        trailer = read_exact(self.source.open_range(self.source.size - TRAILER.size, TRAILER.size), TRAILER.size)
+        magic, iterations, salt, index_offset, index_length = TRAILER.unpack(trailer)
+        if magic != TRAILER_MAGIC:
+            raise IOError('Not an indexed archive, or it was not written to the end')
+        self.aesgcm = AESGCM(derive_key(self.password, salt, iterations))
+        for record_type, body in self.iter_records(index_offset, index_length):
+            if record_type == INDEX_RECORD:
+                index = json.loads(zlib.decompress(body))
+                self.entries = index['entries']
+                # Archives written before codecs were selectable are all deflate
+                self.codec_name = index.get('codec', 'deflate')
+        if self.entries is None:
+            raise IOError('Indexed archive has no index')
+        return self.entries
+
+    def close(self):
+        # Stops the decryption threads, once any records still being decrypted are done
+        self.pool.close()
+        self.pool.join()
+
+    def get_names(self):
+        return [x['name'] for x in self.entries]
+
+    def get_entries(self, prefixes):
+        """Entries named one of prefixes, or under one of them if it is a directory."""
+        prefixes = [x.rstrip('/') for x in prefixes]
+        return [x for x in self.entries if x['name'].rstrip('/') in prefixes or
+            len([y for y in prefixes if x['name'].startswith(y + '/')]) > 0]
+
+    def decrypt_record(self, offset, record):
+        # Returns (type, rest of plaintext), with a block record's block already inflated
+        try:
+            plaintext = self.aesgcm.decrypt(record[:NONCE_SIZE], record[NONCE_SIZE:], RECORD_OFFSET.pack(offset))
+        except InvalidTag:
+            raise IOError('Archive record at offset ' + str(offset) + ' failed authentication (wrong password or ' +
+                'corrupted)')
+        if plaintext[0] == BLOCK_RECORD:
+            return plaintext[0], compression.decompress(plaintext[1:])
+        return plaintext[0], plaintext[1:]
+
+    def iter_records(self, offset, length):
+        # Yields decrypt_record() of each record in the range, fetched as one stream. Records are read ahead and
+        # handed to the pool, up to max_pending of them, while earlier ones are yielded in order
+        input_stream = self.source.open_range(offset, length)
+        end = offset + length
+        pending = collections.deque()
+        while offset < end or pending:
+            while offset < end and len(pending) < self.max_pending:
+                record_length = RECORD_LENGTH.unpack(read_exact(input_stream, RECORD_LENGTH.size))[0]
+                pending.append(self.pool.apply_async(self.decrypt_record, (offset, read_exact(input_stream,
+                    record_length))))
+                offset += RECORD_LENGTH.size + record_length
+            yield pending.popleft().get()
+
+    def iter_ranges(self, entries):
+        # Entries in archive order, grouped into runs whose ranges can be fetched as one
+        entries = sorted(entries, key=lambda x: x['offset'])
+        group = []
+        for entry in entries:
+            if group and entry['offset'] - (group[-1]['offset'] + group[-1]['length']) > MAX_RANGE_GAP:
+                yield group
+                group = []
+            group.append(entry)
+        if group:
+            yield group
+
+    def iter_entry_data(self, entry):
+        for record_type, body in self.iter_records(entry['offset'], entry['length']):
+            if record_type == BLOCK_RECORD:
+                yield body
+
+    def open_entry(self, name):
+        entries = [x for x in self.entries if x['name'] == name]
+        if len(entries) == 0:
+            raise IOError('No entry ' + name + ' in archive')
+        return EntryFile(self.iter_entry_data(entries[0]))
+
+    def extract(self, entries, target_directory, strip_prefix=''):
+        """Writes entries (each named strip_prefix + its path) under target_directory. Each file is written to a
+        temp file next to it and renamed into place, so a live website never sees a partly written file. Returns
+        (number of files, bytes written)."""
+        num_files = 0
+        num_bytes = 0
+        wanted = set(x['offset'] for x in entries)
+        for group in self.iter_ranges(entries):
+            start = group[0]['offset']
+            end = group[-1]['offset'] + group[-1]['length']
+            output = None
+            for record_type, body in self.iter_records(start, end - start):
+                if record_type == ENTRY_RECORD:
+                    if output is not None:
+                        num_bytes += finish_file(output)
+                        num_files += 1
+                    output = None
+                    entry = json.loads(body)
+                    if entry['offset'] not in wanted:
+                        continue
+                    if not entry['name'].startswith(strip_prefix):
+                        raise IOError('Entry ' + entry['name'] + ' is not under ' + strip_prefix)
+                    # The strip_prefix directory itself is target_directory
+                    if entry['name'] == strip_prefix:
+                        continue
+                    path = archive.get_safe_path(target_directory, entry['name'][len(strip_prefix):])
+                    if entry['type'] == 'directory':
+                        if not os.path.isdir(path):
+                            os.makedirs(path)
+                        continue
+                    if not os.path.isdir(os.path.dirname(path)):
+                        os.makedirs(os.path.dirname(path))
+                    output = (open(path + '.web_restore_tmp', 'wb'), path, entry)
+                elif record_type == BLOCK_RECORD and output is not None:
+                    output[0].write(body)
+                elif record_type == ABANDONED_RECORD and output is not None:
+                    output[0].close()
+                    os.remove(output[1] + '.web_restore_tmp')
+                    output = None
+            if output is not None:
+                num_bytes += finish_file(output)
+                num_files += 1
+        return num_files, num_bytes
+
+
+def encode_block(data, codec):
+    # Compressed with codec unless codec is None or compressing doesn't make it smaller
+    if codec is not None:
+        block = codec.compress(data)
+        if len(block) <= len(data):
+            return block
+    return compression.CODEC_IDS['store'] + data
+
+
+def finish_file(output):
+    output_file, path, entry = output
+    num_bytes = output_file.tell()
+    output_file.close()
+    os.chmod(path + '.web_restore_tmp', stat.S_IMODE(entry['mode']))
+    os.utime(path + '.web_restore_tmp', (entry['mtime'], entry['mtime']))
+    os.rename(path + '.web_restore_tmp', path)
+    return num_bytes
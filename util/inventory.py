@@ -0,0 +1,201 @@
+#!/usr/bin/env python
+
+import os
+import re
+import glob
+import json
+import logging
+import tempfile
+import subprocess
+import collections
+
+
+APACHE_CONF_DIRECTORY = '/etc/httpd/conf.d'
+
+# Stored next to web_backup.ini
+CACHE_FILENAME = 'web_backup_sites.cache'
+
+# One website hosted on this server. Fields that don't apply (e.g. wordpress_database on a static site, or
+# backup_hour on a site without a backup crontab entry) are None
+SiteRecord = collections.namedtuple('SiteRecord', ['website_name', 'server_name', 'document_root', 'default_site',
+    'wordpress_database', 'wordpress_user', 'backup_hour', 'backup_minute', 'backup_email'])
+
+
+def get_cache_filename():
+    return os.path.abspath(os.path.dirname(os.path.abspath(__file__)) + '/../' + CACHE_FILENAME)
+
+
+def get_file_signature(filename):
+    # A file is only re-parsed when its mtime or size no longer match what was cached
+    try:
+        stat = os.stat(filename)
+    except OSError:
+        return None
+    return [stat.st_mtime, stat.st_size]
+
+
+def load_cache():
+    try:
+        with open(get_cache_filename()) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+
+def save_cache(cache):
+    # --all-sites children save at the same time, so each writes its own temp file and renames it into place
+    cache_filename = get_cache_filename()
+    temp_filename = None
+    try:
+        fd, temp_filename = tempfile.mkstemp(prefix=CACHE_FILENAME + '.', dir=os.path.dirname(cache_filename))
+        with os.fdopen(fd, 'w') as f:
+            json.dump(cache, f)
+        os.rename(temp_filename, cache_filename)
+    except (IOError, OSError) as e:
+        logging.warning('Could not write website inventory cache ' + cache_filename + ': ' + str(e))
+        if temp_filename is not None and os.path.exists(temp_filename):
+            os.remove(temp_filename)
+
+
+def get_cached_parse(cache, new_cache, filename, parse_function):
+    signature = get_file_signature(filename)
+    if signature is None:
+        return None
+    if filename in cache and cache[filename]['signature'] == signature:
+        info = cache[filename]['info']
+    else:
+        info = parse_function(filename)
+    new_cache[filename] = {'signature': signature, 'info': info}
+    return info
+
+
+def parse_site_conf(fname):
+    results = {'server_name': '<undefined>', 'document_root': '<undefined>'}
+    with open(fname, 'r') as f:
+        line = f.readline()
+        found_vhost = False
+        found_server_name = False
+        found_document_root = False
+        found_default_site = False
+        while line:
+            if not found_vhost:
+                m = re.match('\s*<VirtualHost\s+\*:443>\s*', line)
+                if m is not None:
+                    found_vhost = True
+            else:
+                if re.match('\s*</VirtualHost>\s*', line) is not None:
+                    return results
+                if not found_server_name:
+                    m = re.match('\s*ServerName\s+(?P<server_name>[^\s]+)\s*', line)
+                    if m is not None:
+                        found_server_name = True
+                        results['server_name'] = m.group('server_name')
+                if not found_document_root:
+                    m = re.match('\s*DocumentRoot\s+(?P<document_root>[^\s]+)\s*', line)
+                    if m is not None:
+                        found_document_root = True
+                        results['document_root'] = m.group('document_root')
+                if not found_default_site:
+                    m = re.match('\s*Redirect\s+/\s+https://(?P<default_site>[^/\s]+)/?\s*', line)
+                    if m is not None:
+                        found_default_site = True
+                        results['default_site'] = m.group('default_site')
+            line = f.readline()
+    return results
+
+
+def parse_wp_config(wp_config_filename):
+    results = {}
+    with open(wp_config_filename, 'r') as f:
+        line = f.readline()
+        while line:
+            m = re.match('\s*define\(\s*\'DB_NAME\'*,\s*\'(?P<db_name>[^\']+)\'\s*\);\s*', line)
+            if m is not None:
+                results['wordpress_database'] = m.group('db_name')
+            m = re.match('\s*define\(\s*\'DB_USER\'*,\s*\'(?P<db_user>[^\']+)\'\s*\);\s*', line)
+            if m is not None:
+                results['wordpress_user'] = m.group('db_user')
+            line = f.readline()
+    return results
+
+
+def get_crontab_backups():
+    # One 'crontab -l' for the whole inventory, mapping website name to its backup hour, minute and email
+    crontab_backups = {}
+    cmd = subprocess.Popen('crontab -l', shell=True, stdout=subprocess.PIPE)
+    for line in cmd.stdout:
+        m = re.match('^(?P<minute>[0-9]+)\s+(?P<hour>[0-9]+)[^-]+--website-name\s+' \
+            '(?P<website_name>[A-Za-z0-9_]+).*(--notification-emails\s+(?P<notification_emails>[A-Za-z0-9_@\.]+))?.*',
+            line)
+        if m is not None:
+            backup_email = None
+            m_email = re.match('.*--notification-emails\s+(?P<notification_emails>[A-Za-z0-9_@\.]+).*', line)
+            if m_email is not None:
+                backup_email = m_email.group('notification_emails')
+            crontab_backups[m.group('website_name')] = (m.group('hour'), m.group('minute'), backup_email)
+    cmd.wait()
+    return crontab_backups
+
+
+def get_websites():
+    """Returns a dict of website name to SiteRecord for every _site_<name>.conf Apache config on this server. Parsed
+    config and wp-config.php files are cached in web_backup_sites.cache and only re-read when they change."""
+    cache = load_cache()
+    new_cache = {}
+    default_site = None
+    default_info = get_cached_parse(cache, new_cache, APACHE_CONF_DIRECTORY + '/_site.conf', parse_site_conf)
+    if default_info is not None and 'default_site' in default_info:
+        default_site = default_info['default_site']
+    crontab_backups = get_crontab_backups()
+    websites = {}
+    for _site_file in glob.glob(APACHE_CONF_DIRECTORY + '/_site_*.conf'):
+        m = re.match('.*_site_(?P<website_name>.*)\.conf', _site_file)
+        if m is None:
+            continue
+        website_name = m.group('website_name')
+        info = get_cached_parse(cache, new_cache, _site_file, parse_site_conf)
+        wp_info = get_cached_parse(cache, new_cache, info['document_root'] + '/wp-config.php', parse_wp_config)
+        if wp_info is None:
+            wp_info = {}
+        backup_hour, backup_minute, backup_email = crontab_backups.get(website_name, (None, None, None))
+        websites[website_name] = SiteRecord(website_name, info['server_name'], info['document_root'],
+            default_site is not None and info['server_name'] == default_site, wp_info.get('wordpress_database'),
+            wp_info.get('wordpress_user'), backup_hour, backup_minute, backup_email)
+    if new_cache != cache:
+        save_cache(new_cache)
+    return websites
+
+
+def print_websites(websites):
+    print_blank = False
+    for website_name in sorted(websites.keys()):
+        if print_blank:
+            print
+        else:
+            print_blank = True
+
+        site = websites[website_name]
+        print 'Website: ' + website_name
+        print '    Full domain: ' + site.server_name
+        print '    Directory: ' + site.document_root
+        print '    This is default site on server: ' + str(site.default_site)
+
+        if site.backup_hour is not None:
+            if site.backup_email is not None:
+                backup_email = ' (will notify ' + site.backup_email + ')'
+            else:
+                backup_email = ''
+            print '    Backups for this site are configured for ' + str(site.backup_hour) + ':' + \
+                str(site.backup_minute).zfill(2) + backup_email
+        else:
+            print '    There are no backups configured (via crontab) for this site.'
+
+        if site.wordpress_database is not None:
+            if site.wordpress_user is not None:
+                wordpress_user = ' (accessed as database user \'' + site.wordpress_user + '\')'
+            else:
+                wordpress_user = ''
+            print '    This is a Wordpress site stored in database \'' + site.wordpress_database + '\'' + \
+                wordpress_user
+        else:
+            print '    This is a static site.  (Not a Wordpress site.)'
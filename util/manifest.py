@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+
+import os
+import stat
+import hashlib
+import subprocess
+import db_dump
+
+
+def get_file_manifest(directory):
+    """Returns a sorted list of (path, size, mtime, inode) for everything under directory, following symlinks as
+    archives do. Directories are listed with a trailing / and size 0."""
+    file_manifest = []
+    for root, dirs, files in os.walk(directory, followlinks=True):
+        relative_root = os.path.relpath(root, directory)
+        if relative_root == '.':
+            relative_root = ''
+        for name in dirs + files:
+            path = os.path.join(relative_root, name)
+            try:
+                file_stat = os.stat(os.path.join(root, name))
+            except OSError:
+                continue
+            if stat.S_ISDIR(file_stat.st_mode):
+                file_manifest.append((path + '/', 0, file_stat.st_mtime, file_stat.st_ino))
+            else:
+                file_manifest.append((path, file_stat.st_size, file_stat.st_mtime, file_stat.st_ino))
+    file_manifest.sort()
+    return file_manifest
+
+
+def get_table_checksums(db_info, socket_filename=None):
+    """Returns a sorted list of (table, checksum) for the base tables of a WordPress database, from CHECKSUM TABLE.
+    Uses pymysql if it is installed, otherwise the mysql client."""
+    if db_dump.is_available():
+        conn = db_dump.connect(db_info, socket_filename)
+        try:
+            cursor = conn.cursor()
+            cursor.execute("SHOW FULL TABLES WHERE Table_type = 'BASE TABLE'")
+            tables = [x[0] for x in cursor.fetchall()]
+            rows = []
+            if len(tables) > 0:
+                cursor.execute('CHECKSUM TABLE ' + ', '.join('`' + x.replace('`', '``') + '`' for x in tables))
+                rows = cursor.fetchall()
+            cursor.close()
+        finally:
+            conn.close()
+    else:
+        exec_mysql_list = ['/bin/mysql', '-h', db_info['DB_HOST'], '-u', db_info['DB_USER'],
+            '-p' + db_info['DB_PASSWORD'], '-N', '-B', db_info['DB_NAME']]
+        tables = subprocess.check_output(exec_mysql_list + ['-e', "SHOW FULL TABLES WHERE Table_type = 'BASE TABLE'"]
+            ).split('\n')
+        tables = [x.split('\t')[0] for x in tables if x.strip() != '']
+        rows = []
+        if len(tables) > 0:
+            output = subprocess.check_output(exec_mysql_list + ['-e', 'CHECKSUM TABLE ' + ', '.join('`' +
+                x.replace('`', '``') + '`' for x in tables)])
+            rows = [x.split('\t') for x in output.split('\n') if x.strip() != '']
+    # The checksum comes back qualified with the database name, e.g. wp_site.wp_posts
+    return sorted((x[0].split('.', 1)[-1], str(x[1])) for x in rows)
+
+
+def get_fingerprint(file_manifest, table_checksums, salt=''):
+    """A digest of everything that would go into a backup. Two runs with the same fingerprint would produce the same
+    archive contents, so the later one can reuse the earlier one's archive. salt is folded in for settings that
+    change the archive without changing its contents, such as the zip password."""
+    sha256 = hashlib.sha256()
+    sha256.update(hashlib.sha256(salt).hexdigest() + '\n')
+    for path, size, mtime, inode in file_manifest:
+        sha256.update(path + '\0' + str(size) + '\0' + repr(mtime) + '\0' + str(inode) + '\n')
+    for table, checksum in table_checksums:
+        sha256.update('table\0' + table + '\0' + checksum + '\n')
+    return sha256.hexdigest()
@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+
+import os
+import re
+import json
+import time
+import datetime
+import logging
+import contextlib
+import config
+
+
+# Fields of a phase record that are summed when a phase runs more than once (e.g. one s3_copy per schedule folder)
+SUMMED_FIELDS = ['seconds', 'bytes_in', 'bytes_out', 'files', 'stored_bytes', 'compressed_bytes']
+
+PROMETHEUS_METRICS = [
+    ('phase_duration_seconds', 'seconds', 'Wall time spent in the phase during the last run'),
+    ('phase_bytes_in', 'bytes_in', 'Bytes read by the phase during the last run'),
+    ('phase_bytes_out', 'bytes_out', 'Bytes written (or sent) by the phase during the last run'),
+    ('phase_files', 'files', 'Files handled by the phase during the last run'),
+    ('phase_count', 'count', 'Times the phase ran during the last run'),
+    ('phase_compression_ratio', 'compression_ratio', 'Bytes out over bytes in for the phase during the last run'),
+    ('phase_stored_bytes', 'stored_bytes', 'File bytes archived without compression during the last run'),
+    ('phase_compressed_bytes', 'compressed_bytes', 'File bytes archived with compression during the last run'),
+]
+
+
+class Run:
+    """Phase records of one web_backup.py or web_restore.py run."""
+
+    def __init__(self, script_name, website_name):
+        self.script_name = script_name
+        self.website_name = website_name
+        self.started = time.time()
+        self.phases = []
+
+
+_run = None
+
+
+def start_run(script_name, website_name):
+    global _run
+
+    _run = Run(script_name, website_name)
+    return _run
+
+
+def get_phases():
+    if _run is None:
+        return []
+    return list(_run.phases)
+
+
+@contextlib.contextmanager
+def phase(phase_name, **fields):
+    """Times the with block as one phase of the current run. The block fills in what it knows of the yielded record,
+    usually bytes_in, bytes_out and files; compression_ratio is worked out from the byte counts."""
+    record = {'phase': phase_name, 'started': time.time()}
+    record.update(fields)
+    try:
+        yield record
+    except BaseException:
+        record['failed'] = True
+        raise
+    finally:
+        record['seconds'] = time.time() - record['started']
+        if record.get('bytes_in') and record.get('bytes_out') is not None:
+            record['compression_ratio'] = float(record['bytes_out']) / record['bytes_in']
+        if _run is not None:
+            _run.phases.append(record)
+
+
+def get_phase_totals(phases):
+    totals = {}
+    for record in phases:
+        total = totals.setdefault(record['phase'], {'count': 0})
+        total['count'] += 1
+        for field in SUMMED_FIELDS:
+            if record.get(field) is not None:
+                total[field] = total.get(field, 0) + record[field]
+    for total in totals.values():
+        if total.get('bytes_in') and total.get('bytes_out') is not None:
+            total['compression_ratio'] = float(total['bytes_out']) / total['bytes_in']
+    return totals
+
+
+def finish(exit_code):
+    """Writes the run record (JSON) and Prometheus textfile for the current run, into the directories set in the
+    [metrics] section of web_backup.ini. Does nothing if no run was started or neither directory is set."""
+    global _run
+
+    if _run is None:
+        return
+    run = _run
+    _run = None
+    metrics_settings = config.get_config().metrics
+    run_record = {
+        'script': run.script_name,
+        'website_name': run.website_name,
+        'started': run.started,
+        'seconds': time.time() - run.started,
+        'exit_code': exit_code,
+        'success': exit_code in [0, None],
+        'phases': run.phases,
+        'totals': get_phase_totals(run.phases)
+    }
+    if metrics_settings.run_record_directory is not None:
+        filename = os.path.join(metrics_settings.run_record_directory, run.script_name + '_' + run.website_name +
+            '_' + datetime.datetime.fromtimestamp(run.started).strftime('%Y%m%d%H%M%S') + '.json')
+        write_file(filename, json.dumps(run_record, indent=2, sort_keys=True))
+    if metrics_settings.textfile_directory is not None:
+        filename = os.path.join(metrics_settings.textfile_directory, run.script_name + '_' + run.website_name +
+            '.prom')
+        write_file(filename, get_prometheus_text(run_record))
+
+
+def get_prometheus_text(run_record):
+    labels = 'script="' + escape_label(run_record['script']) + '",website="' + \
+        escape_label(run_record['website_name']) + '"'
+    lines = []
+    for metric_name, help_text, value in [
+            ('run_duration_seconds', 'Wall time of the last run', run_record['seconds']),
+            ('run_success', '1 if the last run exited successfully, otherwise 0', int(run_record['success'])),
+            ('run_timestamp_seconds', 'Unix time the last run finished', run_record['started'] +
+                run_record['seconds'])]:
+        lines.append('# HELP web_backup_' + metric_name + ' ' + help_text)
+        lines.append('# TYPE web_backup_' + metric_name + ' gauge')
+        lines.append('web_backup_' + metric_name + '{' + labels + '} ' + repr(float(value)))
+    totals = run_record['totals']
+    for metric_name, field, help_text in PROMETHEUS_METRICS:
+        phase_names = [x for x in sorted(totals) if field in totals[x]]
+        if len(phase_names) == 0:
+            continue
+        lines.append('# HELP web_backup_' + metric_name + ' ' + help_text)
+        lines.append('# TYPE web_backup_' + metric_name + ' gauge')
+        for phase_name in phase_names:
+            lines.append('web_backup_' + metric_name + '{' + labels + ',phase="' + escape_label(phase_name) + '"} ' +
+                repr(float(totals[phase_name][field])))
+    return '\n'.join(lines) + '\n'
+
+
+def escape_label(value):
+    return re.sub(r'(["\\])', r'\\\1', str(value)).replace('\n', '\\n')
+
+
+def write_file(filename, contents):
+    # Written under a temp name and renamed into place, so node_exporter never reads a half-written file
+    try:
+        with open(filename + '.tmp', 'w') as f:
+            f.write(contents)
+        os.rename(filename + '.tmp', filename)
+    except (IOError, OSError) as e:
+        logging.warning('Could not write metrics file ' + filename + ': ' + str(e))
@@ -0,0 +1,400 @@
+#!/usr/bin/env python
+
+import logging
+import threading
+import re
+import datetime
+import collections
+import hashlib
+import os
+import json
+import time
+from multiprocessing.pool import ThreadPool
+import pytz
+import boto3
+import botocore.exceptions
+import governor
+
+
+# S3 refuses multipart parts smaller than 5MB (except for the last part of an upload)
+MIN_PART_SIZE = 5 * 1024 * 1024
+
+# Most parts one multipart upload can have
+MAX_PARTS = 10000
+
+# A stream of unknown length doubles its part size every this many parts, up to MAX_STREAM_PART_SIZE. Starting
+# from MIN_PART_SIZE parts, that fits streams of about 780GB within MAX_PARTS
+PART_SIZE_DOUBLING_PARTS = 1000
+MAX_STREAM_PART_SIZE = 128 * 1024 * 1024
+
+# Most keys one DeleteObjects request takes
+MAX_DELETE_KEYS = 1000
+
+# One backup archive in a <website_name>/<folder_name>/ prefix. datetime_stamp is the YYYYMMDDHHMMSS from the key
+BackupObject = collections.namedtuple('BackupObject', ['key', 'datetime_stamp', 'last_modified', 'size'])
+
+
+def get_client(aws_access_key_id, aws_secret_access_key, aws_region_name):
+    return boto3.client('s3', aws_access_key_id=aws_access_key_id, aws_secret_access_key=aws_secret_access_key,
+        region_name=aws_region_name)
+
+
+def get_min_part_size(size):
+    # Smallest part size that fits size bytes into MAX_PARTS parts
+    return max(MIN_PART_SIZE, (size + MAX_PARTS - 1) // MAX_PARTS)
+
+
+def read_part(input_stream, part_size):
+    # A pipe can return short reads, so keep reading until a full part (or end of stream) is in hand
+    chunks = []
+    bytes_read = 0
+    while bytes_read < part_size:
+        chunk = input_stream.read(part_size - bytes_read)
+        if not chunk:
+            break
+        chunks.append(chunk)
+        bytes_read += len(chunk)
+    return ''.join(chunks)
+
+
+class MultipartUpload:
+    """Uploads a stream into S3 as a multipart upload. Parts are read from the stream sequentially and
+    handed to a pool of upload threads, so reading (and whatever produces the stream) overlaps with the upload."""
+
+    def __init__(self, s3_client, bucket_name, s3_key, part_size, num_workers):
+        self.s3_client = s3_client
+        self.bucket_name = bucket_name
+        self.s3_key = s3_key
+        self.part_size = max(part_size, MIN_PART_SIZE)
+        self.num_workers = max(num_workers, 1)
+        self.upload_id = None
+        self.parts = {}
+        self.bytes_uploaded = 0
+        self.sha256 = hashlib.sha256()
+        self._lock = threading.Lock()
+
+    def start(self):
+        response = self.s3_client.create_multipart_upload(Bucket=self.bucket_name, Key=self.s3_key)
+        self.upload_id = response['UploadId']
+        return self.upload_id
+
+    def resume(self, upload_id):
+        """Picks up an unfinished upload, keeping the parts S3 already has. Returns False if S3 no longer has it."""
+        parts = {}
+        try:
+            paginator = self.s3_client.get_paginator('list_parts')
+            for page in paginator.paginate(Bucket=self.bucket_name, Key=self.s3_key, UploadId=upload_id):
+                for part in page.get('Parts', []):
+                    parts[part['PartNumber']] = part['ETag']
+        except botocore.exceptions.ClientError as e:
+            if e.response['Error']['Code'] != 'NoSuchUpload':
+                raise
+            return False
+        self.upload_id = upload_id
+        self.parts = parts
+        return True
+
+    def upload_stream(self, input_stream, expected_size=None):
+        """Uploads input_stream. Given its expected_size, parts are sized up front to fit it within MAX_PARTS.
+        Otherwise, past every PART_SIZE_DOUBLING_PARTS parts the part size doubles, up to MAX_STREAM_PART_SIZE (or
+        part_size, if larger). At most 2 * num_workers parts are buffered at any time, so memory use is bounded by
+        2 * num_workers * the part size."""
+        if expected_size is not None:
+            self.part_size = max(self.part_size, get_min_part_size(expected_size))
+        if self.upload_id is None:
+            self.start()
+        pool = ThreadPool(self.num_workers)
+        buffered_parts = threading.BoundedSemaphore(self.num_workers * 2)
+        pending = []
+        part_number = 1
+        try:
+            while True:
+                if expected_size is None and part_number > 1 and (part_number - 1) % PART_SIZE_DOUBLING_PARTS == 0 \
+                        and self.part_size < MAX_STREAM_PART_SIZE:
+                    self.part_size = min(self.part_size * 2, MAX_STREAM_PART_SIZE)
+                data = read_part(input_stream, self.part_size)
+                # S3 needs at least one part, even when the stream turns out to be empty
+                if not data and part_number > 1:
+                    break
+                if part_number > MAX_PARTS:
+                    raise IOError('Stream for ' + self.s3_key + ' is over the ' + str(MAX_PARTS) + ' parts S3 allows')
+                self.sha256.update(data)
+                buffered_parts.acquire()
+                pending.append(pool.apply_async(self._upload_part_and_release, (part_number, data,
+                    buffered_parts)))
+                part_number += 1
+                if len(data) < self.part_size:
+                    break
+            for result in pending:
+                result.get()
+        finally:
+            pool.close()
+            pool.join()
+        return self.bytes_uploaded
+
+    def copy_object(self, source_key, source_size):
+        """Fills the upload with server-side copies of source_key, one part_size byte range per part, so an object
+        of any size (including over the 5GB single-request copy limit) is copied without passing through here."""
+        if self.upload_id is None:
+            self.start()
+        self.part_size = max(self.part_size, get_min_part_size(source_size))
+        ranges = [(i + 1, offset, min(offset + self.part_size, source_size) - 1)
+            for i, offset in enumerate(range(0, max(source_size, 1), self.part_size))]
+        pool = ThreadPool(self.num_workers)
+        try:
+            pending = [pool.apply_async(self.copy_part, (source_key,) + x) for x in ranges]
+            for result in pending:
+                result.get()
+        finally:
+            pool.close()
+            pool.join()
+
+    def copy_part(self, source_key, part_number, first_byte, last_byte):
+        response = self.s3_client.upload_part_copy(Bucket=self.bucket_name, Key=self.s3_key,
+            UploadId=self.upload_id, PartNumber=part_number,
+            CopySource={'Bucket': self.bucket_name, 'Key': source_key},
+            CopySourceRange='bytes=' + str(first_byte) + '-' + str(last_byte))
+        with self._lock:
+            self.parts[part_number] = response['CopyPartResult']['ETag']
+            self.bytes_uploaded += last_byte - first_byte + 1
+
+    def _upload_part_and_release(self, part_number, data, buffered_parts):
+        try:
+            self.upload_part(part_number, data)
+        finally:
+            buffered_parts.release()
+
+    def upload_part(self, part_number, data):
+        response = self.s3_client.upload_part(Bucket=self.bucket_name, Key=self.s3_key, UploadId=self.upload_id,
+            PartNumber=part_number, **governor.get_upload_args(data))
+        with self._lock:
+            self.parts[part_number] = response['ETag']
+            self.bytes_uploaded += len(data)
+        logging.info('Uploaded part ' + str(part_number) + ' (' + str(len(data)) + ' bytes) of ' + self.s3_key)
+
+    def complete(self):
+        part_list = [{'PartNumber': x, 'ETag': self.parts[x]} for x in sorted(self.parts)]
+        self.s3_client.complete_multipart_upload(Bucket=self.bucket_name, Key=self.s3_key, UploadId=self.upload_id,
+            MultipartUpload={'Parts': part_list})
+
+    def abort(self):
+        if self.upload_id is not None:
+            self.s3_client.abort_multipart_upload(Bucket=self.bucket_name, Key=self.s3_key,
+                UploadId=self.upload_id)
+            self.upload_id = None
+
+
+def copy_object(s3_client, bucket_name, source_key, dest_key, part_size, num_workers):
+    """Server-side copy within a bucket. Objects up to one part in size are copied with a single request, larger
+    ones with a parallel multipart copy."""
+    source_size = s3_client.head_object(Bucket=bucket_name, Key=source_key)['ContentLength']
+    if source_size <= max(part_size, MIN_PART_SIZE):
+        s3_client.copy_object(Bucket=bucket_name, Key=dest_key, CopySource={'Bucket': bucket_name,
+            'Key': source_key})
+        return source_size
+    upload = MultipartUpload(s3_client, bucket_name, dest_key, part_size, num_workers)
+    try:
+        upload.copy_object(source_key, source_size)
+        upload.complete()
+    except:
+        upload.abort()
+        raise
+    return source_size
+
+
+def delete_objects(s3_client, bucket_name, keys):
+    """Deletes keys with multi-object deletes, MAX_DELETE_KEYS per request. A key S3 refuses to delete doesn't fail
+    the others. Returns the list of keys deleted and a list of (key, error code, error message) for the rest."""
+    deleted_keys = []
+    errors = []
+    for i in range(0, len(keys), MAX_DELETE_KEYS):
+        batch = keys[i:i + MAX_DELETE_KEYS]
+        # In quiet mode the response lists only the keys that failed
+        response = s3_client.delete_objects(Bucket=bucket_name, Delete={'Objects': [{'Key': x} for x in batch],
+            'Quiet': True})
+        failed = {}
+        for error in response.get('Errors', []):
+            failed[error['Key']] = (error['Key'], error.get('Code', ''), error.get('Message', ''))
+        deleted_keys.extend([x for x in batch if x not in failed])
+        errors.extend([failed[x] for x in batch if x in failed])
+    return deleted_keys, errors
+
+
+def iter_objects(s3_client, bucket_name, prefix):
+    # Pages are fetched lazily, 1000 keys at a time, as the caller iterates
+    paginator = s3_client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket_name, Prefix=prefix):
+        for item in page.get('Contents', []):
+            yield item
+
+
+def get_backup_index(s3_client, bucket_name, website_name, folder_names):
+    """Lists only the <website_name>/<folder_name>/ prefixes of the bucket and returns a dict mapping each folder
+    name to its BackupObject list, oldest first. Keys that are not <YYYYMMDDHHMMSS>.zip archives (or .wba indexed
+    archives, or .snapshot manifests of incremental backups) are skipped."""
+    backup_index = {}
+    for folder_name in folder_names:
+        prefix = website_name + '/' + folder_name + '/'
+        backup_objects = []
+        for item in iter_objects(s3_client, bucket_name, prefix):
+            filename = item['Key'][len(prefix):]
+            if filename == '':
+                continue
+            match = re.match('([0-9]{14})\.(zip|wba|snapshot)$', filename)
+            if match is None:
+                logging.info('Unrecognized file in backup folder...ignoring: ' + item['Key'])
+                continue
+            try:
+                datetime.datetime.strptime(match.group(1), '%Y%m%d%H%M%S')
+            except ValueError:
+                logging.info('ZIP file with invalid datetime format...ignoring: ' + item['Key'])
+                continue
+            backup_objects.append(BackupObject(item['Key'], match.group(1), item['LastModified'], item['Size']))
+        backup_objects.sort(key=lambda x: x.last_modified)
+        backup_index[folder_name] = backup_objects
+    return backup_index
+
+
+def load_upload_checkpoint(checkpoint_filename):
+    if not os.path.isfile(checkpoint_filename):
+        return None
+    with open(checkpoint_filename) as f:
+        return json.load(f)
+
+
+def get_file_identity(filename):
+    # An upload is only resumed from the very file it started with
+    file_stat = os.stat(filename)
+    return {'filename': os.path.abspath(filename), 'size': file_stat.st_size, 'mtime': file_stat.st_mtime}
+
+
+def upload_file(s3_client, bucket_name, s3_key, filename, part_size, num_workers, checkpoint_filename, **fields):
+    """Uploads filename as a multipart upload, num_workers parts at a time. The upload id and each completed part
+    are checkpointed in checkpoint_filename (along with any extra fields), so if the upload is interrupted, a later
+    call for the same file and key sends only the parts S3 doesn't have yet. The checkpoint is removed when the
+    upload completes; on failure the upload is left for resuming. Returns the number of bytes sent."""
+    identity = get_file_identity(filename)
+    size = identity['size']
+    part_size = max(part_size, get_min_part_size(size))
+    checkpoint = load_upload_checkpoint(checkpoint_filename)
+    upload = MultipartUpload(s3_client, bucket_name, s3_key, part_size, num_workers)
+    if checkpoint is not None and [checkpoint.get(x) for x in ['bucket', 'key', 'filename', 'size', 'mtime']] == \
+            [bucket_name, s3_key, identity['filename'], size, identity['mtime']]:
+        upload.part_size = checkpoint['part_size']
+        if upload.resume(checkpoint['upload_id']):
+            logging.info('Resuming upload of ' + s3_key + ', ' + str(len(upload.parts)) + ' parts already done')
+    elif checkpoint is not None:
+        logging.warning('Replacing upload checkpoint ' + checkpoint_filename + ' for ' + checkpoint.get('key', '') +
+            ', which is not an upload of ' + filename + ' to ' + s3_key)
+    if upload.upload_id is None:
+        upload.start()
+    checkpoint = dict(fields, bucket=bucket_name, key=s3_key, upload_id=upload.upload_id,
+        part_size=upload.part_size, **identity)
+    ranges = [(offset // upload.part_size + 1, offset, min(offset + upload.part_size, size) - offset)
+        for offset in range(0, max(size, 1), upload.part_size)]
+    lock = threading.Lock()
+
+    def save_checkpoint():
+        with lock:
+            checkpoint['parts'] = dict(upload.parts)
+            with open(checkpoint_filename + '.tmp', 'w') as f:
+                json.dump(checkpoint, f)
+            os.rename(checkpoint_filename + '.tmp', checkpoint_filename)
+
+    def upload_range(part_number, offset, length):
+        with open(filename, 'rb') as f:
+            f.seek(offset)
+            data = f.read(length)
+        upload.upload_part(part_number, data)
+        save_checkpoint()
+
+    save_checkpoint()
+    pool = ThreadPool(upload.num_workers)
+    try:
+        pending = [pool.apply_async(upload_range, x) for x in ranges if x[0] not in upload.parts]
+        for result in pending:
+            result.get()
+    finally:
+        pool.close()
+        pool.join()
+    upload.complete()
+    os.remove(checkpoint_filename)
+    return upload.bytes_uploaded
+
+
+def abort_stale_uploads(s3_client, bucket_name, prefix, max_age_hours, keep_upload_ids=()):
+    """Aborts multipart uploads under prefix started more than max_age_hours ago, other than keep_upload_ids. S3
+    keeps (and bills for) the parts of an unfinished upload until it is completed or aborted. Returns the keys of
+    the uploads aborted."""
+    cutoff = datetime.datetime.now(pytz.UTC) - datetime.timedelta(hours=max_age_hours)
+    aborted_keys = []
+    paginator = s3_client.get_paginator('list_multipart_uploads')
+    for page in paginator.paginate(Bucket=bucket_name, Prefix=prefix):
+        for item in page.get('Uploads', []):
+            if item['Initiated'] < cutoff and item['UploadId'] not in keep_upload_ids:
+                s3_client.abort_multipart_upload(Bucket=bucket_name, Key=item['Key'], UploadId=item['UploadId'])
+                aborted_keys.append(item['Key'])
+    return aborted_keys
+
+
+def download_object(s3_client, bucket_name, s3_key, filename, part_size, num_workers, num_retries=3):
+    """Downloads an object with concurrent ranged GETs, each part written straight to its offset in filename.
+    Completed parts are checkpointed in <filename>.parts, so a download that is interrupted resumes with only the
+    missing parts as long as the object is unchanged. Each part is retried up to num_retries times."""
+    head = s3_client.head_object(Bucket=bucket_name, Key=s3_key)
+    size = head['ContentLength']
+    etag = head['ETag']
+    part_size = max(part_size, 1024 * 1024)
+    state_filename = filename + '.parts'
+    state = {'etag': etag, 'size': size, 'part_size': part_size, 'done': []}
+    if os.path.isfile(state_filename) and os.path.isfile(filename):
+        with open(state_filename) as f:
+            saved_state = json.load(f)
+        if [saved_state[x] for x in ['etag', 'size', 'part_size']] == [etag, size, part_size]:
+            state = saved_state
+            logging.info('Resuming download of ' + s3_key + ', ' + str(len(state['done'])) + ' parts already done')
+    if len(state['done']) == 0:
+        with open(filename, 'wb') as f:
+            f.truncate(size)
+    done = set(state['done'])
+    ranges = [(offset, min(offset + part_size, size) - 1) for offset in range(0, size, part_size)
+        if offset // part_size not in done]
+    lock = threading.Lock()
+
+    def download_part(first_byte, last_byte):
+        attempt = 0
+        while True:
+            try:
+                response = s3_client.get_object(Bucket=bucket_name, Key=s3_key, IfMatch=etag,
+                    Range='bytes=' + str(first_byte) + '-' + str(last_byte))
+                data = response['Body'].read()
+                if len(data) != last_byte - first_byte + 1:
+                    raise IOError('Short read of bytes ' + str(first_byte) + '-' + str(last_byte))
+                break
+            except Exception as e:
+                attempt += 1
+                if attempt > num_retries:
+                    raise
+                logging.warning('Retrying bytes ' + str(first_byte) + '-' + str(last_byte) + ' of ' + s3_key +
+                    ' after error: ' + str(e))
+                time.sleep(2 ** attempt)
+        with open(filename, 'r+b') as f:
+            f.seek(first_byte)
+            f.write(data)
+        with lock:
+            state['done'].append(first_byte // part_size)
+            with open(state_filename + '.tmp', 'w') as f:
+                json.dump(state, f)
+            os.rename(state_filename + '.tmp', state_filename)
+
+    pool = ThreadPool(max(num_workers, 1))
+    try:
+        pending = [pool.apply_async(download_part, x) for x in ranges]
+        for result in pending:
+            result.get()
+    finally:
+        pool.close()
+        pool.join()
+    if os.path.isfile(state_filename):
+        os.remove(state_filename)
+    return size
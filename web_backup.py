@@ -8,13 +8,30 @@ import os
 import shutil
 import tempfile
 import subprocess
-import ConfigParser
 import re
 import calendar
 import boto3
 from util import util
+from util import s3
+from util import catalog
+from util import inventory
+from util import config
+from util import db_dump
+from util import metrics
+from util import manifest
+from util import chunk_store
+from util import binlog
+from util import governor
+from util import indexed_archive
+from util import compression
 import pytz
 import glob
+import json
+import time
+import hashlib
+import threading
+import multiprocessing
+from multiprocessing.pool import ThreadPool
 
 # Fake class only for purpose of limiting global namespace to the 'g' object
 class g:
@@ -26,9 +43,15 @@ class g:
     aws_secret_access_key = None
     aws_region_name = None
     aws_s3_bucket_name = None
-    reuse_output_filename = None
+    reuse_datetime_stamp = None
     website_directory = None
+    website_files = None
+    website_bytes = None
+    binlog_connection_args = None
     websites = None
+    catalog = None
+    report = None
+    config = None
 
 
 def main(argv):
@@ -36,7 +59,7 @@ def main(argv):
 
     parser = argparse.ArgumentParser()
     parser.add_argument('--output-filename', required=False,
-        help='Output ZIP filename. Defaults to ./tmp/<website_name>_[datetime_stamp].zip')
+        help='Output archive filename. Defaults to ./tmp/<website_name>_[datetime_stamp].wba')
     parser.add_argument('--message-output-filename', required=False, help='Filename of message output file. If ' \
         'unspecified, then messages are written to stderr as well as into the messages_[datetime_stamp].log file ' \
         'that is zipped into the resulting backup file.')
@@ -54,7 +77,8 @@ def main(argv):
     parser.add_argument('--retain-temp-directory', action='store_true', help='If specified, the temp directory ' +
         'with output from website directory and WordPress database is not deleted')
     parser.add_argument('--show-backups-to-do', action='store_true', help='If specified, the ONLY thing that is ' +
-        'done is backup posts and deletions to S3 are calculated and displayed')
+        'done is backup posts and deletions to S3 are calculated and displayed. Each backup retention would ' +
+        'delete is listed, and included in the --report-filename report as planned_deletions')
     parser.add_argument('--zip-file-password', required=False, help='If provided, overrides password used to encryt ' \
         'zip file that is created that was specified in web_backup.ini')
     parser.add_argument('--aws-s3-bucket-name', required=False, help='AWS S3 bucket where output backup zip files ' \
@@ -62,6 +86,27 @@ def main(argv):
     parser.add_argument('--notification-emails', required=False, nargs='*', default=argparse.SUPPRESS,
         help='If specified, list of email addresses that are emailed upon successful upload to AWS S3, along with ' \
         'accessor link to get at the backup zip file (which is encrypted)')
+    parser.add_argument('--reconcile-catalog', action='store_true', help='If specified, the ONLY thing that is ' \
+        'done is the local backup catalog (web_backup_catalog.db) is resynced against the website\'s backups in S3')
+    parser.add_argument('--all-sites', action='store_true', help='If specified, every website on this server is ' \
+        'backed up, several at a time, with the other options applied to each. Parallelism is limited by the ' \
+        '[concurrency] section of web_backup.ini. A combined report is output at the end')
+    parser.add_argument('--report-filename', required=False, help='If specified, a JSON summary of the run is ' \
+        'written to this file')
+    parser.add_argument('--force-backup', action='store_true', help='If specified, a new backup archive is built ' \
+        'even if the website files and database are unchanged since the last one (which is otherwise copied)')
+    parser.add_argument('--stream-to-s3', action='store_true', help='If specified, the encrypted backup archive is ' \
+        'not written to local disk. It is streamed into an AWS S3 multipart upload while it is being built, so ' \
+        'archiving and uploading overlap. Implies --post-to-s3')
+    parser.add_argument('--incremental', action='store_true', help='If specified, the website files and database ' \
+        'dump are stored in the website\'s encrypted chunk store in S3 instead of a zip archive. Only chunks the ' \
+        'store doesn\'t already have are uploaded, and each schedule folder gets a small .snapshot manifest that ' \
+        'web_restore.py rebuilds the website from. Implies --post-to-s3')
+    parser.add_argument('--binlog', action='store_true', help='If specified, the WordPress database is dumped in ' \
+        'full only every [database]binlog_full_dump_interval (and for backups going into any schedule folder but ' \
+        'the first). Other backups hold the MySQL binary log files written since the last full dump instead, which ' \
+        'web_restore.py replays (to a point in time with --stop-datetime). Needs binary logging on, and the ' \
+        '[database] user to have the RELOAD, REPLICATION CLIENT and REPLICATION SLAVE privileges')
 
     g.args = parser.parse_args()
 
@@ -69,7 +114,9 @@ def main(argv):
     if g.program_filename[-3:] == '.py':
                 g.program_filename = g.program_filename[:-3]
 
-    message_level = util.get_ini_setting('logging', 'level')
+    # web_backup.ini is parsed (and any errors in it reported) once, up front
+    g.config = config.get_config()
+    message_level = g.config.logging.level
 
     script_directory = os.path.dirname(os.path.realpath(__file__))
 
@@ -83,7 +130,21 @@ def main(argv):
 
     util.set_logger(message_level, g.message_output_filename, os.path.basename(__file__))
 
-    g.websites = util.get_websites()
+    # Rate caps, backing off under load, and a lower CPU and I/O priority for this run and its child processes
+    # ([throttle] section of web_backup.ini)
+    governor.start(g.config.throttle)
+
+    g.websites = inventory.get_websites()
+
+    if g.args.all_sites:
+        if g.args.website_name is not None or g.args.output_filename is not None:
+            message_error('--website-name and --output-filename cannot be used with --all-sites. Aborting!')
+            util.sys_exit(1)
+        exit_status = backup_all_sites(argv)
+        if not g.args.retain_temp_directory:
+            shutil.rmtree(g.temp_directory)
+        util.sys_exit(exit_status)
+
     if g.args.website_name is None or g.args.website_name not in g.websites.keys():
         if g.args.website_name is None:
             print 'NOTE:  --website-name of website to backup was not specified.'
@@ -91,32 +152,78 @@ def main(argv):
             print 'NOTE:  Specified website \'' + g.args.website_name + '\' is not a valid website on this server.'
         print 'Here\'s a list of websites configured on this server.'
         print
-        util.print_websites(g.websites)
+        inventory.print_websites(g.websites)
         util.sys_exit(0)
 
-    g.website_directory = g.websites[g.args.website_name]['document_root']
+    g.website_directory = g.websites[g.args.website_name].document_root
 
     # Don't do work that'd just get deleted
     if not g.args.post_to_s3 and g.args.delete_zip:
         message_error('Does not make sense to create zip file and delete it without posting to AWS S3. Aborting!')
         util.sys_exit(1)
 
+    # The backup runs from inside the website directory, so pin down a relative output filename now
+    if g.args.output_filename is not None:
+        g.args.output_filename = os.path.abspath(g.args.output_filename)
+
+    # A streamed backup never exists as a local archive file
+    if g.args.stream_to_s3 and (g.args.output_filename is not None or g.args.delete_zip):
+        message_error('--stream-to-s3 does not create a local archive file, so --output-filename and --delete-zip ' \
+            'cannot be used with it. Aborting!')
+        util.sys_exit(1)
+
+    # Nor does an incremental one
+    if g.args.incremental and (g.args.stream_to_s3 or g.args.output_filename is not None or g.args.delete_zip):
+        message_error('--incremental does not create an archive file, so --stream-to-s3, --output-filename and ' \
+            '--delete-zip cannot be used with it. Aborting!')
+        util.sys_exit(1)
+
+    # Archives (and an incremental backup's chunks) are AES-GCM encrypted in-process
+    if not indexed_archive.is_available():
+        message_error('web_backup.py needs the Python cryptography package (pip install cryptography). Aborting!')
+        util.sys_exit(1)
+    if not g.args.incremental and not compression.is_available(g.config.zip_file.codec):
+        message_error("[zip_file]codec '" + g.config.zip_file.codec + "' needs the Python zstandard package " \
+            '(pip install zstandard). Aborting!')
+        util.sys_exit(1)
+
+    # Binlog backups read the binary log and dump with the [database] user, as the WordPress user can't
+    if g.args.binlog:
+        if g.args.incremental:
+            message_error('--binlog cannot be used with --incremental. Aborting!')
+            util.sys_exit(1)
+        g.binlog_connection_args = binlog.get_connection_args(config.require(g.config.database.user, 'database',
+            'user'), config.require(g.config.database.password, 'database', 'password'), g.config.database.socket)
+
     # Load AWS creds which are used for checking need for backup and posting backup file
-    g.aws_access_key_id = util.get_ini_setting('aws', 'access_key_id', False)
-    g.aws_secret_access_key = util.get_ini_setting('aws', 'secret_access_key', False)
-    g.aws_region_name = util.get_ini_setting('aws', 'region_name', False)
+    g.aws_access_key_id = config.require(g.config.aws.access_key_id, 'aws', 'access_key_id')
+    g.aws_secret_access_key = config.require(g.config.aws.secret_access_key, 'aws', 'secret_access_key')
+    g.aws_region_name = config.require(g.config.aws.region_name, 'aws', 'region_name')
     if g.args.aws_s3_bucket_name is not None:
         g.aws_s3_bucket_name = g.args.aws_s3_bucket_name
     else:
-        g.aws_s3_bucket_name = util.get_ini_setting('aws', 's3_bucket_name', False)
+        g.aws_s3_bucket_name = config.require(g.config.aws.s3_bucket_name, 'aws', 's3_bucket_name')
 
     if g.args.zip_file_password is not None:
         g.zip_file_password = g.args.zip_file_password
     else:
-        g.zip_file_password = util.get_ini_setting('zip_file', 'password', False)
+        g.zip_file_password = config.require(g.config.zip_file.password, 'zip_file', 'password')
 
     # Call the base directory the name of the website
     website_name = os.path.basename(g.website_directory)
+    g.report = {'website_name': website_name, 'started': time.time(), 'backups': [], 'deleted': []}
+
+    # Uploads, copies and deletions are recorded in the local catalog, which answers backup planning queries
+    g.catalog = catalog.open_catalog()
+
+    if g.args.reconcile_catalog:
+        folder_names = [x.folder_name for x in g.config.schedules]
+        s3_client = s3.get_client(g.aws_access_key_id, g.aws_secret_access_key, g.aws_region_name)
+        num_added, num_removed = catalog.reconcile(g.catalog, s3_client, g.aws_s3_bucket_name, website_name,
+            folder_names)
+        message_info('Backup catalog resynced with S3. ' + str(num_added) + ' backups added and ' +
+            str(num_removed) + ' removed')
+        util.sys_exit(0)
 
     # Start with assumption no backups to do
     backups_to_do = None
@@ -124,78 +231,182 @@ def main(argv):
     # If user specified just to show work to be done (backups to do), calculate, display, and exit
     if g.args.show_backups_to_do:
         backups_to_do = get_backups_to_do(website_name)
+        g.report['planned_deletions'] = get_planned_deletions(backups_to_do)
         if backups_to_do is None:
             message_info('Backups in S3 are already up-to-date. Nothing to do')
+            write_report('up-to-date')
             util.sys_exit(0)
         else:
             message_info('There are backups/deletions to do')
             message_info('Backup plan details: ' + str(backups_to_do))
+            for planned_deletion in g.report['planned_deletions']:
+                message_info('Would delete from S3: ' + planned_deletion['key'] + ' (' +
+                    str(planned_deletion['size']) + ' bytes, ' + planned_deletion['last_modified'] + ')')
+            message_info(str(len(g.report['planned_deletions'])) + ' backups (' +
+                str(sum(x['size'] for x in g.report['planned_deletions'])) + ' bytes) would be deleted')
+            write_report('dry-run')
             util.sys_exit(0)
 
+    # Each phase from here on is timed and sized into the run's metrics (see the [metrics] section of web_backup.ini)
+    metrics.start_run(g.program_filename, website_name)
+
+    # An upload an earlier run didn't get to finish is completed first (its archive is still on disk), so it counts
+    # in this run's plan. Uploads abandoned longer ago than [aws]stale_upload_hours are aborted
+    if g.args.post_to_s3 or g.args.stream_to_s3 or g.args.incremental:
+        resume_pending_upload(website_name)
+        abort_stale_uploads(website_name)
+
     # See if there are backups to do
-    backups_to_do = get_backups_to_do(website_name)
+    with metrics.phase('plan'):
+        backups_to_do = get_backups_to_do(website_name)
 
-    # If we're posting to S3 and deleting the ZIP file, then utility has been run only for purpose of
-    # posting to S3. See if there are posts to be done and exit if not
-    if g.args.post_to_s3 and g.args.delete_zip and backups_to_do is None:
+    # If we're posting to S3 and deleting the ZIP file (or not making one), then utility has been run only for
+    # purpose of posting to S3. See if there are posts to be done and exit if not
+    posting_only = (g.args.post_to_s3 and g.args.delete_zip) or g.args.stream_to_s3 or g.args.incremental
+    if posting_only and backups_to_do is None:
         message_info('Backups in S3 are already up-to-date. Nothing to do. Exiting!')
+        write_report('up-to-date')
         util.sys_exit(0)
 
-    # Create ZIP file of website files
-    output_filename = g.temp_directory + '/files.zip'
+    # The website files are archived straight from the website directory along with the results files below
     os.chdir(g.website_directory)
     web_files = os.listdir(g.website_directory)
     if len(web_files) == 0:
         message_info('No files in directory ' + g.website_directory + '. Nothing to back up. Aborting.')
         util.sys_exit(1)
-    exec_zip_list = ['/usr/bin/zip', '-r', output_filename, '.']
-    message_info('Zipping website files directory')
-    FNULL = open(os.devnull, 'w')
-    exit_status = subprocess.call(exec_zip_list, stdout=FNULL)
-    if exit_status == 0:
-        message_info('Successfully zipped web directory to ' + output_filename)
-    else:
-        message_warning('Error running zip. Exit status ' + str(exit_status))
-
-    # Create .sql dump file from website's WordPress database (if applicable)
     wp_config_filename = g.website_directory + '/wp-config.php'
+    dict_db_info = None
     if os.path.isfile(wp_config_filename):
+        dict_db_info = get_wp_database_defines(wp_config_filename, ['DB_NAME', 'DB_USER', 'DB_PASSWORD', 'DB_HOST'])
+    with metrics.phase('site_scan') as record:
+        file_manifest = manifest.get_file_manifest(g.website_directory)
+        g.website_files = len([x for x in file_manifest if not x[0].endswith('/')])
+        g.website_bytes = sum(x[1] for x in file_manifest)
+        record['files'] = g.website_files
+        record['bytes_in'] = g.website_bytes
+
+    # A website whose files and database are unchanged since its last backup isn't zipped, dumped and uploaded
+    # again. Its schedule folders get server-side copies of the last archive instead
+    fingerprint = None
+    unchanged_s3_key = None
+    if posting_only and backups_to_do is not None:
+        fingerprint = get_backup_fingerprint(file_manifest, dict_db_info)
+        if fingerprint is not None and not g.args.force_backup:
+            unchanged_s3_key = catalog.get_fingerprinted_backup(g.catalog, g.aws_s3_bucket_name, website_name,
+                fingerprint)
+        if unchanged_s3_key is not None:
+            message_info('Website files and database are unchanged since backup ' + unchanged_s3_key + '. Copying ' +
+                'it instead of building a new backup')
+            g.report['unchanged_since'] = unchanged_s3_key
+
+    # Binlog backups between full dumps hold the binlog files written since the last full dump instead of a dump
+    binlog_base = None
+    binlog_full_dump = True
+    binlog_backup = g.args.binlog and dict_db_info is not None and unchanged_s3_key is None
+    if binlog_backup:
+        binlog_base, binlog_full_dump = get_binlog_plan(website_name, backups_to_do)
+        dump_db_info = dict(dict_db_info, DB_USER=g.config.database.user, DB_PASSWORD=g.config.database.password)
+    else:
+        dump_db_info = dict_db_info
+    dump_datetime = datetime.datetime.now().strftime(binlog.DATETIME_FORMAT)
+    dump_position = None
+
+    # Create .sql dump file from website's WordPress database (if applicable). With pymysql installed, tables are
+    # dumped in parallel into database/<table>.sql.gz files
+    dump_workers = g.config.database.dump_workers
+    dump_database = dict_db_info is not None and unchanged_s3_key is None and binlog_full_dump
+    parallel_dump = dump_database and dump_workers > 1 and db_dump.is_available()
+    if parallel_dump:
+        try:
+            unsupported_objects = db_dump.get_unsupported_objects(dump_db_info, g.config.database.socket)
+        except Exception as e:
+            message_error('Could not read views and triggers of database ' + dict_db_info['DB_NAME'] + ': ' + str(e))
+            util.sys_exit(1)
+        if len(unsupported_objects) > 0:
+            message_info('Database has objects the parallel dump does not include (' + ', '.join(unsupported_objects) +
+                '), so it is dumped with mysqldump instead')
+            parallel_dump = False
+    if parallel_dump:
+        message_info('Dumping WordPress MySQL database named ' + dict_db_info['DB_NAME'] + ', ' + str(dump_workers) +
+            ' tables at a time')
+        try:
+            with phase_slot('mysqldump'), metrics.phase('mysqldump') as record:
+                dump_manifest = db_dump.dump_database(dump_db_info, g.temp_directory + '/database', dump_workers,
+                    g.config.database.socket)
+                dump_position = dump_manifest['binlog_position']
+                record['files'] = len(dump_manifest['tables'])
+                record['rows'] = sum(x['rows'] for x in dump_manifest['tables'])
+                record['bytes_out'] = sum(x['bytes'] for x in dump_manifest['tables'])
+        except db_dump.SnapshotError as e:
+            # Tables dumped by separate connections are only consistent with each other under the global lock
+            message_info(str(e) + ', so the database is dumped with mysqldump instead')
+            parallel_dump = False
+        except Exception as e:
+            message_error(str(e))
+            util.sys_exit(1)
+    if parallel_dump:
+        message_info('Dumped ' + str(len(dump_manifest['tables'])) + ' tables (' +
+            str(sum(x['rows'] for x in dump_manifest['tables'])) + ' rows) in ' + '%.1f' % dump_manifest['seconds'] +
+            's')
+    elif dump_database:
         output_filename = g.temp_directory + '/database.sql'
-        dict_db_info = get_wp_database_defines(wp_config_filename,
-            ['DB_NAME', 'DB_USER', 'DB_PASSWORD', 'DB_HOST'])
         message_info('Dumping WordPress MySQL database named ' + dict_db_info['DB_NAME'])
-        mysqldump_string = '/bin/mysqldump -h ' + dict_db_info['DB_HOST'] + ' -u ' + dict_db_info['DB_USER'] + \
-            ' -p' + dict_db_info['DB_PASSWORD'] + ' ' + dict_db_info['DB_NAME'] + ' --add-drop-table -r ' + \
+        mysqldump_string = '/bin/mysqldump -h ' + dump_db_info['DB_HOST'] + ' -u ' + dump_db_info['DB_USER'] + \
+            ' -p' + dump_db_info['DB_PASSWORD'] + ' ' + dump_db_info['DB_NAME'] + ' --add-drop-table -r ' + \
             output_filename
+        if binlog_backup:
+            mysqldump_string += ' --single-transaction ' + binlog.get_dump_position_option()
         try:
-            exec_output = subprocess.check_output(mysqldump_string, stderr=subprocess.STDOUT, shell=True)
+            with phase_slot('mysqldump'), metrics.phase('mysqldump', files=1) as record:
+                exec_output = subprocess.check_output(mysqldump_string, stderr=subprocess.STDOUT, shell=True)
+                record['bytes_out'] = os.path.getsize(output_filename)
         except subprocess.CalledProcessError as e:
             print 'mysqldump exited with error status ' + str(e.returncode) + ' and error: ' + e.output
             util.sys_exit(1)
+        if binlog_backup:
+            dump_position = list(binlog.read_dump_position(output_filename))
 
-    # Generate final results output zip filename
-    if g.args.output_filename is not None:
+    if binlog_backup:
+        if binlog_full_dump and dump_position is None:
+            message_error('No binlog position for the database dump. Binlog backups need binary logging on, and ' \
+                'the [database] user to have the RELOAD privilege. Aborting!')
+            util.sys_exit(1)
+        write_binlog_backup(dict_db_info['DB_NAME'], binlog_base, binlog_full_dump, dump_position, dump_datetime)
+
+    # Generate final results output archive filename
+    if g.args.stream_to_s3 or g.args.incremental or unchanged_s3_key is not None:
+        output_filename = None
+    elif g.args.output_filename is not None:
         output_filename = g.args.output_filename
     elif g.args.delete_zip:
         # We're deleting it when we're done, so we don't care about its location/name. Grab temp filename
-        tmp_file = tempfile.NamedTemporaryFile(prefix='web_backup_', suffix='.zip', delete=False)
+        tmp_file = tempfile.NamedTemporaryFile(prefix='web_backup_', suffix=indexed_archive.EXTENSION, delete=False)
         output_filename = tmp_file.name
         tmp_file.close()
         os.remove(output_filename)
-        message_info('Temp filename used for final results zip output: ' + output_filename)
+        message_info('Temp filename used for final results archive output: ' + output_filename)
     else:
         output_filename = script_directory + '/tmp/' + website_name + '_' + \
-            datetime.datetime.now().strftime('%Y%m%d%H%M%S') + '.zip'
-
-    # Zip together results files to create final encrypted zip file
-    exec_zip_list = ['/usr/bin/zip', '-P', g.zip_file_password, '-j', '-r', output_filename, g.temp_directory + '/']
-    message_info('Zipping results files together')
-    exit_status = subprocess.call(exec_zip_list, stdout=FNULL)
-    if exit_status == 0:
-        message_info('Successfully zipped all results to temporary file ' + output_filename)
-    else:
-        message_error('Error running zip. Exit status ' + str(exit_status))
-        util.sys_exit(1)
+            datetime.datetime.now().strftime('%Y%m%d%H%M%S') + indexed_archive.EXTENSION
+
+    # Archive the website files and results files together into the final encrypted archive
+    if output_filename is not None:
+        message_info('Archiving website files and results files, ' + str(get_compression_workers()) +
+            ' compression workers')
+        try:
+            with phase_slot('zip'), metrics.phase('final_zip') as record:
+                with open(output_filename, 'wb') as output_file:
+                    archive_stats = write_archive(output_file)
+                for field in ['files', 'bytes_in', 'bytes_out', 'stored_bytes', 'compressed_bytes']:
+                    record[field] = archive_stats[field]
+        except (IOError, OSError) as e:
+            message_error('Error writing archive: ' + str(e))
+            util.sys_exit(1)
+        message_info('Successfully archived ' + str(archive_stats['files']) + ' files to ' + output_filename +
+            ' (' + str(archive_stats['bytes_out']) + ' bytes). Stored ' + str(archive_stats['stored_files']) +
+            ' files (' + str(archive_stats['stored_bytes']) + ' bytes) as is, compressed ' +
+            str(archive_stats['compressed_files']) + ' files (' + str(archive_stats['compressed_bytes']) +
+            ' bytes to ' + str(archive_stats['compressed_bytes_out']) + ') with ' + g.config.zip_file.codec)
 
     # Push ZIP file into appropriate schedule folders (daily, weekly, monthly, etc.) and then delete excess
     # backups in each folder
@@ -204,18 +415,50 @@ def main(argv):
         list_notification_emails = g.args.notification_emails
     else:
         list_notification_emails = None
-    if g.args.post_to_s3 and backups_to_do is not None:
+    if (g.args.post_to_s3 or g.args.stream_to_s3 or g.args.incremental) and backups_to_do is not None:
+        # The archive is only sent to S3 once (and not at all if the website is unchanged). Every other schedule
+        # folder gets a server-side copy of it
+        uploaded_s3_key = unchanged_s3_key
+        # (g.report['backups'] may already hold an upload resumed from an earlier run)
+        first_backup = True
         for folder_name in backups_to_do:
             if backups_to_do[folder_name]['do_backup']:
-                s3_key = upload_to_s3(website_name, folder_name, output_filename)
+                if uploaded_s3_key is not None:
+                    s3_key = copy_in_s3(uploaded_s3_key, website_name, folder_name)
+                elif g.args.stream_to_s3:
+                    s3_key = stream_to_s3(website_name, folder_name)
+                    uploaded_s3_key = s3_key
+                elif g.args.incremental:
+                    s3_key = post_snapshot(website_name, folder_name, file_manifest)
+                    uploaded_s3_key = s3_key
+                else:
+                    s3_key = upload_to_s3(website_name, folder_name, output_filename)
+                    uploaded_s3_key = s3_key
                 expiry_days = {'daily':1, 'weekly':7, 'monthly':31}[folder_name]
-                expiring_url = gen_s3_expiring_url(s3_key, expiry_days)
+                with metrics.phase('presign', key=s3_key):
+                    expiring_url = gen_s3_expiring_url(s3_key, expiry_days)
                 message_info('Backup URL ' + expiring_url + ' is valid for ' + str(expiry_days) + ' days')
                 list_completed_backups.append([folder_name, expiring_url, expiry_days])
-            for item_to_delete in backups_to_do[folder_name]['files_to_delete']:
-                delete_from_s3(item_to_delete)
+                g.report['backups'].append(s3_key)
+                # The newest copy is the one that survives retention longest, so future unchanged runs copy it
+                if fingerprint is not None and first_backup:
+                    catalog.record_fingerprint(g.catalog, g.aws_s3_bucket_name, website_name, fingerprint, s3_key)
+                # Binlog backups that follow replay from this one's dump
+                if binlog_backup and binlog_full_dump and first_backup:
+                    catalog.record_binlog_base(g.catalog, g.aws_s3_bucket_name, website_name, s3_key,
+                        dump_position[0], dump_position[1])
+                # ...and retention keeps that dump for as long as this one is kept
+                if binlog_backup and not binlog_full_dump:
+                    catalog.record_binlog_dependency(g.catalog, g.aws_s3_bucket_name, s3_key, binlog_base[0])
+                first_backup = False
+        # Excess backups are deleted once every folder's new backup is posted
+        prune_backups(backups_to_do)
+        # Chunks only referenced by deleted snapshots are deleted too
+        if len([x for x in g.report['deleted'] if chunk_store.is_snapshot_key(x)]) > 0:
+            collect_chunk_garbage(website_name)
         if list_notification_emails is not None:
-            send_email_notification(list_completed_backups, list_notification_emails)
+            with metrics.phase('email'):
+                send_email_notification(list_completed_backups, list_notification_emails)
 
     # If user asked not to retain temp directory, don't delete it!  Else, delete it
     if g.args.retain_temp_directory:
@@ -225,12 +468,12 @@ def main(argv):
         message_info('Temporary output directory deleted')
 
     # If user requested generated zip file be deleted, delete it
-    if g.args.delete_zip:
+    if g.args.delete_zip and output_filename is not None:
         os.remove(output_filename)
         message_info('Output final results zip file deleted')
 
     # If its a Wordpress site and user requested, after backup is complete, run /root/bin/update_and_secure_wp utility
-    if 'wordpress_database' in g.websites[g.args.website_name] and g.args.update_and_secure_wp:
+    if g.websites[g.args.website_name].wordpress_database is not None and g.args.update_and_secure_wp:
         message_info('Updating and (re)securing Wordpress after backup as requested')
         try:
             exec_output = subprocess.check_output('/root/bin/update_and_secure_wp ' + g.website_directory,
@@ -241,10 +484,177 @@ def main(argv):
             util.sys_exit(1)
 
     message_info('Done!')
+    write_report('ok')
 
     util.sys_exit(0)
 
 
+def backup_all_sites(argv):
+    global g
+
+    # Each website is backed up by its own child web_backup.py process (which keeps every run's temp directory,
+    # working directory and failures separate), a few at a time. The zip, mysqldump and upload phases inside the
+    # children are further limited by machine-wide slots (see phase_slot())
+    child_argv = [x for x in argv if x != '--all-sites']
+    for option in ['--report-filename', '--message-output-filename']:
+        if option in child_argv:
+            i = child_argv.index(option)
+            del child_argv[i:i + 2]
+    num_workers = g.config.concurrency.sites
+    website_names = sorted(g.websites.keys())
+    message_info('Backing up ' + str(len(website_names)) + ' websites, ' + str(num_workers) + ' at a time')
+    started = time.time()
+    pool = ThreadPool(num_workers)
+    try:
+        site_reports = pool.map(lambda x: backup_one_site(x, child_argv), website_names)
+    finally:
+        pool.close()
+        pool.join()
+    combined_report = {'started': started, 'duration': time.time() - started, 'sites': site_reports}
+
+    for site_report in site_reports:
+        if g.args.show_backups_to_do:
+            message_info(site_report['website_name'] + ': ' + str(len(site_report.get('planned_deletions', []))) +
+                ' backups would be deleted')
+            continue
+        message_info(site_report['website_name'] + ': ' + site_report['status'] + ' in ' +
+            str(int(site_report['duration'])) + 's, ' + str(len(site_report.get('backups', []))) + ' backups posted, ' +
+            str(len(site_report.get('deleted', []))) + ' deleted')
+    num_failed = len([x for x in site_reports if x['status'] == 'failed'])
+    message_info('All websites done in ' + str(int(combined_report['duration'])) + 's. ' + str(num_failed) +
+        ' failed')
+    if g.args.report_filename is not None:
+        with open(g.args.report_filename, 'w') as f:
+            json.dump(combined_report, f, indent=2)
+    if num_failed > 0:
+        return 1
+    return 0
+
+
+def backup_one_site(website_name, child_argv):
+    global g
+
+    report_filename = g.temp_directory + '/report_' + website_name + '.json'
+    output_filename = g.temp_directory + '/output_' + website_name + '.log'
+    exec_list = [sys.executable, os.path.realpath(__file__), '--website-name', website_name, '--report-filename',
+        report_filename] + child_argv
+    started = time.time()
+    with open(output_filename, 'w') as output_file:
+        exit_status = subprocess.call(exec_list, stdout=output_file, stderr=subprocess.STDOUT)
+    if os.path.isfile(report_filename):
+        with open(report_filename) as f:
+            site_report = json.load(f)
+    else:
+        site_report = {'website_name': website_name, 'status': 'ok'}
+    site_report['duration'] = time.time() - started
+    if exit_status != 0:
+        site_report['status'] = 'failed'
+        with open(output_filename) as f:
+            site_report['output'] = f.read()[-4000:]
+        message_error(website_name + ': backup failed with exit status ' + str(exit_status))
+    return site_report
+
+
+def write_report(status):
+    global g
+
+    if g.args.report_filename is None:
+        return
+    g.report['status'] = status
+    g.report['phases'] = metrics.get_phases()
+    g.report['throttle'] = governor.get_stats()
+    g.report['duration'] = time.time() - g.report['started']
+    with open(g.args.report_filename, 'w') as f:
+        json.dump(g.report, f, indent=2)
+
+
+def phase_slot(resource_name):
+    # Machine-wide cap on concurrent zip, mysqldump and upload work across all running backups
+    return util.resource_slot(resource_name, getattr(g.config.concurrency, resource_name))
+
+
+def get_backup_fingerprint(file_manifest, dict_db_info):
+    global g
+
+    # The zip password, archive format and codec go into the fingerprint so that changing any forces a new archive
+    table_checksums = []
+    if dict_db_info is not None:
+        try:
+            with metrics.phase('db_checksum') as record:
+                table_checksums = manifest.get_table_checksums(dict_db_info, g.config.database.socket)
+                record['files'] = len(table_checksums)
+        except Exception as e:
+            message_warning('Could not checksum WordPress database, so not checking for an unchanged website: ' +
+                str(e))
+            return None
+    return manifest.get_fingerprint(file_manifest, table_checksums, g.zip_file_password + indexed_archive.EXTENSION +
+        g.config.zip_file.codec)
+
+
+def get_binlog_plan(website_name, backups_to_do):
+    global g
+
+    # Returns the last full dump's (key, last_modified, binlog file, position), if binlog files can follow on from
+    # it, and whether this backup needs a full dump
+    binlog_base = catalog.get_binlog_base(g.catalog, g.aws_s3_bucket_name, website_name)
+    if binlog_base is None:
+        message_info('No earlier full database dump to follow with binlog files. Dumping in full')
+        return None, True
+    try:
+        binary_logs = binlog.get_binary_logs(g.binlog_connection_args)
+    except subprocess.CalledProcessError as e:
+        message_error('Could not list MySQL binary logs: ' + str(e))
+        util.sys_exit(1)
+    if binlog_base[2] not in binary_logs:
+        message_info('Binlog file ' + binlog_base[2] + ' of the last full database dump has been purged. Dumping in ' +
+            'full')
+        return None, True
+    if backups_to_do is None:
+        backups_to_do = {}
+    keys_to_delete = [y.key for x in backups_to_do.values() for y in x['files_to_delete']]
+    if binlog_base[0] in keys_to_delete:
+        message_info('Last full database dump ' + binlog_base[0] + ' is being deleted. Dumping in full')
+        return None, True
+    if binlog_base[1] < now_minus_delta_time(g.config.database.binlog_full_dump_interval):
+        message_info('Last full database dump is older than [database]binlog_full_dump_interval. Dumping in full')
+        return binlog_base, True
+    # Backups kept longer than the first folder's mustn't depend on an archive that will be deleted before them
+    first_folder_name = g.config.schedules[0].folder_name
+    if len([x for x in backups_to_do if x != first_folder_name and backups_to_do[x]['do_backup']]) > 0:
+        message_info('Backup is going into a schedule folder other than ' + first_folder_name + '. Dumping in full')
+        return binlog_base, True
+    message_info('Backing up binlog files written since full database dump ' + binlog_base[0])
+    return binlog_base, False
+
+
+def write_binlog_backup(database_name, binlog_base, binlog_full_dump, dump_position, dump_datetime):
+    global g
+
+    # Full dumps also carry the binlog since the previous full dump, so a restore to a point in time between the two
+    # can replay it on top of the previous dump
+    binlog_directory = g.temp_directory + '/' + binlog.BINLOG_DIRECTORY
+    binlog_manifest = {'database': database_name, 'dump_position': dump_position, 'dump_datetime': dump_datetime,
+        'base_key': None, 'base_position': None, 'files': [], 'format': binlog.SQL_FORMAT}
+    with metrics.phase('binlog_capture') as record:
+        if binlog_base is not None:
+            try:
+                binlog_manifest['files'] = binlog.capture(g.binlog_connection_args, binlog_base[2], binlog_base[3],
+                    database_name, binlog_directory)
+                binlog_manifest['base_key'] = binlog_base[0]
+                binlog_manifest['base_position'] = [binlog_base[2], binlog_base[3]]
+            except (binlog.BinlogError, subprocess.CalledProcessError) as e:
+                if not binlog_full_dump:
+                    message_error('Could not capture binlog files: ' + str(e))
+                    util.sys_exit(1)
+                message_warning('Could not capture binlog files since the last full dump: ' + str(e))
+        if not os.path.isdir(binlog_directory):
+            os.makedirs(binlog_directory)
+        binlog.write_manifest(binlog_directory, binlog_manifest)
+        record['files'], record['bytes_out'] = util.get_directory_size(binlog_directory)
+    message_info('Captured ' + str(len(binlog_manifest['files'])) + ' binlog files (' + str(record['bytes_out']) +
+        ' bytes)')
+
+
 def get_wp_database_defines(wp_config_filename, list_match_defines):
     dict_wp_database_defines = {}
     with open(wp_config_filename) as wp_config_file:
@@ -259,23 +669,257 @@ def get_wp_database_defines(wp_config_filename, list_match_defines):
     return dict_wp_database_defines
 
 
-def upload_to_s3(website_name, folder_name, output_filename):
+def get_s3_key(website_name, folder_name, extension):
     global g
 
-    # Cache and reuse exact same S3 filename even if upload_to_s3 called multiple times for daily, weekly, etc.
-    if g.reuse_output_filename is None:
-        g.reuse_output_filename = datetime.datetime.now().strftime('%Y%m%d%H%M%S') + '.zip'
+    # Cache and reuse exact same S3 filename even if called multiple times for daily, weekly, etc.
+    if g.reuse_datetime_stamp is None:
+        g.reuse_datetime_stamp = datetime.datetime.now().strftime('%Y%m%d%H%M%S')
 
-    s3_key = website_name + '/' + folder_name + '/' + g.reuse_output_filename
-    s3 = boto3.resource('s3', aws_access_key_id=g.aws_access_key_id, aws_secret_access_key=g.aws_secret_access_key,
-        region_name=g.aws_region_name)
-    data = open(output_filename, 'rb')
-    bucket = s3.Bucket(g.aws_s3_bucket_name)
-    bucket.put_object(Key=s3_key, Body=data)
+    return website_name + '/' + folder_name + '/' + g.reuse_datetime_stamp + extension
+
+
+def upload_to_s3(website_name, folder_name, output_filename):
+    global g
+
+    # Archives bigger than a part go up as a checkpointed multipart upload, which the next run resumes if this one
+    # is cut short
+    s3_key = get_s3_key(website_name, folder_name, indexed_archive.EXTENSION)
+    part_size = g.config.aws.multipart_part_size_mb * 1024 * 1024
+    with phase_slot('upload'), metrics.phase('s3_upload', key=s3_key, files=1) as record:
+        if os.path.getsize(output_filename) > part_size:
+            s3_client = s3.get_client(g.aws_access_key_id, g.aws_secret_access_key, g.aws_region_name)
+            try:
+                record['bytes_out'] = s3.upload_file(s3_client, g.aws_s3_bucket_name, s3_key, output_filename,
+                    part_size, g.config.aws.upload_workers, get_upload_checkpoint_filename(website_name),
+                    delete_archive=g.args.delete_zip)
+            except Exception as e:
+                message_error('Upload to S3 of ' + s3_key + ' failed, the next run will resume it: ' + str(e))
+                util.sys_exit(1)
+        else:
+            s3_resource = boto3.resource('s3', aws_access_key_id=g.aws_access_key_id,
+                aws_secret_access_key=g.aws_secret_access_key, region_name=g.aws_region_name)
+            data = open(output_filename, 'rb')
+            bucket = s3_resource.Bucket(g.aws_s3_bucket_name)
+            bucket.put_object(Key=s3_key, **governor.get_upload_args(data))
+            record['bytes_out'] = os.path.getsize(output_filename)
+    catalog.record_upload(g.catalog, g.aws_s3_bucket_name, s3_key, os.path.getsize(output_filename),
+        util.get_file_checksum(output_filename))
     message_info('Uploaded to S3: ' + s3_key)
     return s3_key
 
 
+def get_compression_workers():
+    global g
+
+    # Blocks are compressed and encrypted on several cores at once ([zip_file]compression_workers, 0 for one per core)
+    if g.config.zip_file.compression_workers == 0:
+        return multiprocessing.cpu_count()
+    return g.config.zip_file.compression_workers
+
+
+def write_archive(output_file):
+    global g
+
+    # Website files go under files/, then the results files with the messages log last, so that it captures as much
+    # of the run as possible. Blocks are compressed with [zip_file]codec, except already-compressed media, which is
+    # stored as is ([zip_file]store_extensions and store_sample_percent)
+    writer = indexed_archive.ArchiveWriter(output_file, g.zip_file_password,
+        compression.Codec(g.config.zip_file.codec, g.config.zip_file.compression_level),
+        [x.lower() for x in g.config.zip_file.store_extensions], g.config.zip_file.store_sample_percent,
+        get_compression_workers())
+    writer.add_directory('files/', os.stat(g.website_directory))
+    writer.add_tree(g.website_directory, 'files/', True)
+    for name in sorted(os.listdir(g.temp_directory), key=lambda x: x.endswith('.log')):
+        path = os.path.join(g.temp_directory, name)
+        if os.path.isdir(path):
+            writer.add_directory(name + '/', os.stat(path))
+            writer.add_tree(path, name + '/')
+        else:
+            writer.add_path(name, path, os.stat(path))
+    return writer.close()
+
+
+def get_upload_checkpoint_filename(website_name):
+    # Kept next to the backup catalog, as it has to outlive the run's temp directory
+    return os.path.dirname(os.path.realpath(__file__)) + '/web_backup_upload_' + website_name + '.json'
+
+
+def resume_pending_upload(website_name):
+    global g
+
+    checkpoint_filename = get_upload_checkpoint_filename(website_name)
+    checkpoint = s3.load_upload_checkpoint(checkpoint_filename)
+    if checkpoint is None or checkpoint['bucket'] != g.aws_s3_bucket_name:
+        return
+    s3_client = s3.get_client(g.aws_access_key_id, g.aws_secret_access_key, g.aws_region_name)
+    if not os.path.isfile(checkpoint['filename']) or s3.get_file_identity(checkpoint['filename'])['mtime'] != \
+            checkpoint['mtime']:
+        message_warning('Archive ' + checkpoint['filename'] + ' of unfinished upload ' + checkpoint['key'] +
+            ' is gone or changed, so the upload is abandoned')
+        try:
+            s3_client.abort_multipart_upload(Bucket=checkpoint['bucket'], Key=checkpoint['key'],
+                UploadId=checkpoint['upload_id'])
+        except Exception as e:
+            message_warning('Could not abort upload ' + checkpoint['key'] + ': ' + str(e))
+        os.remove(checkpoint_filename)
+        return
+    message_info('Resuming unfinished upload of ' + checkpoint['filename'] + ' to S3: ' + checkpoint['key'])
+    with phase_slot('upload'), metrics.phase('s3_upload', key=checkpoint['key'], files=1, resumed=True) as record:
+        try:
+            record['bytes_out'] = s3.upload_file(s3_client, checkpoint['bucket'], checkpoint['key'],
+                checkpoint['filename'], checkpoint['part_size'], g.config.aws.upload_workers, checkpoint_filename,
+                delete_archive=checkpoint['delete_archive'])
+        except Exception as e:
+            message_error('Resuming upload to S3 of ' + checkpoint['key'] + ' failed: ' + str(e))
+            util.sys_exit(1)
+    catalog.record_upload(g.catalog, checkpoint['bucket'], checkpoint['key'], checkpoint['size'],
+        util.get_file_checksum(checkpoint['filename']))
+    g.report['backups'].append(checkpoint['key'])
+    message_info('Uploaded to S3: ' + checkpoint['key'] + ' (' + str(record['bytes_out']) + ' bytes sent to ' +
+        'finish it)')
+    if checkpoint['delete_archive']:
+        os.remove(checkpoint['filename'])
+
+
+def abort_stale_uploads(website_name):
+    global g
+
+    if g.config.aws.stale_upload_hours == 0:
+        return
+    s3_client = s3.get_client(g.aws_access_key_id, g.aws_secret_access_key, g.aws_region_name)
+    with metrics.phase('upload_cleanup') as record:
+        try:
+            aborted_keys = s3.abort_stale_uploads(s3_client, g.aws_s3_bucket_name, website_name + '/',
+                g.config.aws.stale_upload_hours)
+        except Exception as e:
+            message_warning('Could not clean up unfinished uploads: ' + str(e))
+            return
+        record['files'] = len(aborted_keys)
+    for key in aborted_keys:
+        message_info('Aborted unfinished upload to S3 older than ' + str(g.config.aws.stale_upload_hours) +
+            ' hours: ' + key)
+
+
+def stream_to_s3(website_name, folder_name):
+    global g
+
+    # The archive is written on a thread into a pipe, which the multipart upload reads parts from as they fill
+    s3_key = get_s3_key(website_name, folder_name, indexed_archive.EXTENSION)
+    part_size = g.config.aws.multipart_part_size_mb * 1024 * 1024
+    num_workers = g.config.aws.upload_workers
+    s3_client = s3.get_client(g.aws_access_key_id, g.aws_secret_access_key, g.aws_region_name)
+    upload = s3.MultipartUpload(s3_client, g.aws_s3_bucket_name, s3_key, part_size, num_workers)
+    message_info('Archiving and streaming backup to S3: ' + s3_key)
+    read_fd, write_fd = os.pipe()
+    archive_results = []
+
+    def write_archive_to_pipe():
+        try:
+            with os.fdopen(write_fd, 'wb') as output_file:
+                archive_results.append(write_archive(output_file))
+        except Exception as e:
+            archive_results.append(e)
+
+    writer_thread = threading.Thread(target=write_archive_to_pipe)
+    writer_thread.daemon = True
+    with phase_slot('zip'), phase_slot('upload'), metrics.phase('s3_stream', key=s3_key) as record:
+        try:
+            writer_thread.start()
+            with os.fdopen(read_fd, 'rb') as input_stream:
+                upload.upload_stream(input_stream)
+            writer_thread.join()
+            if isinstance(archive_results[0], Exception):
+                raise archive_results[0]
+            upload.complete()
+            record['files'] = archive_results[0]['files']
+            record['bytes_in'] = archive_results[0]['bytes_in']
+            record['bytes_out'] = upload.bytes_uploaded
+        except Exception as e:
+            upload.abort()
+            message_error('Streaming backup to S3 failed: ' + str(e))
+            util.sys_exit(1)
+    catalog.record_upload(g.catalog, g.aws_s3_bucket_name, s3_key, upload.bytes_uploaded,
+        upload.sha256.hexdigest())
+    message_info('Streamed to S3: ' + s3_key + ' (' + str(upload.bytes_uploaded) + ' bytes)')
+    return s3_key
+
+
+def open_chunk_store(website_name, create=False):
+    global g
+
+    s3_client = s3.get_client(g.aws_access_key_id, g.aws_secret_access_key, g.aws_region_name)
+    store = chunk_store.ChunkStore(s3_client, g.aws_s3_bucket_name, website_name, g.zip_file_password,
+        g.config.aws.upload_workers)
+    store.open(create)
+    return store
+
+
+def post_snapshot(website_name, folder_name, file_manifest):
+    global g
+
+    # Files unchanged since the latest snapshot reuse its chunk lists without being read again
+    s3_key = get_s3_key(website_name, folder_name, chunk_store.SNAPSHOT_EXTENSION)
+    message_info('Storing incremental backup in chunk store: ' + s3_key)
+    try:
+        with phase_slot('upload'), metrics.phase('snapshot', key=s3_key) as record:
+            store = open_chunk_store(website_name, create=True)
+            previous_snapshot = None
+            snapshot_keys = catalog.get_snapshot_keys(g.catalog, g.aws_s3_bucket_name, website_name)
+            if len(snapshot_keys) > 0:
+                try:
+                    previous_snapshot = store.get_snapshot(snapshot_keys[-1])
+                except Exception as e:
+                    message_warning('Could not read previous snapshot ' + snapshot_keys[-1] + ', so reading every ' +
+                        'file: ' + str(e))
+            snapshot, stats = chunk_store.make_snapshot(store, g.website_directory, file_manifest, g.temp_directory,
+                manifest.get_file_manifest(g.temp_directory), previous_snapshot)
+            body = store.encode_snapshot(snapshot)
+            store.s3_client.put_object(Bucket=g.aws_s3_bucket_name, Key=s3_key, Body=body)
+            store.commit()
+            for field in ['files', 'bytes_in', 'reused_files', 'chunked_bytes', 'new_chunks']:
+                record[field] = stats[field]
+            record['bytes_out'] = stats['uploaded_bytes'] + len(body)
+    except Exception as e:
+        message_error('Storing incremental backup failed: ' + str(e))
+        util.sys_exit(1)
+    catalog.record_upload(g.catalog, g.aws_s3_bucket_name, s3_key, len(body), hashlib.sha256(body).hexdigest())
+    message_info('Stored snapshot ' + s3_key + ': ' + str(stats['files']) + ' files, ' + str(stats['reused_files']) +
+        ' unchanged, ' + str(stats['chunked_bytes']) + ' bytes read, ' + str(stats['new_chunks']) + ' new chunks (' +
+        str(stats['uploaded_bytes']) + ' bytes uploaded)')
+    return s3_key
+
+
+def collect_chunk_garbage(website_name):
+    global g
+
+    try:
+        with metrics.phase('chunk_gc') as record:
+            store = open_chunk_store(website_name)
+            record['files'] = store.collect_garbage()
+    except Exception as e:
+        # Unreferenced chunks only cost storage, and the next run's collection will get them. Nothing is deleted
+        # unless every snapshot in S3 could be read
+        message_warning('Could not delete unreferenced chunks: ' + str(e))
+        return
+    message_info('Deleted ' + str(record['files']) + ' chunks no longer referenced by any snapshot')
+
+
+def copy_in_s3(source_s3_key, website_name, folder_name):
+    global g
+
+    s3_key = get_s3_key(website_name, folder_name, os.path.splitext(source_s3_key)[1])
+    part_size = g.config.aws.multipart_part_size_mb * 1024 * 1024
+    num_workers = g.config.aws.upload_workers
+    s3_client = s3.get_client(g.aws_access_key_id, g.aws_secret_access_key, g.aws_region_name)
+    with metrics.phase('s3_copy', key=s3_key, files=1) as record:
+        size = s3.copy_object(s3_client, g.aws_s3_bucket_name, source_s3_key, s3_key, part_size, num_workers)
+        record['bytes_out'] = size
+    catalog.record_upload(g.catalog, g.aws_s3_bucket_name, s3_key, size, None, source_key=source_s3_key)
+    message_info('Copied in S3: ' + source_s3_key + ' to ' + s3_key)
+    return s3_key
+
+
 def gen_s3_expiring_url(s3_key, expiry_days):
     global g
 
@@ -286,10 +930,49 @@ def gen_s3_expiring_url(s3_key, expiry_days):
     return url
 
 
-def delete_from_s3(item_to_delete):
-    item_to_delete_key = item_to_delete.key
-    item_to_delete.delete()
-    message_info('Deleted from S3: ' + item_to_delete_key)
+def prune_backups(backups_to_do):
+    global g
+
+    # Each folder's excess backups go in multi-object deletes (up to 1000 keys a request), all folders at once
+    folder_names = [x for x in backups_to_do if len(backups_to_do[x]['files_to_delete']) > 0]
+    if len(folder_names) == 0:
+        return
+    s3_client = s3.get_client(g.aws_access_key_id, g.aws_secret_access_key, g.aws_region_name)
+    pool = ThreadPool(len(folder_names))
+    try:
+        results = pool.map(lambda x: delete_from_s3(s3_client, x, backups_to_do[x]['files_to_delete']),
+            folder_names)
+    finally:
+        pool.close()
+        pool.join()
+
+    # The catalog's sqlite connection belongs to this thread, so deletions are recorded here
+    for deleted_keys, errors in results:
+        for key in deleted_keys:
+            catalog.record_deletion(g.catalog, g.aws_s3_bucket_name, key)
+            g.report['deleted'].append(key)
+            message_info('Deleted from S3: ' + key)
+        for key, code, message in errors:
+            message_error('Could not delete from S3: ' + key + ' (' + code + ': ' + message + ')')
+            g.report.setdefault('delete_errors', []).append({'key': key, 'code': code, 'message': message})
+
+
+def delete_from_s3(s3_client, folder_name, items_to_delete):
+    global g
+
+    with metrics.phase('s3_delete', folder=folder_name, files=len(items_to_delete)) as record:
+        deleted_keys, errors = s3.delete_objects(s3_client, g.aws_s3_bucket_name, [x.key for x in items_to_delete])
+        deleted_key_set = set(deleted_keys)
+        record['bytes_in'] = sum(x.size for x in items_to_delete if x.key in deleted_key_set)
+    return deleted_keys, errors
+
+
+def get_planned_deletions(backups_to_do):
+    # What retention would delete, for --show-backups-to-do
+    if backups_to_do is None:
+        return []
+    return [{'folder': x, 'key': y.key, 'size': y.size, 'last_modified': str(y.last_modified)}
+        for x in sorted(backups_to_do) for y in backups_to_do[x]['files_to_delete']]
 
 
 def send_email_notification(list_completed_backups, list_notification_emails):
@@ -312,50 +995,22 @@ def send_email_notification(list_completed_backups, list_notification_emails):
 def get_backups_to_do(website_name):
     global g
 
-    schedules_by_folder_name = {x['folder_name']:x for x in get_schedules_from_ini()}
-    s3 = boto3.resource('s3', aws_access_key_id=g.aws_access_key_id, aws_secret_access_key=g.aws_secret_access_key,
-        region_name=g.aws_region_name)
+    schedules_by_folder_name = {x['folder_name']:x for x in get_schedules()}
+    s3_client = s3.get_client(g.aws_access_key_id, g.aws_secret_access_key, g.aws_region_name)
 
-    # In S3, folder items end with '/', whereas files do not
-    file_items = [item for item in s3.Bucket(g.aws_s3_bucket_name).objects.all() if item.key[-1] != '/']
-    files_per_folder_dict = {}
-    for file_item in file_items:
-        path_sects = file_item.key.split('/')
-        if len(path_sects) == 3:
-            if path_sects[0] == website_name:
-                if path_sects[1] in schedules_by_folder_name:
-                    filename = path_sects[2]
-                    match = re.match('([0-9]{14})\.zip', filename)
-                    if match is not None:
-                        valid_date = True
-                        try:
-                            datetime.datetime.strptime(match.group(1), '%Y%m%d%H%M%S')
-                        except:
-                            valid_date = False
-                        if valid_date:
-                            if path_sects[1] not in files_per_folder_dict:
-                                files_per_folder_dict[path_sects[1]] = [file_item]
-                            else:
-                                files_per_folder_dict[path_sects[1]].append(file_item)
-                        else:
-                            message_info('ZIP file with invalid datetime format...ignoring: ' + file_item.key)
-                    else:
-                        message_info('Unrecognized file in backup folder...ignoring: ' + file_item.key)
-                else:
-                    message_info('Unrecognized folder or file in web_backups S3 bucket...ignoring: ' + file_item.key)
-            # else:
-            #     message_info('Non-matching folder or file in web_backups S3 bucket with long path...ignoring: ' +
-            #         file_item.key)
-        else:
-            message_info('Found folder that is not part of this website backup area: ' +
-                file_item.key)
+    # Backups are looked up in the local catalog. Only folders the catalog has never seen are listed in S3, and
+    # then only this website's prefix of the bucket
+    catalog.ensure_reconciled(g.catalog, s3_client, g.aws_s3_bucket_name, website_name,
+        schedules_by_folder_name.keys())
+    files_per_folder_dict = catalog.get_backup_index(g.catalog, g.aws_s3_bucket_name, website_name,
+        schedules_by_folder_name.keys())
     backups_to_post_dict = {}
     for folder_name in schedules_by_folder_name:
         num_files_to_keep = schedules_by_folder_name[folder_name]['num_files_to_keep']
         files_to_delete = []
         do_backup = True
-        if folder_name in files_per_folder_dict:
-            sorted_by_last_modified_list = sorted(files_per_folder_dict[folder_name], key=lambda x: x.last_modified)
+        if len(files_per_folder_dict[folder_name]) > 0:
+            sorted_by_last_modified_list = files_per_folder_dict[folder_name]
             num_files = len(sorted_by_last_modified_list)
             if schedules_by_folder_name[folder_name]['backup_after_datetime'] < \
                sorted_by_last_modified_list[num_files - 1].last_modified:
@@ -377,45 +1032,36 @@ def get_backups_to_do(website_name):
                     files_to_delete = sorted_by_last_modified_list[0:num_files - num_files_to_keep + kicker]
         if do_backup or len(files_to_delete) > 0:
             backups_to_post_dict[folder_name] = {'do_backup': do_backup, 'files_to_delete': files_to_delete}
+
+    # A full dump that binlog backups replay on top of is kept until the last of them is deleted
+    keys_to_delete = set(y.key for x in backups_to_post_dict.values() for y in x['files_to_delete'])
+    needed_base_keys = set(x[1] for x in catalog.get_binlog_dependencies(g.catalog, g.aws_s3_bucket_name,
+        website_name) if x[0] not in keys_to_delete)
+    for folder_name in backups_to_post_dict.keys():
+        files_to_delete = backups_to_post_dict[folder_name]['files_to_delete']
+        for backup_object in [x for x in files_to_delete if x.key in needed_base_keys]:
+            message_info(folder_name + ': keeping ' + backup_object.key + ', the full database dump of binlog ' +
+                'backups still kept')
+        files_to_delete = [x for x in files_to_delete if x.key not in needed_base_keys]
+        backups_to_post_dict[folder_name]['files_to_delete'] = files_to_delete
+        if not backups_to_post_dict[folder_name]['do_backup'] and len(files_to_delete) == 0:
+            del backups_to_post_dict[folder_name]
     if len(backups_to_post_dict) > 0:
         return backups_to_post_dict
     else:
         return None
 
 
-def get_schedules_from_ini():
-    config_file_path = os.path.dirname(os.path.abspath(__file__)) + '/web_backup.ini'
-    config_parser = ConfigParser.ConfigParser()
-    config_parser.read(config_file_path)
+def get_schedules():
+    global g
+
     schedules = []
     curr_datetime = datetime.datetime.now(pytz.UTC)
     message_info('Current UTC datetime: ' + str(curr_datetime))
-    for schedule in config_parser.items('schedules'):
-        schedule_parms = schedule[1].split(',')
-        if len(schedule_parms) != 3:
-            message_error("web_backup.ini [schedules] entry '" + schedule[0] + '=' + schedule[1] + "' is invalid. " \
-                "Must contain 3 comma-separated fields. Aborting!")
-            util.sys_exit(1)
-        folder_name = schedule_parms[0].strip()
-        delta_time_string = schedule_parms[1].strip()
-        num_files_to_keep_string = schedule_parms[2].strip()
-        try:
-            num_files_to_keep = int(num_files_to_keep_string)
-        except:
-            message_error("web_backup.ini [schedules] entry '" + schedule[0] + '=' + schedule[1] + "' is " \
-                "invalid. '" + num_files_to_keep_string + "' must be a positive integer")
-            util.sys_exit(1)
-        if num_files_to_keep < 0:
-                message_error("web_backup.ini [schedules] entry '" + schedule[0] + '=' + schedule[1] + "' is " \
-                "invalid. Specified a negative number of files to keep")
-                util.sys_exit(1)
-        backup_after_datetime = now_minus_delta_time(delta_time_string)
-        if backup_after_datetime is None:
-            message_error("web_backup.ini [schedules] entry '" + schedule[0] + '=' + schedule[1] + "' contains " \
-                "an invalid interval between backups '" + delta_time_string + "'. Aborting!")
-            util.sys_exit(1)
-        schedules.append({'folder_name': folder_name, 'backup_after_datetime': backup_after_datetime,
-            'num_files_to_keep': num_files_to_keep})
+    for schedule in g.config.schedules:
+        schedules.append({'folder_name': schedule.folder_name,
+            'backup_after_datetime': now_minus_delta_time(schedule.interval),
+            'num_files_to_keep': schedule.num_files_to_keep})
     return schedules
 
 
@@ -469,4 +1115,13 @@ def output_message(s, level):
 
 
 if __name__ == "__main__":
-    main(sys.argv[1:])
+    # The run's metrics are written however it exits
+    try:
+        main(sys.argv[1:])
+    except SystemExit as e:
+        metrics.finish(e.code)
+        raise
+    except:
+        metrics.finish(1)
+        raise
+    metrics.finish(0)
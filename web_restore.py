@@ -7,11 +7,28 @@ import boto3
 import datetime
 import os
 import argparse
-import urllib
 import tempfile
 import subprocess
 import shutil
+import json
+import zlib
+import time
+import itertools
+import threading
+import multiprocessing
+from multiprocessing.pool import ThreadPool
 from util import util
+from util import s3
+from util import catalog
+from util import inventory
+from util import config
+from util import archive
+from util import metrics
+from util import chunk_store
+from util import binlog
+from util import db_load
+from util import indexed_archive
+from util import compression
 
 
 # Fake class only for purpose of limiting global namespace to the 'g' object
@@ -19,6 +36,8 @@ class g:
     program_filename = None 
     websites = None
     message_output_filename = None
+    snapshot_directory = None
+    indexed_readers = {}
 
 
 def main(argv):
@@ -27,6 +46,12 @@ def main(argv):
     parser.add_argument('--from-website-backup-file', required=False, help='Input ZIP filename of a website '
         'backup file.')
     parser.add_argument('--from-s3-website-name', required=False, help='Name of website with backup archive in S3.')
+    parser.add_argument('--from-s3-key', required=False, help='S3 key of the backup archive (or incremental ' \
+        'backup .snapshot) to restore, e.g. example.com/weekly/20170101120000.snapshot. Defaults to the latest ' \
+        'daily backup of --from-s3-website-name')
+    parser.add_argument('--stop-datetime', required=False, help='If specified (as \'YYYY-MM-DD HH:MM:SS\', server ' \
+        'local time), the database of a binlog backup (web_backup.py --binlog) is restored as of that time. ' \
+        'Without --from-s3-key, the first daily backup made at or after that time is restored')
     parser.add_argument('--to-website-name', required=False, help='Name of local website to restore into.')
     parser.add_argument('--message-output-filename', required=False, help='Filename of message output file. If ' \
         'unspecified, then messages are written to stderr as well as into the messages_[datetime_stamp].log file ' \
@@ -44,6 +69,13 @@ def main(argv):
     parser.add_argument('--wp-user-password', required=False, help='If specified, if the restored site is a ' \
         'Wordpress site, and --wp-user is specified, then this password is used when creating specified wp-user if ' \
         'that user doesn\'t exist in MySQL')
+    parser.add_argument('--reconcile-catalog', action='store_true', help='If specified, the local backup catalog ' \
+        '(web_backup_catalog.db) is resynced against the website\'s backups in S3 before looking up the latest ' \
+        'backup. Use when backups of --from-s3-website-name are made from another server')
+    parser.add_argument('--restore-path', required=False, nargs='+', help='If specified, only these files or ' \
+        'directories (relative to the website directory, e.g. wp-content/uploads/2017) are restored, over what is ' \
+        'there now. The rest of the website and the database are left alone. Only the parts of the backup holding ' \
+        'these paths are downloaded. Not for zip backups made by older versions of web_backup.py')
 
     g.args = parser.parse_args()
 
@@ -51,14 +83,16 @@ def main(argv):
     if g.program_filename[-3:] == '.py':
         g.program_filename = g.program_filename[:-3]
 
-    message_level = util.get_ini_setting('logging', 'level')
+    # web_backup.ini is parsed (and any errors in it reported) once, up front
+    settings = config.get_config()
+    message_level = settings.logging.level
 
     if g.args.message_output_filename is not None:
         g.message_output_filename = g.args.message_output_filename
 
     util.set_logger(message_level, g.message_output_filename, os.path.basename(__file__))
 
-    g.websites = util.get_websites()
+    g.websites = inventory.get_websites()
     if g.args.to_website_name is None or g.args.to_website_name not in g.websites.keys():
         if g.args.to_website_name is None:
             print 'NOTE:  --to-website-name of website to restore into was not specified.'
@@ -66,7 +100,7 @@ def main(argv):
             print 'NOTE:  Specified website \'' + g.args.to_website_name + '\' is not a valid website on this server.'
         print 'Here\'s a list of websites configured on this server.'
         print
-        util.print_websites(g.websites)
+        inventory.print_websites(g.websites)
         sys.exit(0)
 
     if g.args.wp_user is None and g.args.wp_user_password is not None:
@@ -74,62 +108,106 @@ def main(argv):
             'create with that password.')
         sys.exit(1)
 
-    if g.args.from_website_backup_file is None and g.args.from_s3_website_name is None:
+    if g.args.from_website_backup_file is None and g.args.from_s3_website_name is None and \
+            g.args.from_s3_key is None:
         message_error('Must either specify a local backup ZIP file to restore from or an S3 bucket to grab latest ' \
             'backup from.')
         sys.exit(1)
 
+    if g.args.stop_datetime is not None:
+        try:
+            stop_datetime = datetime.datetime.strptime(g.args.stop_datetime, binlog.DATETIME_FORMAT)
+        except ValueError:
+            message_error('--stop-datetime must be formatted as YYYY-MM-DD HH:MM:SS')
+            sys.exit(1)
+
+    if g.args.zip_file_password is not None:
+        zip_file_password = g.args.zip_file_password
+    else:
+        zip_file_password = config.require(settings.zip_file.password, 'zip_file', 'password')
+
+    website_root = settings.website.root_directory
+    website_dir = website_root + '/' + g.args.to_website_name
+
+    if not os.path.isdir(website_dir):
+        message_error(website_dir + ' is not a directory.')
+        sys.exit(1)
+
+    # Each phase from here on is timed and sized into the run's metrics (see the [metrics] section of web_backup.ini)
+    metrics.start_run(g.program_filename, g.args.to_website_name)
+
+    snapshot = None
+    store = None
+
     if g.args.from_website_backup_file is None:
 
         # Load AWS creds which are used for iterating S3 backups and creating download link
-        aws_access_key_id = util.get_ini_setting('aws', 'access_key_id', False)
-        aws_secret_access_key = util.get_ini_setting('aws', 'secret_access_key', False)
-        aws_region_name = util.get_ini_setting('aws', 'region_name', False)
-        aws_s3_bucket_name = util.get_ini_setting('aws', 's3_bucket_name', False)
-
-        # Find latest backup in 'daily' folder of S3 bucket 'ingomarchurch_website_backups'
-        s3 = boto3.resource('s3', aws_access_key_id=aws_access_key_id, aws_secret_access_key=aws_secret_access_key,
-            region_name=aws_region_name)
-        file_items = [item for item in s3.Bucket(aws_s3_bucket_name).objects.all() if item.key[-1] != '/']
-        newest_sortable_str = ''
-        obj_to_retrieve = None
-        for file_item in file_items:
-            path_sects = file_item.key.split('/')
-            if len(path_sects) == 3:
-                if path_sects[0] == g.args.from_s3_website_name:
-                    if path_sects[1] == 'daily':
-                        filename = path_sects[2]
-                        match = re.match('(?P<year>[0-9]{4})(?P<month>[0-9]{2})(?P<day>[0-9]{2})' + \
-                            '(?P<hours>[0-9]{2})(?P<minutes>[0-9]{2})(?P<seconds>[0-9]{2})\.zip', filename)
-                        if match is not None:
-                            sortable_str = match.group('year') + match.group('month') + match.group('day') + \
-                                match.group('hours') + match.group('minutes') + match.group('seconds')
-                            if sortable_str > newest_sortable_str:
-                                newest_sortable_str = sortable_str
-                                obj_to_retrieve = file_item
-                        else:
-                            message("Unrecognized file in 'daily' backup folder...ignoring: " + file_item.key)
-                    else:
-                        message('Non-matching folder or file in website_backups S3 bucket...ignoring: ' +
-                            file_item.key)
-            else:
-                message('Unrecognized folder or file in website_backups S3 bucket with long path...ignoring: ' +
-                    file_item.key)
-        if obj_to_retrieve is not None:
-            # Generate 10-minute download URL
-            s3Client = boto3.client('s3', aws_access_key_id=aws_access_key_id,
-                aws_secret_access_key=aws_secret_access_key, region_name=aws_region_name)
-            url = s3Client.generate_presigned_url('get_object', Params = {'Bucket': aws_s3_bucket_name,
-                'Key': obj_to_retrieve.key}, ExpiresIn = 10 * 60)
+        aws_access_key_id = config.require(settings.aws.access_key_id, 'aws', 'access_key_id')
+        aws_secret_access_key = config.require(settings.aws.secret_access_key, 'aws', 'secret_access_key')
+        aws_region_name = config.require(settings.aws.region_name, 'aws', 'region_name')
+        aws_s3_bucket_name = config.require(settings.aws.s3_bucket_name, 'aws', 's3_bucket_name')
+
+        # Find latest backup in this website's 'daily' folder using the local backup catalog, unless a backup was
+        # picked with --from-s3-key
+        s3_client = s3.get_client(aws_access_key_id, aws_secret_access_key, aws_region_name)
+        if g.args.from_s3_key is not None:
+            obj_to_retrieve = s3.BackupObject(g.args.from_s3_key, None, None, None)
         else:
+            backup_catalog = catalog.open_catalog()
+            with metrics.phase('plan'):
+                if g.args.reconcile_catalog:
+                    catalog.reconcile(backup_catalog, s3_client, aws_s3_bucket_name, g.args.from_s3_website_name,
+                        ['daily'])
+                else:
+                    catalog.ensure_reconciled(backup_catalog, s3_client, aws_s3_bucket_name,
+                        g.args.from_s3_website_name, ['daily'])
+                obj_to_retrieve = None
+                if g.args.stop_datetime is not None:
+                    obj_to_retrieve = catalog.get_first_backup_after(backup_catalog, aws_s3_bucket_name,
+                        g.args.from_s3_website_name, 'daily', stop_datetime.strftime('%Y%m%d%H%M%S'))
+                    if obj_to_retrieve is None:
+                        message_warning('No daily backup made since ' + g.args.stop_datetime + '. Restoring the ' +
+                            'latest one')
+                if obj_to_retrieve is None:
+                    obj_to_retrieve = catalog.get_latest_backup(backup_catalog, aws_s3_bucket_name,
+                        g.args.from_s3_website_name, 'daily')
+        if obj_to_retrieve is None:
             message('Error finding latest backup file to retrieve. Aborting!')
             sys.exit(1)
 
-        backup_zip_file = tempfile.NamedTemporaryFile(prefix='web_restore_', suffix='.zip', delete=False)
-        backup_zip_filename = backup_zip_file.name
-        backup_zip_file.close()
-        os.remove(backup_zip_filename)
-        urllib.urlretrieve(url, backup_zip_filename)
+    if g.args.restore_path is not None:
+        if g.args.from_website_backup_file is None:
+            restore_paths(settings, website_dir, zip_file_password, s3_client, aws_s3_bucket_name,
+                obj_to_retrieve.key)
+        else:
+            restore_paths(settings, website_dir, zip_file_password)
+        report_step_timings()
+        print 'Done!'
+        sys.exit(0)
+
+    if g.args.from_website_backup_file is None and chunk_store.is_snapshot_key(obj_to_retrieve.key):
+        # An incremental backup's snapshot lists the chunks of every file. The database dump and messages log are
+        # rebuilt into a temp directory now, the website files straight into the website directory below
+        if not chunk_store.is_available():
+            message_error('Restoring an incremental backup needs the Python cryptography package. Aborting!')
+            sys.exit(1)
+        store = chunk_store.ChunkStore(s3_client, aws_s3_bucket_name, obj_to_retrieve.key.split('/')[0],
+            zip_file_password, settings.aws.download_workers)
+        g.snapshot_directory = tempfile.mkdtemp(prefix='web_restore_')
+        message_info('Rebuilding database dump from snapshot ' + obj_to_retrieve.key)
+        try:
+            with metrics.phase('download', key=obj_to_retrieve.key) as record:
+                store.open()
+                snapshot = store.get_snapshot(obj_to_retrieve.key)
+                record['files'], record['bytes_in'] = chunk_store.restore_entries(store, snapshot['extra_files'],
+                    g.snapshot_directory)
+        except Exception as e:
+            message_error('Reading snapshot ' + obj_to_retrieve.key + ' failed: ' + str(e))
+            sys.exit(1)
+        backup_zip_filename = None
+        backup_entries = [x['path'] for x in snapshot['extra_files'] if x['type'] == 'file']
+    elif g.args.from_website_backup_file is None:
+        backup_zip_filename = download_backup(settings, s3_client, aws_s3_bucket_name, obj_to_retrieve.key)
     else:
         if os.path.exists(g.args.from_website_backup_file):
             backup_zip_filename = g.args.from_website_backup_file
@@ -137,48 +215,61 @@ def main(argv):
             message_error('Specified website backup file does not exist: ' + g.args.from_website_backup_file)
             sys.exit(1)
 
-    if g.args.zip_file_password is not None:
-        zip_file_password = g.args.zip_file_password
-    else:
-        zip_file_password = util.get_ini_setting('zip_file', 'password', False)
-
-    temp_directory = tempfile.mkdtemp(prefix='web_restore_')
-    exec_zip_list = ['/usr/bin/unzip', '-P', zip_file_password, backup_zip_filename, '-d', temp_directory]
-    message_info('Unzipping backup file container into ' + temp_directory)
-    FNULL = open(os.devnull, 'w')
-    exit_status = subprocess.call(exec_zip_list, stdout=FNULL)
-    website_root = util.get_ini_setting('website', 'root_directory')
-    website_dir = website_root + '/' + g.args.to_website_name
+    # The backup container is never unpacked to a temp directory. Each entry is decrypted and inflated once by
+    # the archive reader (or unzip -p, for an older zip backup) and streamed straight to where it belongs
+    if snapshot is None:
+        backup_entries = get_backup_entries(backup_zip_filename, zip_file_password, get_decryption_workers(settings))
 
-    if not os.path.isdir(website_dir):
-        message_error(website_dir + ' is not a directory.')
-        sys.exit(1)
-
-    # Ensure target directory is empty before restoring files into it
+    # Ensure target directory is empty (or may be cleaned) before restoring files into it
     existing_file_list = os.listdir(website_dir)
-    if len(existing_file_list) != 0:
-        if not g.args.overwrite_files:
-            message_error(website_dir + ' is not empty and --overwrite-files was not specified.  Aborting...')
-            sys.exit(1)
-        else:
-            message_info('Directory ' + website_dir + ' is not empty. Cleaning first.')
-            for the_file in existing_file_list:
-                file_path = os.path.join(website_dir, the_file)
-                if os.path.isfile(file_path):
-                    os.unlink(file_path)
-                elif os.path.isdir(file_path):
-                    shutil.rmtree(file_path)
+    if len(existing_file_list) != 0 and not g.args.overwrite_files:
+        message_error(website_dir + ' is not empty and --overwrite-files was not specified.  Aborting...')
+        sys.exit(1)
 
-    # Restore website files
-    exec_zip_list = ['/usr/bin/unzip', temp_directory + '/files.zip', '-d', website_dir]
-    message_info('Unzipping backed up website files to ' + website_dir)
-    FNULL = open(os.devnull, 'w')
-    exit_status = subprocess.call(exec_zip_list, stdout=FNULL)
+    # A binlog backup (web_backup.py --binlog) between full dumps holds the binlog files written since an earlier
+    # archive's dump. That dump is loaded and the binlog replayed on top of it. A full dump archive also carries the
+    # binlog since the full dump before it, for restoring to a time before its own dump
+    database_zip_filename = backup_zip_filename
+    database_entries = backup_entries
+    base_zip_filename = None
+    binlog_manifest = None
+    replay_files = []
+    binlog_manifest_entry = binlog.BINLOG_DIRECTORY + '/' + binlog.MANIFEST_FILENAME
+    if binlog_manifest_entry in backup_entries:
+        unzip_process = open_backup_entry(backup_zip_filename, zip_file_password, binlog_manifest_entry)
+        binlog_manifest = json.load(unzip_process.stdout)
+        check_backup_entry_process(unzip_process, binlog_manifest_entry)
+        if binlog_manifest['dump_position'] is None or (g.args.stop_datetime is not None and
+                binlog_manifest['base_key'] is not None and g.args.stop_datetime < binlog_manifest['dump_datetime']):
+            if binlog_manifest['base_key'] is None:
+                message_error('Binlog backup has no full database dump to replay onto. Aborting!')
+                sys.exit(1)
+            message_info('Database is restored from the full dump in ' + binlog_manifest['base_key'] + ' plus ' +
+                str(len(binlog_manifest['files'])) + ' binlog files')
+            aws_s3_bucket_name = config.require(settings.aws.s3_bucket_name, 'aws', 's3_bucket_name')
+            s3_client = s3.get_client(config.require(settings.aws.access_key_id, 'aws', 'access_key_id'),
+                config.require(settings.aws.secret_access_key, 'aws', 'secret_access_key'),
+                config.require(settings.aws.region_name, 'aws', 'region_name'))
+            base_zip_filename = download_backup(settings, s3_client, aws_s3_bucket_name, binlog_manifest['base_key'])
+            database_zip_filename = base_zip_filename
+            database_entries = get_backup_entries(base_zip_filename, zip_file_password,
+                get_decryption_workers(settings))
+            replay_files = binlog_manifest['files']
+        elif g.args.stop_datetime is not None:
+            message_warning('Backup was dumped at ' + binlog_manifest['dump_datetime'] + ', so the database is ' +
+                'restored as of then')
 
     # Is there a Wordpress database in the backup for us to restore?
-    if os.path.isfile(temp_directory + '/database.sql'):
-        db_user = util.get_ini_setting('database', 'user', False)
-        db_password = util.get_ini_setting('database', 'password', False)
+    # Backups made with pymysql installed hold one database/<table>.sql.gz per table instead of database.sql
+    dump_manifest = None
+    if 'database/manifest.json' in database_entries:
+        unzip_process = open_backup_entry(database_zip_filename, zip_file_password, 'database/manifest.json')
+        dump_manifest = json.load(unzip_process.stdout)
+        check_backup_entry_process(unzip_process, 'database/manifest.json')
+    restore_database = 'database.sql' in database_entries or dump_manifest is not None
+    if restore_database:
+        db_user = config.require(settings.database.user, 'database', 'user')
+        db_password = config.require(settings.database.password, 'database', 'password')
         output_lines = subprocess.check_output("/bin/mysql -u " + db_user + " -p" + db_password + \
             " -e 'show databases;' 2>/dev/null | /bin/grep wp_", shell=True)
         output_lines_list = [elem for elem in output_lines.split("\n") if elem != ""]
@@ -188,98 +279,55 @@ def main(argv):
                 message_error('Database ' + db_name + ' already exists and --overwrite_database was ' \
                     'not specified. Aborting...')
                 sys.exit(1)
-
-        # Recreate database from backup's database.sql file
-        wp_user = 'wp_user'
-        wp_user_password = None
-        if g.args.wp_user is not None:
-            wp_user = g.args.wp_user
-        if g.args.wp_user is not None and g.args.wp_user_password is not None:
-            wp_user_password = g.args.wp_user_password
-        wrapper_sql_file = create_wrapper_sql_file(db_name, wp_user, wp_user_password, temp_directory)
-        output_lines = subprocess.check_output("/bin/mysql -u " + db_user + " -p" + db_password + \
-            " < " + temp_directory + "/restore.sql", shell=True)
-
-        # Update wp-config.php file
-        wp_config_filename = website_root + '/' + g.args.to_website_name + '/wp-config.php'
-        if not os.path.isfile(wp_config_filename):
-            message_error('Wordpress config file ' + wp_config_filename + ' does not exist.')
+        # Binlog captured as SQL names its database throughout, so it only replays into a database of that name
+        if len(replay_files) > 0 and binlog_manifest.get('format') == binlog.SQL_FORMAT and \
+                binlog_manifest['database'] != db_name:
+            message_error('The binlog of this backup can only be replayed into database ' +
+                binlog_manifest['database'] + ', not ' + db_name + '. Aborting...')
             sys.exit(1)
-        with open(wp_config_filename, 'r') as f_in:
-            with open(wp_config_filename + 'x', 'w') as f_out:
-                in_line = f_in.readline()
-                skipping_lines = False
-                while in_line:
-                    out_line = None
-                    m = re.match('\s*define\(\s*\'DB_NAME\'*,\s*\'(?P<db_name>[^\']+)\'\s*\);\s*', in_line)
-                    if m is not None:
-                        curr_db_name = m.group('db_name')
-                        new_db_name = 'wp_' + g.args.to_website_name
-                        if curr_db_name != new_db_name:
-                            out_line = 'define(\'DB_NAME\', \'' + new_db_name + '\');\n'
-                    m = re.match('\s*define\(\s*\'DB_USER\'*,\s*\'(?P<db_user>[^\']+)\'\s*\);\s*', in_line)
-                    if m is not None and g.args.wp_user is not None:
-                        curr_db_user = m.group('db_user')
-                        new_db_user = g.args.wp_user
-                        if curr_db_user != new_db_user:
-                            out_line = 'define(\'DB_USER\', \'' + new_db_user + '\');\n'
-                    m = re.match('\s*define\(\s*\'DB_PASSWORD\'*,\s*\'(?P<db_password>[^\']+)\'\s*\);\s*', in_line)
-                    if m is not None and g.args.wp_user is not None and g.args.wp_user_password is not None:
-                        curr_db_password = m.group('db_password')
-                        new_db_password = g.args.wp_user_password
-                        if curr_db_password != new_db_password:
-                            out_line = 'define(\'DB_PASSWORD\', \'' + new_db_password + '\');\n'
-                    m = re.match('\s*define\(\s*\'AUTH_KEY\'*', in_line)
-                    if m is not None:
-                        skipping_lines = True
-                    m = re.match('\s*define\(\s*\'NONCE_SALT\'*', in_line)
-                    if m is not None:
-                        skipping_lines = False
-                        send_new_random_salt(f_out)
-                        in_line = f_in.readline()
-                        next
-                    if not skipping_lines:
-                        if out_line is None:
-                            f_out.write(in_line)
-                        else:
-                            f_out.write(out_line)
-                    in_line = f_in.readline()
-        os.rename(wp_config_filename + 'x', wp_config_filename)
 
-        # Rename Wordpress URL in database
-        output_lines = subprocess.check_output('mysql -u ' + db_user + ' -p' + db_password + \
-            ' -e "use wp_' + g.args.to_website_name + ';select option_value from wp_options ' \
-            'where option_name = \'siteurl\';"', shell=True)
-        output_lines_list = [elem for elem in output_lines.split("\n") if elem != ""]
-        current_full_domain = None
-        for line in output_lines_list:
-            m = re.match('[\s\|]*https://(?P<full_domain>[a-z0-9\.]+)[\s\|]*', line)
-            if m is not None:
-                current_full_domain = m.group('full_domain')
-        new_full_domain = g.websites[g.args.to_website_name]['server_name']
-        if current_full_domain is not None and current_full_domain != new_full_domain:
-            message_info('Renaming from https://' + current_full_domain + ' to https://' + new_full_domain + \
-                ' in Wordpress database')
-            output_lines = subprocess.check_output('/usr/local/bin/wp --path=/var/www/' + g.args.to_website_name + \
-                ' search-replace "https://' + current_full_domain + '" "https://' + new_full_domain + '" ' \
-                '--skip-columns=guid', shell=True)
-        else:
-            message_info('No need to rename from https://' + current_full_domain + ' to https://' + \
-                new_full_domain + ' in Wordpress database...skipping')
+    # Restoring the files (disk bound) and loading the database (MySQL server bound) don't depend on each other, so
+    # they run at the same time. wp-config.php is rewritten as soon as the files are in place; the WordPress steps
+    # that need both the files and the database wait for both
+    files_step = RestoreStep('files', restore_files, (website_dir, existing_file_list, backup_zip_filename,
+        zip_file_password, backup_entries, snapshot, store, restore_database))
+    files_step.start()
+    if restore_database:
+        load_database(db_user, db_password, db_name, dump_manifest, database_zip_filename, zip_file_password,
+            settings.database.load_workers)
+        if len(replay_files) > 0:
+            replay_binlog(db_user, db_password, db_name, binlog_manifest, replay_files, backup_zip_filename,
+                zip_file_password, settings.database.socket)
+    files_step.join()
+
+    if restore_database:
+        with metrics.phase('search_replace'):
+            rename_wp_url(db_user, db_password)
 
         # Update and (re)secure Wordpress after a restore
         message_info('Updating and (re)securing Wordpress')
         try:
-            exec_output = subprocess.check_output('/root/bin/update_and_secure_wp ' + website_dir,
-                stderr=subprocess.STDOUT, shell=True)
+            with metrics.phase('update_and_secure_wp'):
+                exec_output = subprocess.check_output('/root/bin/update_and_secure_wp ' + website_dir,
+                    stderr=subprocess.STDOUT, shell=True)
         except subprocess.CalledProcessError as e:
             print '/root/bin/update_and_secure_wp utility exited with error status ' + str(e.returncode) + \
                 ' and error: ' + e.output
             sys.exit(1)
 
+    report_step_timings()
+
     # Cleanup
-    shutil.rmtree(temp_directory)
-    message_info('Temporary output directory deleted')
+    for reader in g.indexed_readers.values():
+        reader.close()
+    g.indexed_readers = {}
+    if g.snapshot_directory is not None:
+        shutil.rmtree(g.snapshot_directory)
+    elif g.args.from_website_backup_file is None:
+        os.remove(backup_zip_filename)
+        message_info('Downloaded backup file deleted')
+    if base_zip_filename is not None:
+        os.remove(base_zip_filename)
 
     print 'NOTE: If you web_restore\'d a WordPress installation with WordFence installed, you may need to hand edit'
     print '      .htaccess to modify auto_prepend_file to point at proper wordfence-waf.php in restored'
@@ -291,6 +339,349 @@ def main(argv):
     sys.exit(0)
 
 
+class RestoreStep(threading.Thread):
+    """Runs one step of the restore on its own thread. join() raises whatever ended the step, sys.exit() included,
+    in the joining thread."""
+
+    def __init__(self, name, target, args):
+        threading.Thread.__init__(self, name=name)
+        # A failure elsewhere exits the restore without waiting for this step
+        self.daemon = True
+        self.step_target = target
+        self.step_args = args
+        self.exc_info = None
+
+    def run(self):
+        try:
+            self.step_target(*self.step_args)
+        except BaseException:
+            self.exc_info = sys.exc_info()
+
+    def join(self):
+        threading.Thread.join(self)
+        if self.exc_info is not None:
+            raise self.exc_info[0], self.exc_info[1], self.exc_info[2]
+
+
+def restore_files(website_dir, existing_file_list, backup_zip_filename, zip_file_password, backup_entries, snapshot,
+                  store, update_wp_config):
+    if len(existing_file_list) != 0:
+        message_info('Directory ' + website_dir + ' is not empty. Cleaning first.')
+        with metrics.phase('clean'):
+            for the_file in existing_file_list:
+                file_path = os.path.join(website_dir, the_file)
+                if os.path.isfile(file_path):
+                    os.unlink(file_path)
+                elif os.path.isdir(file_path):
+                    shutil.rmtree(file_path)
+
+    # Restore website files from an incremental backup's snapshot, an indexed archive, or the nested files.zip of an
+    # older zip backup
+    if snapshot is not None:
+        message_info('Rebuilding backed up website files into ' + website_dir)
+        try:
+            with metrics.phase('unzip') as record:
+                record['files'], record['bytes_out'] = chunk_store.restore_entries(store, snapshot['files'],
+                    website_dir)
+        except Exception as e:
+            message_error('Error rebuilding website files: ' + str(e))
+            sys.exit(1)
+        message_info('Rebuilt ' + str(record['files']) + ' files (' + str(record['bytes_out']) + ' bytes)')
+    elif backup_zip_filename in g.indexed_readers:
+        message_info('Extracting backed up website files into ' + website_dir)
+        reader = g.indexed_readers[backup_zip_filename]
+        try:
+            with metrics.phase('unzip') as record:
+                record['files'], record['bytes_out'] = reader.extract(reader.get_entries(['files']), website_dir,
+                    'files/')
+        except (IOError, OSError) as e:
+            message_error('Error extracting website files: ' + str(e))
+            sys.exit(1)
+        message_info('Extracted ' + str(record['files']) + ' files (' + str(record['bytes_out']) + ' bytes)')
+    elif 'files.zip' in backup_entries:
+        message_info('Streaming backed up website files into ' + website_dir)
+        with metrics.phase('unzip') as record:
+            unzip_process = open_backup_entry(backup_zip_filename, zip_file_password, 'files.zip')
+            try:
+                num_files, num_bytes = archive.extract_zip_stream(unzip_process.stdout, website_dir)
+            except IOError as e:
+                message_error('Error extracting website files: ' + str(e))
+                sys.exit(1)
+            check_backup_entry_process(unzip_process, 'files.zip')
+            record['files'] = num_files
+            record['bytes_out'] = num_bytes
+        message_info('Extracted ' + str(num_files) + ' files (' + str(num_bytes) + ' bytes)')
+
+    if update_wp_config:
+        with metrics.phase('wp_config'):
+            update_wp_config_file(website_dir + '/wp-config.php')
+
+
+def load_database(db_user, db_password, db_name, dump_manifest, database_zip_filename, zip_file_password,
+                  load_workers):
+    # Recreate database from backup's database.sql file (or per-table dump files, load_workers tables at a time)
+    wp_user = 'wp_user'
+    wp_user_password = None
+    if g.args.wp_user is not None:
+        wp_user = g.args.wp_user
+    if g.args.wp_user is not None and g.args.wp_user_password is not None:
+        wp_user_password = g.args.wp_user_password
+    wrapper_sql = get_wrapper_sql(db_name, wp_user, wp_user_password)
+    with metrics.phase('database_load') as record:
+        if dump_manifest is None:
+            message_info('Streaming database.sql into database ' + db_name)
+            started = time.time()
+            bulk_load_filter = db_load.BulkLoadFilter()
+            record['files'] = 1
+            record['bytes_out'] = load_backup_entry_into_mysql(db_user, db_password, None, wrapper_sql,
+                database_zip_filename, zip_file_password, 'database.sql', bulk_load_filter)
+            load_seconds = time.time() - started
+            # Tables were timed as their SQL went by, and their indexes are rebuilt (and timed) one table at a time
+            table_results = []
+            for table_stats in bulk_load_filter.tables:
+                index_started = time.time()
+                index_sql = bulk_load_filter.get_index_sql(table_stats['table'])
+                if index_sql != '':
+                    load_backup_entry_into_mysql(db_user, db_password, db_name, index_sql)
+                table_results.append(get_table_result(table_stats['table'], table_stats['rows'],
+                    table_stats['bytes'], table_stats['load_seconds'], time.time() - index_started))
+            record['rows'] = sum(x['rows'] for x in table_results)
+            record['tables'] = table_results
+            message_info('Loaded database.sql in ' + '%.1f' % load_seconds + 's, rebuilt ' +
+                str(sum(len(x[1]) for x in bulk_load_filter.deferred_keys)) + ' indexes in ' + '%.1f' %
+                (time.time() - started - load_seconds) + 's')
+        else:
+            load_backup_entry_into_mysql(db_user, db_password, None, wrapper_sql)
+            # Tables are loaded largest first, which is the order they were dumped in
+            message_info('Loading ' + str(len(dump_manifest['tables'])) + ' tables, ' + str(load_workers) +
+                ' at a time')
+            pool = ThreadPool(max(1, min(load_workers, len(dump_manifest['tables']))))
+            try:
+                table_results = pool.map(lambda x: load_table(db_user, db_password, db_name, x,
+                    database_zip_filename, zip_file_password), dump_manifest['tables'])
+            except Exception as e:
+                message_error(str(e))
+                sys.exit(1)
+            finally:
+                pool.close()
+                pool.join()
+            record['files'] = len(table_results)
+            record['rows'] = sum(x['rows'] for x in table_results)
+            record['bytes_out'] = sum(x['bytes'] for x in table_results)
+            record['tables'] = table_results
+
+
+def load_table(db_user, db_password, db_name, table_info, database_zip_filename, zip_file_password):
+    # Loads one table's dump, then builds its secondary indexes. Returns its row count and timings
+    started = time.time()
+    bulk_load_filter = db_load.BulkLoadFilter()
+    try:
+        num_bytes = load_backup_entry_into_mysql(db_user, db_password, db_name, '', database_zip_filename,
+            zip_file_password, 'database/' + table_info['filename'], bulk_load_filter)
+        load_seconds = time.time() - started
+        index_sql = bulk_load_filter.get_index_sql()
+        if index_sql != '':
+            load_backup_entry_into_mysql(db_user, db_password, db_name, index_sql)
+    except SystemExit:
+        # sys.exit() in a pool thread would end the worker without a result, leaving the pool waiting on it
+        raise Exception('Loading table ' + table_info['table'] + ' failed')
+    return get_table_result(table_info['table'], table_info['rows'], num_bytes, load_seconds,
+        time.time() - started - load_seconds)
+
+
+def get_table_result(table_name, rows, num_bytes, load_seconds, index_seconds):
+    # The same per-table metrics (and message) whether the tables came from their own dump files or database.sql
+    seconds = load_seconds + index_seconds
+    table_result = {'table': table_name, 'rows': rows, 'bytes': num_bytes, 'seconds': seconds,
+        'load_seconds': load_seconds, 'index_seconds': index_seconds, 'rows_per_second': rows / max(seconds, 0.001)}
+    message_info('Loaded table ' + table_name + ': ' + str(rows) + ' rows in ' + '%.1f' % seconds + 's (' +
+        str(int(table_result['rows_per_second'])) + ' rows/s), indexes rebuilt in ' + '%.1f' % index_seconds + 's')
+    return table_result
+
+
+def replay_binlog(db_user, db_password, db_name, binlog_manifest, replay_files, backup_zip_filename,
+                  zip_file_password, socket_filename):
+    message_info('Replaying ' + str(len(replay_files)) + ' binlog files into database ' + db_name +
+        ('' if g.args.stop_datetime is None else ' up to ' + g.args.stop_datetime))
+    binlog_directory = tempfile.mkdtemp(prefix='web_restore_binlog_')
+    try:
+        with metrics.phase('binlog_replay', files=len(replay_files)) as record:
+            record['bytes_in'] = 0
+            for name in replay_files:
+                entry_name = binlog.BINLOG_DIRECTORY + '/' + name
+                unzip_process = open_backup_entry(backup_zip_filename, zip_file_password, entry_name)
+                with open(os.path.join(binlog_directory, name), 'wb') as f:
+                    shutil.copyfileobj(unzip_process.stdout, f, 1024 * 1024)
+                check_backup_entry_process(unzip_process, entry_name)
+                record['bytes_in'] += os.path.getsize(os.path.join(binlog_directory, name))
+            connection_args = binlog.get_connection_args(db_user, db_password, socket_filename)
+            filenames = [os.path.join(binlog_directory, x) for x in replay_files]
+            if binlog_manifest.get('format') == binlog.SQL_FORMAT:
+                binlog.replay_sql(connection_args, filenames, g.args.stop_datetime)
+            else:
+                binlog.replay(connection_args, filenames, binlog_manifest['base_position'][1],
+                    binlog_manifest['database'], db_name, g.args.stop_datetime)
+    except (binlog.BinlogError, OSError) as e:
+        message_error('Error replaying binlog: ' + str(e))
+        sys.exit(1)
+    finally:
+        shutil.rmtree(binlog_directory)
+
+
+def update_wp_config_file(wp_config_filename):
+    if not os.path.isfile(wp_config_filename):
+        message_error('Wordpress config file ' + wp_config_filename + ' does not exist.')
+        sys.exit(1)
+    with open(wp_config_filename, 'r') as f_in:
+        with open(wp_config_filename + 'x', 'w') as f_out:
+            in_line = f_in.readline()
+            skipping_lines = False
+            while in_line:
+                out_line = None
+                m = re.match('\s*define\(\s*\'DB_NAME\'*,\s*\'(?P<db_name>[^\']+)\'\s*\);\s*', in_line)
+                if m is not None:
+                    curr_db_name = m.group('db_name')
+                    new_db_name = 'wp_' + g.args.to_website_name
+                    if curr_db_name != new_db_name:
+                        out_line = 'define(\'DB_NAME\', \'' + new_db_name + '\');\n'
+                m = re.match('\s*define\(\s*\'DB_USER\'*,\s*\'(?P<db_user>[^\']+)\'\s*\);\s*', in_line)
+                if m is not None and g.args.wp_user is not None:
+                    curr_db_user = m.group('db_user')
+                    new_db_user = g.args.wp_user
+                    if curr_db_user != new_db_user:
+                        out_line = 'define(\'DB_USER\', \'' + new_db_user + '\');\n'
+                m = re.match('\s*define\(\s*\'DB_PASSWORD\'*,\s*\'(?P<db_password>[^\']+)\'\s*\);\s*', in_line)
+                if m is not None and g.args.wp_user is not None and g.args.wp_user_password is not None:
+                    curr_db_password = m.group('db_password')
+                    new_db_password = g.args.wp_user_password
+                    if curr_db_password != new_db_password:
+                        out_line = 'define(\'DB_PASSWORD\', \'' + new_db_password + '\');\n'
+                m = re.match('\s*define\(\s*\'AUTH_KEY\'*', in_line)
+                if m is not None:
+                    skipping_lines = True
+                m = re.match('\s*define\(\s*\'NONCE_SALT\'*', in_line)
+                if m is not None:
+                    skipping_lines = False
+                    send_new_random_salt(f_out)
+                    in_line = f_in.readline()
+                    next
+                if not skipping_lines:
+                    if out_line is None:
+                        f_out.write(in_line)
+                    else:
+                        f_out.write(out_line)
+                in_line = f_in.readline()
+    os.rename(wp_config_filename + 'x', wp_config_filename)
+
+
+def rename_wp_url(db_user, db_password):
+    # Rename Wordpress URL in database
+    output_lines = subprocess.check_output('mysql -u ' + db_user + ' -p' + db_password + \
+        ' -e "use wp_' + g.args.to_website_name + ';select option_value from wp_options ' \
+        'where option_name = \'siteurl\';"', shell=True)
+    output_lines_list = [elem for elem in output_lines.split("\n") if elem != ""]
+    current_full_domain = None
+    for line in output_lines_list:
+        m = re.match('[\s\|]*https://(?P<full_domain>[a-z0-9\.]+)[\s\|]*', line)
+        if m is not None:
+            current_full_domain = m.group('full_domain')
+    new_full_domain = g.websites[g.args.to_website_name].server_name
+    if current_full_domain is not None and current_full_domain != new_full_domain:
+        message_info('Renaming from https://' + current_full_domain + ' to https://' + new_full_domain + \
+            ' in Wordpress database')
+        output_lines = subprocess.check_output('/usr/local/bin/wp --path=/var/www/' + g.args.to_website_name + \
+            ' search-replace "https://' + current_full_domain + '" "https://' + new_full_domain + '" ' \
+            '--skip-columns=guid', shell=True)
+    else:
+        message_info('No need to rename from https://' + str(current_full_domain) + ' to https://' + \
+            new_full_domain + ' in Wordpress database...skipping')
+
+
+def report_step_timings():
+    # Steps that ran at the same time show overlapping start offsets and durations
+    phases = metrics.get_phases()
+    if len(phases) == 0:
+        return
+    started = min(x['started'] for x in phases)
+    for record in sorted(phases, key=lambda x: x['started']):
+        message_info('Step ' + record['phase'] + ': started at +' + '%.1f' % (record['started'] - started) +
+            's, took ' + '%.1f' % record['seconds'] + 's')
+    message_info('Restore steps took ' + '%.1f' % (max(x['started'] + x['seconds'] for x in phases) - started) +
+        's in all')
+
+
+def restore_paths(settings, website_dir, zip_file_password, s3_client=None, aws_s3_bucket_name=None, s3_key=None):
+    # Restores just --restore-path from the local backup file, or from s3_key without downloading all of it: an
+    # indexed archive's index is read from its end and then only the byte ranges of the wanted files, and an
+    # incremental backup's snapshot gives the chunks of the wanted files
+    paths = [x.strip('/') for x in g.args.restore_path]
+    if '' in paths:
+        message_error('--restore-path cannot be the whole website. Aborting!')
+        sys.exit(1)
+    message_info('Restoring ' + ', '.join(paths) + ' into ' + website_dir)
+    try:
+        with metrics.phase('unzip', key=s3_key) as record:
+            if s3_key is not None and chunk_store.is_snapshot_key(s3_key):
+                if not chunk_store.is_available():
+                    message_error('Restoring an incremental backup needs the Python cryptography package. Aborting!')
+                    sys.exit(1)
+                store = chunk_store.ChunkStore(s3_client, aws_s3_bucket_name, s3_key.split('/')[0],
+                    zip_file_password, settings.aws.download_workers)
+                store.open()
+                entries = [x for x in store.get_snapshot(s3_key)['files'] if x['path'] in paths or
+                    len([y for y in paths if x['path'].startswith(y + '/')]) > 0]
+                if len(entries) == 0:
+                    message_error('None of ' + ', '.join(paths) + ' is in ' + s3_key + '. Aborting!')
+                    sys.exit(1)
+                record['files'], record['bytes_out'] = chunk_store.restore_entries(store, entries, website_dir)
+            else:
+                if s3_key is not None:
+                    source = indexed_archive.S3Source(s3_client, aws_s3_bucket_name, s3_key)
+                elif not os.path.isfile(g.args.from_website_backup_file):
+                    message_error('Specified website backup file does not exist: ' + g.args.from_website_backup_file)
+                    sys.exit(1)
+                else:
+                    source = indexed_archive.FileSource(g.args.from_website_backup_file)
+                if not indexed_archive.is_available():
+                    message_error('Restoring from an indexed archive needs the Python cryptography package. ' +
+                        'Aborting!')
+                    sys.exit(1)
+                reader = indexed_archive.ArchiveReader(source, zip_file_password, get_decryption_workers(settings))
+                try:
+                    reader.open()
+                    check_archive_codec(reader)
+                    entries = reader.get_entries(['files/' + x for x in paths])
+                    if len(entries) == 0:
+                        message_error('None of ' + ', '.join(paths) + ' is in the backup. Aborting!')
+                        sys.exit(1)
+                    record['files'], record['bytes_out'] = reader.extract(entries, website_dir, 'files/')
+                finally:
+                    reader.close()
+                record['bytes_in'] = source.bytes_read
+    except Exception as e:
+        message_error('Error restoring ' + ', '.join(paths) + ': ' + str(e) + '. --restore-path needs a .wba ' +
+            'archive or incremental backup')
+        sys.exit(1)
+    message_info('Restored ' + str(record['files']) + ' files (' + str(record['bytes_out']) + ' bytes)')
+
+
+def download_backup(settings, s3_client, aws_s3_bucket_name, s3_key):
+    # Download with parallel ranged GETs into a filename derived from the S3 key, so that a rerun after an
+    # interrupted download picks up the parts already fetched
+    backup_zip_filename = os.path.join(tempfile.gettempdir(), 'web_restore_' + s3_key.replace('/', '_'))
+    part_size = settings.aws.download_part_size_mb * 1024 * 1024
+    num_workers = settings.aws.download_workers
+    message_info('Downloading ' + s3_key + ' to ' + backup_zip_filename)
+    try:
+        with metrics.phase('download', key=s3_key, files=1) as record:
+            record['bytes_in'] = s3.download_object(s3_client, aws_s3_bucket_name, s3_key, backup_zip_filename,
+                part_size, num_workers)
+    except Exception as e:
+        message_error('Download of ' + s3_key + ' failed (rerun to resume): ' + str(e))
+        sys.exit(1)
+    return backup_zip_filename
+
+
 def send_new_random_salt(output_file):
     output_lines = subprocess.check_output('/bin/curl https://api.wordpress.org/secret-key/1.1/salt/', shell=True)
     output_lines_list = [elem for elem in output_lines.split("\n") if elem != ""]
@@ -298,19 +689,116 @@ def send_new_random_salt(output_file):
         output_file.write(line + '\n')
 
 
-def create_wrapper_sql_file(db_name, wp_user, wp_user_password, temp_directory):
-    wrapper_sql_filename = temp_directory + '/restore.sql'
-    with open(wrapper_sql_filename, 'w') as f_out:
-        f_out.write('DROP DATABASE IF EXISTS ' + db_name + ';\n')
-        f_out.write('CREATE DATABASE ' + db_name + ';\n')
-        if wp_user is not None and wp_user_password is not None:
-            f_out.write('CREATE USER IF NOT EXISTS \'' + wp_user + '\'@\'localhost\' IDENTIFIED BY \'' + \
-                wp_user_password + '\';\n')
-        if wp_user is not None:
-            f_out.write('GRANT ALL ON ' + db_name + '.* TO \'' + wp_user + '\'@\'localhost\';\n')
-        f_out.write('USE ' + db_name + ';\n')
-        f_out.write('source ' + temp_directory + '/database.sql;\n')
-    return wrapper_sql_filename
+def get_wrapper_sql(db_name, wp_user, wp_user_password):
+    wrapper_sql = 'DROP DATABASE IF EXISTS ' + db_name + ';\n'
+    wrapper_sql += 'CREATE DATABASE ' + db_name + ';\n'
+    if wp_user is not None and wp_user_password is not None:
+        wrapper_sql += 'CREATE USER IF NOT EXISTS \'' + wp_user + '\'@\'localhost\' IDENTIFIED BY \'' + \
+            wp_user_password + '\';\n'
+    if wp_user is not None:
+        wrapper_sql += 'GRANT ALL ON ' + db_name + '.* TO \'' + wp_user + '\'@\'localhost\';\n'
+    wrapper_sql += 'USE ' + db_name + ';\n'
+    return wrapper_sql
+
+
+def get_decryption_workers(settings):
+    # Archive records are decrypted and inflated on as many threads as web_backup.py compresses them on
+    if settings.zip_file.compression_workers == 0:
+        return multiprocessing.cpu_count()
+    return settings.zip_file.compression_workers
+
+
+def get_backup_entries(backup_zip_filename, zip_file_password, num_workers):
+    # Archives (.wba) are opened once here, which reads their index, and kept in g.indexed_readers for
+    # open_backup_entry(). Zip files are backups made before web_backup.py encrypted archives itself
+    if not indexed_archive.is_indexed_archive(backup_zip_filename):
+        return subprocess.check_output(['/usr/bin/unzip', '-Z1', backup_zip_filename]).splitlines()
+    if not indexed_archive.is_available():
+        message_error('Restoring an indexed archive needs the Python cryptography package. Aborting!')
+        sys.exit(1)
+    reader = indexed_archive.ArchiveReader(indexed_archive.FileSource(backup_zip_filename), zip_file_password,
+        num_workers)
+    try:
+        reader.open()
+    except IOError as e:
+        reader.close()
+        message_error('Error reading ' + backup_zip_filename + ': ' + str(e))
+        sys.exit(1)
+    check_archive_codec(reader)
+    g.indexed_readers[backup_zip_filename] = reader
+    return reader.get_names()
+
+
+def check_archive_codec(reader):
+    # Each block says which codec it is compressed with, so this only catches a missing package before restoring
+    # starts rather than partway through
+    if not compression.is_available(reader.codec_name):
+        message_error('Backup is compressed with ' + reader.codec_name + ', which needs the Python zstandard ' +
+            'package (pip install zstandard). Aborting!')
+        sys.exit(1)
+    message_info('Backup archive is compressed with ' + reader.codec_name)
+
+
+class IndexedArchiveEntry:
+    """Stands in for an unzip -p process reading one entry of an indexed archive."""
+
+    def __init__(self, entry_file):
+        self.stdout = entry_file
+
+    def wait(self):
+        return 0
+
+
+def open_backup_entry(backup_zip_filename, zip_file_password, entry_name):
+    # Entries of an incremental backup were already rebuilt as plain files
+    if g.snapshot_directory is not None:
+        return subprocess.Popen(['/bin/cat', os.path.join(g.snapshot_directory, entry_name)], stdout=subprocess.PIPE)
+    if backup_zip_filename in g.indexed_readers:
+        return IndexedArchiveEntry(g.indexed_readers[backup_zip_filename].open_entry(entry_name))
+    # unzip -p writes the decrypted, inflated contents of just the one entry to its stdout
+    return subprocess.Popen(['/usr/bin/unzip', '-p', '-P', zip_file_password, backup_zip_filename, entry_name],
+        stdout=subprocess.PIPE)
+
+
+def check_backup_entry_process(unzip_process, entry_name):
+    exit_status = unzip_process.wait()
+    if exit_status != 0:
+        message_error('Error running unzip on ' + entry_name + '. Exit status ' + str(exit_status))
+        sys.exit(1)
+
+
+def load_backup_entry_into_mysql(db_user, db_password, db_name, sql_prefix, backup_zip_filename=None,
+                                 zip_file_password=None, entry_name=None, bulk_load_filter=None):
+    # Pipes sql_prefix followed by the backup entry (gunzipped on the fly if it is a .gz) into the mysql client.
+    # With a bulk_load_filter, the entry is loaded in one transaction without per-row checks, and its secondary
+    # indexes are held back (see db_load.BulkLoadFilter). Returns the number of bytes of SQL sent
+    exec_mysql_list = ['/bin/mysql', '-u', db_user, '-p' + db_password]
+    if db_name is not None:
+        exec_mysql_list.append(db_name)
+    mysql_process = subprocess.Popen(exec_mysql_list, stdin=subprocess.PIPE)
+    mysql_process.stdin.write(sql_prefix)
+    num_bytes = len(sql_prefix)
+    if entry_name is not None:
+        unzip_process = open_backup_entry(backup_zip_filename, zip_file_password, entry_name)
+        decompressor = None
+        if entry_name.endswith('.gz'):
+            decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        chunks = iter(lambda: unzip_process.stdout.read(1024 * 1024), '')
+        if decompressor is not None:
+            chunks = (decompressor.decompress(x) for x in chunks)
+        if bulk_load_filter is not None:
+            chunks = itertools.chain([db_load.BULK_LOAD_PREFIX], bulk_load_filter.filter(chunks),
+                [db_load.BULK_LOAD_SUFFIX])
+        for chunk in chunks:
+            mysql_process.stdin.write(chunk)
+            num_bytes += len(chunk)
+        check_backup_entry_process(unzip_process, entry_name)
+    mysql_process.stdin.close()
+    exit_status = mysql_process.wait()
+    if exit_status != 0:
+        message_error('Error loading ' + str(entry_name) + ' into MySQL. Exit status ' + str(exit_status))
+        sys.exit(1)
+    return num_bytes
 
 
 def message(str):
@@ -346,4 +834,13 @@ def output_message(s, level):
 
 
 if __name__ == "__main__":
-    main(sys.argv[1:])
+    # The run's metrics are written however it exits
+    try:
+        main(sys.argv[1:])
+    except SystemExit as e:
+        metrics.finish(e.code)
+        raise
+    except:
+        metrics.finish(1)
+        raise
+    metrics.finish(0)